@@ -6,6 +6,10 @@ from flask_talisman import Talisman
 def create_app(config_class=Config):
     app = Flask(__name__)
     app.config.from_object(config_class)
+
+    # Stream file uploads straight into the upload folder
+    from app.services.ingest import IngestRequest
+    app.request_class = IngestRequest
     
     # Security Plugins
     csrf = CSRFProtect(app)
@@ -14,6 +18,21 @@ def create_app(config_class=Config):
 
     config_class.init_app(app)
 
+    from app.services.metadata_templates import MetadataTemplates
+    MetadataTemplates.init_app(app)
+
+    from app.services.file_reaper import FileReaper
+    FileReaper.init_app(app)
+
+    from app.services.metrics import Metrics
+    Metrics.init_app(app)
+
+    from app.services.profiler import Profiler
+    Profiler.init_app(app)
+
+    from app.services.job_runner import JobRunner
+    JobRunner.init_app(app)
+
     from app.main import main as main_blueprint
     app.register_blueprint(main_blueprint)
 
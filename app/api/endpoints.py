@@ -1,23 +1,28 @@
-from flask import jsonify, request, send_file, current_app
+from flask import jsonify, request, send_file, current_app, url_for, Response, stream_with_context
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.utils import secure_filename
 from app.api import api
 from app.services.image_handler import ImageHandler
 from app.services.exif_manager import ExifManager
+from app.services.batch_processor import BatchProcessor
+from app.services.heif_editor import TRANSCODE_FORMATS
+from app.services.ingest import sniff_format
+from app.services.job_queue import OPERATIONS
+from app.services.job_runner import JobRunner
+from app.services.metadata_templates import MetadataTemplates
+from app.services.multipart_stream import MultipartStream
+from app.services.zip_streamer import ZipStreamer
+from app.services.gps_batch import GpsBatch, EXPORT_FORMATS
 import os
-import random
+import json
+import uuid
+import logging
 
-def trigger_bg_cleanup():
-    # Cleanup files based on configuraton
-    prob = current_app.config.get('CLEANUP_PROBABILITY', 0.2)
-    max_age = current_app.config.get('MAX_FILE_AGE_SECONDS', 3600)
-    
-    if random.random() < prob:
-        ImageHandler.cleanup_old_files(max_age)
+
+logger = logging.getLogger(__name__)
 
 @api.route('/analyze', methods=['POST'])
 def analyze():
-    # Cleanup check
-    trigger_bg_cleanup()
-    
     if 'image' not in request.files:
         return jsonify({'error': 'No image provided'}), 400
     
@@ -28,7 +33,7 @@ def analyze():
         return jsonify({'error': 'Invalid file'}), 400
         
     file_path = ImageHandler.get_path(filename)
-    exif_data = ExifManager.get_exif_data(file_path)
+    exif_data = ExifManager.get_exif_data(file_path, ImageHandler.get_content_hash(filename))
     
     return jsonify({
         'filename': filename,
@@ -37,9 +42,6 @@ def analyze():
 
 @api.route('/purify', methods=['POST'])
 def purify():
-    # Cleanup check
-    trigger_bg_cleanup()
-
     if 'image' not in request.files:
         return jsonify({'error': 'No image provided'}), 400
         
@@ -53,10 +55,415 @@ def purify():
     purified_path = ExifManager.remove_exif(file_path)
     
     if purified_path:
-        purified_filename = os.path.basename(purified_path)
-        if purified_filename != filename:
-            ImageHandler.delete_file(filename)
-            
-        return send_file(purified_path, mimetype='image/jpeg') 
+        purified_filename = ImageHandler.replace_file(filename, purified_path)
+        purified_path = ImageHandler.get_path(purified_filename)
+
+        # Optional conversion (e.g. HEIC to JPEG), on the batch pool
+        fmt = request.form.get('format')
+        if fmt:
+            fmt = fmt.upper()
+            if fmt not in TRANSCODE_FORMATS:
+                return jsonify({'error': f"format must be one of: {', '.join(TRANSCODE_FORMATS)}"}), 400
+            try:
+                quality = max(1, min(100, int(request.form.get('quality', current_app.config.get('TRANSCODE_QUALITY', 90)))))
+            except ValueError:
+                return jsonify({'error': 'quality must be an integer'}), 400
+            result = BatchProcessor.run(
+                'transcode', [purified_filename], [purified_path], {'format': fmt, 'quality': quality}
+            )[0]
+            if not result['result']:
+                return jsonify({'error': result['error'] or 'Conversion failed'}), 500
+            purified_path = ImageHandler.get_path(ImageHandler.replace_file(purified_filename, result['result']))
+
+        return send_file(purified_path, mimetype=_image_mimetype(purified_path))
     
     return jsonify({'error': 'Processing failed'}), 500
+
+def _image_mimetype(path):
+    ext = path.rsplit('.', 1)[-1].lower()
+    return {'jpg': 'image/jpeg', 'tif': 'image/tiff', 'heic': 'image/heic', 'heif': 'image/heif'}.get(ext, f'image/{ext}')
+
+# --- Bulk (streaming) ---
+
+BULK_FIELDS = ('image', 'images')
+
+def _bulk_parts():
+    """Returns an iterator over the parts of the request body, or None if it is not multipart."""
+    boundary = request.mimetype_params.get('boundary')
+    if request.mimetype != 'multipart/form-data' or not boundary:
+        return None
+    # A bulk body carries many uploads: it gets its own size limit
+    request.max_content_length = current_app.config.get('BULK_MAX_CONTENT_LENGTH')
+    return MultipartStream.iter_parts(
+        request.stream, boundary.encode(), current_app.config['UPLOAD_FOLDER'],
+        max_parts=current_app.config.get('BULK_MAX_FILES', 10000) + 16
+    )
+
+def _bulk_images(parts, fields):
+    """
+    Yields (index, filename, ingest, error) for each image part as it arrives.
+    ingest is None when the part was rejected. Form fields are collected into
+    fields; send options before the images. Each upload is deleted once the
+    consumer moves on to the next one.
+    """
+    index = 0
+    for name, filename, value in parts:
+        if filename is None:
+            fields[name] = value
+            continue
+        try:
+            if name not in BULK_FIELDS:
+                continue
+            if not ImageHandler.allowed_file(filename):
+                yield index, filename, None, 'File type not allowed'
+            elif value.size == 0 or sniff_format(value.head) is None:
+                yield index, filename, None, 'Invalid image file'
+            else:
+                yield index, filename, value, None
+            index += 1
+        finally:
+            value.close()
+
+def _bulk_quality(fields):
+    try:
+        return max(1, min(100, int(fields['quality']))) if fields.get('quality') else None
+    except ValueError:
+        return None
+
+@api.route('/analyze/bulk', methods=['POST'])
+def analyze_bulk():
+    """
+    Analyzes every 'image' part of a multipart body and streams one JSON line
+    per file as soon as it is received. Failures are reported on the file's
+    own line. Nothing is stored.
+    """
+    parts = _bulk_parts()
+    if parts is None:
+        return jsonify({'error': 'Expected multipart/form-data'}), 400
+
+    def generate():
+        try:
+            for index, filename, ingest, error in _bulk_images(parts, {}):
+                line = {'index': index, 'filename': filename}
+                if error is None:
+                    try:
+                        line['sha256'] = ingest.sha256
+                        line['exif_data'] = ExifManager.get_exif_data(ingest.path, ingest.sha256)
+                    except Exception as e:
+                        logger.error(f"Bulk analysis failed for {filename}: {e}")
+                        error = 'Processing failed'
+                if error is not None:
+                    line['error'] = error
+                yield current_app.json.dumps(line) + '\n'
+        except (ValueError, RequestEntityTooLarge) as e:
+            # The body itself is unusable: report it as the last line
+            yield current_app.json.dumps({'error': f"Malformed request body: {e}"}) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@api.route('/purify/bulk', methods=['POST'])
+def purify_bulk():
+    """
+    Purifies every 'image' part of a multipart body and streams the results
+    as a ZIP, one entry per file as soon as it is processed. A file that
+    fails gets a '<name>.error.txt' entry instead. An optional 'quality'
+    field sent before the images requests lossy re-encoding.
+    """
+    parts = _bulk_parts()
+    if parts is None:
+        return jsonify({'error': 'Expected multipart/form-data'}), 400
+    upload_folder = current_app.config['UPLOAD_FOLDER']
+
+    def entries():
+        fields = {}
+        used = set()
+        try:
+            for index, filename, ingest, error in _bulk_images(parts, fields):
+                name = secure_filename(filename) or f"image_{index}"
+                if name in used:
+                    name = f"{index}_{name}"
+                used.add(name)
+                if error is None:
+                    dest_path = os.path.join(upload_folder, f".bulk_{uuid.uuid4().hex}_{name}")
+                    try:
+                        if ExifManager.remove_exif(ingest.path, dest_path, quality=_bulk_quality(fields)):
+                            yield dest_path, name
+                            continue
+                        error = 'Processing failed'
+                    finally:
+                        if os.path.exists(dest_path):
+                            os.remove(dest_path)
+                yield f"{error}\n".encode(), f"{name}.error.txt"
+        except (ValueError, RequestEntityTooLarge) as e:
+            yield f"Malformed request body: {e}\n".encode(), 'error.txt'
+
+    return Response(
+        stream_with_context(ZipStreamer.stream(entries())),
+        mimetype='application/zip',
+        headers={'Content-Disposition': 'attachment; filename=picturify_purified.zip'}
+    )
+
+@api.route('/gps/bulk', methods=['POST'])
+def gps_bulk():
+    """
+    Extracts the GPS position of every 'image' part of a multipart body and
+    returns them as GeoJSON (default) or CSV ('format' query argument or
+    field). Each file is read as it arrives and the coordinates of all of
+    them are converted at the end, in one pass. Nothing is stored.
+    """
+    fmt = request.args.get('format', 'geojson')
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({'error': f"format must be one of: {', '.join(EXPORT_FORMATS)}"}), 400
+    parts = _bulk_parts()
+    if parts is None:
+        return jsonify({'error': 'Expected multipart/form-data'}), 400
+
+    fields = {}
+
+    def located_files():
+        for index, filename, ingest, error in _bulk_images(parts, fields):
+            if error is None:
+                yield filename or f"image_{index}", ingest.path
+
+    try:
+        positions = GpsBatch.collect(located_files())
+    except (ValueError, RequestEntityTooLarge) as e:
+        return jsonify({'error': f"Malformed request body: {e}"}), 400
+
+    fmt = fields.get('format', fmt)
+    if fmt == 'csv':
+        return Response(positions.to_csv(), mimetype='text/csv')
+    return Response(positions.to_geojson(), mimetype='application/geo+json')
+
+# --- Asynchronous jobs ---
+
+WATERMARK_POSITIONS = ('center', 'bottom-right', 'bottom-left', 'top-right', 'top-left')
+
+def _job_options(operation, form):
+    """Validates the options of a job submission. Returns (options, error)."""
+    if operation not in OPERATIONS:
+        return None, f"operation must be one of: {', '.join(OPERATIONS)}"
+
+    options = {}
+    if form.get('quality'):
+        try:
+            options['quality'] = max(1, min(100, int(form['quality'])))
+        except ValueError:
+            return None, 'quality must be an integer'
+
+    if operation == 'template':
+        template = form.get('template')
+        if not MetadataTemplates.get_compiled(template):
+            return None, 'Invalid template'
+        options['template'] = template
+    elif operation == 'edit':
+        try:
+            changes = json.loads(form.get('changes') or '{}')
+        except ValueError:
+            return None, 'changes must be a JSON object'
+        if not isinstance(changes, dict) or not changes:
+            return None, 'changes must be a non-empty JSON object'
+        changes.setdefault('Software', 'Picturify')
+        options['changes'] = {str(k): str(v) for k, v in changes.items()}
+    elif operation == 'watermark':
+        if not form.get('text'):
+            return None, 'Watermark text is required'
+        position = form.get('position', 'center')
+        if position not in WATERMARK_POSITIONS:
+            return None, f"position must be one of: {', '.join(WATERMARK_POSITIONS)}"
+        try:
+            opacity = float(form.get('opacity', 0.5))
+        except ValueError:
+            return None, 'opacity must be a number'
+        options.update(text=form['text'], position=position, opacity=max(0.0, min(1.0, opacity)))
+    return options, None
+
+def _add_job_files(queue, job_id, files):
+    """
+    Moves valid uploads into the job. Returns (added, rejected names), or
+    None if the job does not accept that many more files.
+    """
+    accepted, rejected = [], []
+    try:
+        for file in files:
+            if not file or not file.filename:
+                continue
+            ingest = ImageHandler._ingest(file)
+            if not ImageHandler.allowed_file(file.filename) or ingest.size == 0 or sniff_format(ingest.head) is None:
+                rejected.append(file.filename)
+                ingest.close()
+                continue
+            accepted.append((secure_filename(file.filename) or 'image', ingest))
+
+        if not accepted:
+            return 0, rejected
+        first = queue.reserve(job_id, len(accepted), current_app.config.get('JOB_MAX_FILES', 10000))
+        if first is None:
+            return None
+
+        items = []
+        for offset, (name, ingest) in enumerate(accepted):
+            seq = first + offset
+            ingest.commit(queue.input_path(job_id, seq, name))
+            items.append((seq, name))
+        queue.add_items(job_id, items)
+        return len(items), rejected
+    finally:
+        # Deletes spooled uploads that were not moved into the job
+        for _, ingest in accepted:
+            ingest.close()
+
+def _job_payload(job):
+    counts = job['counts']
+    finished = counts.get('done', 0) + counts.get('failed', 0)
+    return {
+        'id': job['id'],
+        'operation': job['operation'],
+        'status': job['status'],
+        'total': job['total'],
+        'queued': counts.get('pending', 0) + counts.get('queued', 0),
+        'running': counts.get('running', 0),
+        'done': counts.get('done', 0),
+        'failed': counts.get('failed', 0),
+        'progress': round(finished / job['total'], 4) if job['total'] else 0.0,
+        'created_at': job['created_at'],
+        'finished_at': job['finished_at'],
+        'links': {
+            'self': url_for('api.job_status', job_id=job['id']),
+            'items': url_for('api.job_items', job_id=job['id']),
+            'results': url_for('api.job_results', job_id=job['id']),
+        },
+    }
+
+def _flag(form, name, default):
+    value = form.get(name)
+    return default if value is None else value.lower() in ('1', 'true', 'yes')
+
+@api.route('/jobs', methods=['POST'])
+def submit_job():
+    """
+    Creates a job from the uploaded 'images' and an 'operation' (purify,
+    template, edit, watermark) plus its options. With start=false the job
+    stays open for more files (POST /jobs/<id>/files) until POST /jobs/<id>/start.
+    """
+    operation = request.form.get('operation')
+    options, error = _job_options(operation, request.form)
+    if error:
+        return jsonify({'error': error}), 400
+
+    queue = JobRunner.get_queue()
+    job_id = queue.create(operation, options)
+    added = _add_job_files(queue, job_id, request.files.getlist('images'))
+    if added is None:
+        queue.delete(job_id)
+        return jsonify({'error': 'Too many files for one job'}), 413
+    count, rejected = added
+    if _flag(request.form, 'start', True):
+        if not count:
+            queue.delete(job_id)
+            return jsonify({'error': 'No valid images provided', 'rejected': rejected}), 400
+        queue.start(job_id)
+
+    payload = _job_payload(queue.job(job_id))
+    payload['rejected'] = rejected
+    return jsonify(payload), 202, {'Location': payload['links']['self']}
+
+@api.route('/jobs/<job_id>/files', methods=['POST'])
+def add_job_files(job_id):
+    queue = JobRunner.get_queue()
+    job = queue.job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    if job['status'] != 'open':
+        return jsonify({'error': 'Job is not accepting files'}), 409
+
+    added = _add_job_files(queue, job_id, request.files.getlist('images'))
+    if added is None:
+        return jsonify({'error': 'Too many files for one job'}), 413
+    if _flag(request.form, 'start', False):
+        queue.start(job_id)
+
+    payload = _job_payload(queue.job(job_id))
+    payload['rejected'] = added[1]
+    return jsonify(payload)
+
+@api.route('/jobs/<job_id>/start', methods=['POST'])
+def start_job(job_id):
+    queue = JobRunner.get_queue()
+    if queue.job(job_id) is None:
+        return jsonify({'error': 'Job not found'}), 404
+    if not queue.start(job_id):
+        return jsonify({'error': 'Job already started'}), 409
+    return jsonify(_job_payload(queue.job(job_id))), 202
+
+@api.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = JobRunner.get_queue().job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(_job_payload(job))
+
+@api.route('/jobs/<job_id>/items', methods=['GET'])
+def job_items(job_id):
+    queue = JobRunner.get_queue()
+    if queue.job(job_id) is None:
+        return jsonify({'error': 'Job not found'}), 404
+    offset = max(0, request.args.get('offset', 0, type=int))
+    limit = max(1, min(1000, request.args.get('limit', 100, type=int)))
+    items = queue.items(job_id, offset, limit, request.args.get('status'))
+    return jsonify({
+        'offset': offset,
+        'items': [
+            {
+                'seq': seq,
+                'filename': name,
+                'status': status,
+                'error': error,
+                'result': url_for('api.job_result', job_id=job_id, seq=seq) if status == 'done' else None,
+            }
+            for seq, name, status, error in items
+        ],
+    })
+
+@api.route('/jobs/<job_id>/results', methods=['GET'])
+def job_results(job_id):
+    """Streams a ZIP of every successfully processed file of a finished job."""
+    queue = JobRunner.get_queue()
+    job = queue.job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    if job['status'] in ('open', 'queued', 'running'):
+        return jsonify({'error': 'Job not finished', 'status': job['status']}), 409
+
+    def entries():
+        offset = 0
+        while True:
+            page = queue.items(job_id, offset, 500, status='done')
+            if not page:
+                return
+            for seq, name, _, _ in page:
+                yield queue.output_path(job_id, seq, name), f"{seq:06d}_{name}"
+            offset += len(page)
+
+    return Response(
+        ZipStreamer.stream(entries()),
+        mimetype='application/zip',
+        headers={'Content-Disposition': f'attachment; filename=picturify_job_{job_id}.zip'}
+    )
+
+@api.route('/jobs/<job_id>/results/<int:seq>', methods=['GET'])
+def job_result(job_id, seq):
+    queue = JobRunner.get_queue()
+    item = queue.item(job_id, seq)
+    if item is None or item[2] != 'done':
+        return jsonify({'error': 'Result not found'}), 404
+    name = item[1]
+    return send_file(queue.output_path(job_id, seq, name), as_attachment=True, download_name=name)
+
+@api.route('/jobs/<job_id>', methods=['DELETE'])
+def delete_job(job_id):
+    queue = JobRunner.get_queue()
+    if not queue.cancel(job_id):
+        return jsonify({'error': 'Job not found'}), 404
+    queue.delete(job_id)
+    return '', 204
@@ -0,0 +1,94 @@
+import sys
+import json
+import logging
+import argparse
+from app.services.directory_pipeline import DirectoryPipeline, OPERATIONS, SKIP_MODES
+from app.services.metadata_templates import MetadataTemplates
+from app.services.processing_options import ProcessingOptions
+
+
+WATERMARK_POSITIONS = ('center', 'bottom-right', 'bottom-left', 'top-right', 'top-left')
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog='picturify',
+        description='Process directories of images without the web app. '
+                    'Outputs mirror the input tree; re-running resumes where the last run stopped.'
+    )
+    parser.add_argument('operation', choices=OPERATIONS)
+    parser.add_argument('input', help='directory to process, recursively')
+    parser.add_argument('-o', '--output', required=True,
+                        help='output directory (also holds the run manifest and analysis.ndjson)')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='worker processes (default: CPU count, 0 = run in this process)')
+    parser.add_argument('--queue-size', type=int, default=None, help='bounded queue length (default: 4 per worker)')
+    parser.add_argument('--skip', choices=SKIP_MODES, default='mtime',
+                        help='how files already processed are recognised (default: mtime)')
+    parser.add_argument('--quality', type=int, default=None,
+                        help='re-encode quality (1-100); below 100 forces a lossy re-encode')
+    parser.add_argument('--subsampling', type=int, choices=(0, 1, 2), default=None,
+                        help='chroma subsampling of re-encoded JPEGs')
+    parser.add_argument('--template', help='template name (template operation)')
+    parser.add_argument('--templates-file', help='JSON file with extra templates')
+    parser.add_argument('--text', help='watermark text (watermark operation)')
+    parser.add_argument('--position', choices=WATERMARK_POSITIONS, default='center')
+    parser.add_argument('--opacity', type=float, default=0.5)
+    parser.add_argument('--progress-seconds', type=float, default=5, help='seconds between progress lines')
+    parser.add_argument('--json', action='store_true', help='print the final report as JSON')
+    parser.add_argument('-q', '--quiet', action='store_true', help='no progress lines')
+    return parser
+
+
+def format_report(report):
+    return (f"{report['processed']} processed, {report['skipped']} skipped, {report['failed']} failed "
+            f"in {report['seconds']:.1f}s ({report['files_per_second']:.1f} files/s, "
+            f"{report['megabytes_per_second']:.1f} MB/s)")
+
+
+def main(argv=None):
+    """Entry point of the picturify command. Returns the exit status."""
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING, format='%(levelname)s %(name)s: %(message)s')
+
+    defaults = ProcessingOptions()
+    options = ProcessingOptions(
+        image_quality=defaults.image_quality if args.quality is None else max(1, min(100, args.quality)),
+        image_subsampling=defaults.image_subsampling if args.subsampling is None else args.subsampling,
+    )
+    if args.templates_file:
+        try:
+            MetadataTemplates.load_file(args.templates_file)
+        except (OSError, ValueError) as e:
+            parser.error(f"cannot load templates: {e}")
+
+    def progress(report):
+        print(format_report(report), file=sys.stderr, flush=True)
+
+    try:
+        pipeline = DirectoryPipeline(
+            args.operation, args.input, args.output, workers=args.workers, queue_size=args.queue_size,
+            skip=args.skip, quality=args.quality, template=args.template, text=args.text,
+            position=args.position, opacity=args.opacity, processing_options=options,
+            progress=None if args.quiet else progress, progress_seconds=args.progress_seconds,
+        )
+    except ValueError as e:
+        parser.error(str(e))
+
+    try:
+        report = pipeline.run()
+    except KeyboardInterrupt:
+        # Finished files are in the manifest: the next run resumes from there
+        print(f"Interrupted: {format_report(pipeline.report())}", file=sys.stderr)
+        return 130
+
+    if args.json:
+        print(json.dumps(report))
+    else:
+        print(format_report(report))
+    return 1 if report['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,26 +1,23 @@
-from flask import render_template, request, redirect, url_for, flash, current_app, send_file, session
+from flask import render_template, request, redirect, url_for, flash, current_app, send_file, Response
 from app.main import main
 from app.services.image_handler import ImageHandler
 from app.services.exif_manager import ExifManager
 from app.services.metadata_templates import MetadataTemplates
 from app.services.watermark_manager import WatermarkManager
+from app.services.batch_processor import BatchProcessor
+from app.services.zip_streamer import ZipStreamer
+from app.services.variant_cache import VariantCache
+from app.services.preview_manager import PreviewManager, PREVIEW_SIZES
+from app.services.heif_editor import TRANSCODE_FORMATS
+from app.services.batch_manifest import BatchManifest
+from app.services.batch_exif_index import BatchExifIndex
+from app.services.gps_batch import GpsBatch, EXPORT_FORMATS
 import os
-import random
-
-def trigger_bg_cleanup():
-    # Reduce default probability to prevent frequent blocking
-    prob = current_app.config.get('CLEANUP_PROBABILITY', 0.1)
-    max_age = current_app.config.get('MAX_FILE_AGE_SECONDS', 3600)
-    
-    if random.random() < prob:
-        ImageHandler.cleanup_old_files(max_age)
+import time
 
 @main.route('/', methods=['GET', 'POST'])
 def index():
     if request.method == 'POST':
-        # Cleanup check
-        trigger_bg_cleanup()
-
         if 'image' not in request.files:
             flash('No file part')
             return redirect(request.url)
@@ -42,26 +39,23 @@ def index():
             if file and file.filename != '':
                 filename = ImageHandler.save_image(file)
                 if filename:
-                    saved_filenames.append(filename)
+                    saved_filenames.append((filename, file.filename))
         
         if not saved_filenames:
             flash('No valid files saved.')
             return redirect(request.url)
 
-        if len(saved_filenames) == 1 and not session.get('batch_files'):
-            return redirect(url_for('main.result', filename=saved_filenames[0]))
+        if len(saved_filenames) == 1 and not BatchManifest.count(BatchManifest.current()):
+            return redirect(url_for('main.result', filename=saved_filenames[0][0]))
         else:
-            current_batch = session.get('batch_files', [])
-            
-            # Check if appending would exceed the limit
-            if len(current_batch) + len(saved_filenames) > max_batch:
+            # The limit is checked in the same transaction that appends the files
+            if not BatchManifest.add(BatchManifest.current(create=True), saved_filenames):
                 # Delete newly uploaded files since we can't add them
-                for f in saved_filenames:
+                for f, _ in saved_filenames:
                     ImageHandler.delete_file(f)
                 flash(f'Cannot add files. Total batch size would exceed {max_batch}.')
                 return redirect(url_for('main.batch_result'))
-                
-            session['batch_files'] = current_batch + saved_filenames
+
             return redirect(url_for('main.batch_result'))
 
     return render_template('index.html')
@@ -77,7 +71,8 @@ def result(filename):
         flash('File not found')
         return redirect(url_for('main.index'))
     
-    exif_data = ExifManager.get_exif_data(file_path)
+    ImageHandler.touch_file(filename)
+    exif_data = ExifManager.get_exif_data(file_path, ImageHandler.get_content_hash(filename))
     
     # Calculate Lat/Lon for Map
     lat, lon = ExifManager.get_lat_lon(exif_data)
@@ -95,6 +90,8 @@ def download(filename):
     if not os.path.exists(file_path):
         return "File not found", 404
     
+    ImageHandler.touch_file(filename)
+
     # Check for quality param
     try:
         quality = int(request.args.get('quality', 100))
@@ -102,33 +99,13 @@ def download(filename):
         quality = 100
         
     if quality < 100:
-        # Compress on the fly
+        # Compress once, then serve the cached variant from disk.
+        # If they just want to download compressed, keep EXIF but compress.
         try:
-            from PIL import Image
-            import io
-            
-            # Use ExifManager logic to compress but keep EXIF? 
-            # If user selected compression in "Purify", they removed EXIF.
-            # If they just want to download compressed, let's keep EXIF but compress.
-            
-            img_io = io.BytesIO()
-            with Image.open(file_path) as img:
-                # Basic save to IO with quality
-                # Preserve format
-                fmt = img.format if img.format else 'JPEG'
-                if fmt == 'JPEG':
-                     # Keep EXIF if present
-                     exif = img.info.get('exif')
-                     if exif:
-                         img.save(img_io, fmt, quality=quality, exif=exif)
-                     else:
-                         img.save(img_io, fmt, quality=quality)
-                else:
-                    # PNG/WEBP etc
-                    img.save(img_io, fmt, quality=quality)
-            
-            img_io.seek(0)
-            return send_file(img_io, as_attachment=True, download_name=filename, mimetype=f'image/{fmt.lower()}')
+            variant_path, fmt = VariantCache.get_or_render(
+                file_path, quality, ImageHandler.get_content_hash(filename)
+            )
+            return send_file(variant_path, as_attachment=True, download_name=filename, mimetype=f'image/{fmt.lower()}')
             
         except Exception as e:
             current_app.logger.error(f"Error compressing for download: {e}")
@@ -137,9 +114,39 @@ def download(filename):
             
     return send_file(file_path, as_attachment=True)
 
+@main.app_template_global()
+def preview_url(filename, size='small'):
+    """URL of a cached preview, versioned by content so it can be cached for good."""
+    try:
+        version = VariantCache.source_key(ImageHandler.get_path(filename), ImageHandler.get_content_hash(filename))
+    except OSError:
+        version = None
+    return url_for('main.preview', filename=filename, size=size, v=version[:16] if version else None)
+
+@main.route('/preview/<filename>')
+def preview(filename):
+    file_path = ImageHandler.get_path(filename)
+    size = request.args.get('size', 'small')
+    if size not in PREVIEW_SIZES or not os.path.exists(file_path):
+        return "File not found", 404
+
+    try:
+        preview_path, fmt = PreviewManager.get_or_render(file_path, size, ImageHandler.get_content_hash(filename))
+    except Exception as e:
+        current_app.logger.error(f"Error rendering preview: {e}")
+        return send_file(file_path)
+
+    # URLs carry a content version, so the browser may keep previews indefinitely
+    response = send_file(
+        preview_path, mimetype=f'image/{fmt.lower()}',
+        max_age=current_app.config.get('PREVIEW_MAX_AGE', 31536000)
+    )
+    response.cache_control.private = True
+    response.cache_control.immutable = True
+    return response
+
 @main.route('/delete_selected/<filename>', methods=['POST'])
 def delete_selected(filename):
-    trigger_bg_cleanup()
     file_path = ImageHandler.get_path(filename)
     if not file_path or not os.path.exists(file_path):
         flash("File not found.")
@@ -150,9 +157,7 @@ def delete_selected(filename):
     if selected_tags:
         modified_path = ExifManager.delete_tags(file_path, selected_tags)
         if modified_path:
-             modified_filename = os.path.basename(modified_path)
-             if modified_filename != filename:
-                 ImageHandler.delete_file(filename)
+             modified_filename = ImageHandler.replace_file(filename, modified_path)
              flash(f"Deleted {len(selected_tags)} tags successfully.")
              return redirect(url_for('main.result', filename=modified_filename))
         else:
@@ -164,7 +169,6 @@ def delete_selected(filename):
 
 @main.route('/purify/<filename>', methods=['POST'])
 def purify(filename):
-    trigger_bg_cleanup()
     file_path = ImageHandler.get_path(filename)
     if not os.path.exists(file_path):
         flash('File not found')
@@ -177,9 +181,7 @@ def purify(filename):
 
     purified_path = ExifManager.remove_exif(file_path, quality=quality)
     if purified_path:
-        purified_filename = os.path.basename(purified_path)
-        if purified_filename != filename:
-            ImageHandler.delete_file(filename)
+        purified_filename = ImageHandler.replace_file(filename, purified_path)
 
         # Redirect to result with download trigger
         return redirect(url_for('main.result', filename=purified_filename, download='true'))
@@ -189,7 +191,6 @@ def purify(filename):
 
 @main.route('/apply_template/<filename>', methods=['POST'])
 def apply_template(filename):
-    trigger_bg_cleanup()
     file_path = ImageHandler.get_path(filename)
     if not os.path.exists(file_path):
         flash('File not found')
@@ -200,7 +201,7 @@ def apply_template(filename):
         flash('No template selected')
         return redirect(url_for('main.result', filename=filename))
         
-    kept_tags = MetadataTemplates.get_template(template_name)
+    kept_tags = MetadataTemplates.get_compiled(template_name)
     if not kept_tags:
         flash('Invalid template')
         return redirect(url_for('main.result', filename=filename))
@@ -213,9 +214,7 @@ def apply_template(filename):
     optimized_path = ExifManager.keep_only_tags(file_path, kept_tags, quality=quality)
     
     if optimized_path:
-        optimized_filename = os.path.basename(optimized_path)
-        if optimized_filename != filename:
-            ImageHandler.delete_file(filename)
+        optimized_filename = ImageHandler.replace_file(filename, optimized_path)
             
         flash(f'Metadata optimized for {template_name.capitalize()}!')
         return redirect(url_for('main.result', filename=optimized_filename))
@@ -231,7 +230,6 @@ def finish(filename):
 
 @main.route('/edit/<filename>', methods=['POST'])
 def edit(filename):
-    trigger_bg_cleanup()
     file_path = ImageHandler.get_path(filename)
     if not os.path.exists(file_path):
         flash('File not found')
@@ -255,9 +253,7 @@ def edit(filename):
     modified_path = ExifManager.modify_exif(file_path, changes)
     
     if modified_path:
-        modified_filename = os.path.basename(modified_path)
-        if modified_filename != filename:
-            ImageHandler.delete_file(filename)
+        modified_filename = ImageHandler.replace_file(filename, modified_path)
             
         flash('Metadata updated successfully!')
         return redirect(url_for('main.result', filename=modified_filename))
@@ -267,9 +263,15 @@ def edit(filename):
 
 from app.services.watermark_manager import WatermarkManager
 
+def _watermark_opacity(form):
+    """Returns the form's watermark opacity clamped to [0, 1], or None if it is not a number."""
+    try:
+        return max(0.0, min(1.0, float(form.get('watermark_opacity', 0.5))))
+    except ValueError:
+        return None
+
 @main.route('/watermark/<filename>', methods=['POST'])
 def watermark(filename):
-    trigger_bg_cleanup()
     file_path = ImageHandler.get_path(filename)
     if not os.path.exists(file_path):
         flash('File not found')
@@ -277,18 +279,19 @@ def watermark(filename):
     
     text = request.form.get('watermark_text')
     position = request.form.get('watermark_position', 'center')
-    opacity = float(request.form.get('watermark_opacity', 0.5))
+    opacity = _watermark_opacity(request.form)
     
     if not text:
         flash('Watermark text is required')
         return redirect(url_for('main.result', filename=filename))
+    if opacity is None:
+        flash('Invalid opacity')
+        return redirect(url_for('main.result', filename=filename))
         
     watermarked_path = WatermarkManager.apply_watermark(file_path, text, position, opacity)
     
     if watermarked_path:
-        watermarked_filename = os.path.basename(watermarked_path)
-        if watermarked_filename != filename:
-            ImageHandler.delete_file(filename)
+        watermarked_filename = ImageHandler.replace_file(filename, watermarked_path)
             
         flash('Watermark applied successfully!')
         return redirect(url_for('main.result', filename=watermarked_filename))
@@ -296,112 +299,255 @@ def watermark(filename):
     flash('Error applying watermark')
     return redirect(url_for('main.result', filename=filename))
 
+def _transcode_options(form):
+    """Target format and quality of a conversion, defaulting to the configured ones."""
+    fmt = (form.get('format') or current_app.config.get('TRANSCODE_FORMAT', 'JPEG')).upper()
+    try:
+        quality = max(1, min(100, int(form.get('quality', current_app.config.get('TRANSCODE_QUALITY', 90)))))
+    except ValueError:
+        quality = current_app.config.get('TRANSCODE_QUALITY', 90)
+    return {'format': fmt, 'quality': quality}
+
+@main.route('/transcode/<filename>', methods=['POST'])
+def transcode(filename):
+    file_path = ImageHandler.get_path(filename)
+    if not os.path.exists(file_path):
+        flash('File not found')
+        return redirect(url_for('main.index'))
+
+    options = _transcode_options(request.form)
+    if options['format'] not in TRANSCODE_FORMATS:
+        flash('Unsupported format')
+        return redirect(url_for('main.result', filename=filename))
+
+    # Decoded and encoded on the batch pool, not in this thread
+    result = BatchProcessor.run('transcode', [filename], [file_path], options)[0]
+    if result['result']:
+        converted_filename = ImageHandler.replace_file(filename, result['result'])
+        flash(f"Converted to {options['format']}.")
+        return redirect(url_for('main.result', filename=converted_filename))
+
+    flash(f"Error converting file: {result['error']}")
+    return redirect(url_for('main.result', filename=filename))
+
 # --- Batch Routes ---
 
+# Query/form fields of the batch filters
+BATCH_FILTER_FIELDS = ('gps', 'make', 'model', 'from', 'to')
+
+def _filter_args(values):
+    return {key: values[key] for key in BATCH_FILTER_FIELDS if values.get(key)}
+
+def _batch_filters(filter_args):
+    """Converts batch filter fields to BatchExifIndex.select arguments."""
+    filters = {}
+    if filter_args.get('gps') in ('1', '0'):
+        filters['has_gps'] = filter_args['gps'] == '1'
+    tags = {tag: filter_args[key] for key, tag in (('make', 'Make'), ('model', 'Model')) if key in filter_args}
+    if tags:
+        filters['tags'] = tags
+    for key, arg, end_of_day in (('from', 'date_from', False), ('to', 'date_to', True)):
+        try:
+            day = time.mktime(time.strptime(filter_args.get(key, ''), '%Y-%m-%d'))
+        except ValueError:
+            continue
+        filters[arg] = day + 86399 if end_of_day else day
+    return filters
+
+# Ways the batch "coarsen location" action can blur positions
+COARSEN_MODES = ('grid', 'jitter', 'remove')
+
+def _coarsened_gps(names, paths, mode, grid, meters):
+    """
+    Returns the new GPS IFD of each file, computed for the whole batch in
+    one pass. Only the coarsened position is kept: altitude, time and
+    direction tags are dropped with the exact position.
+    """
+    if mode == 'remove':
+        return [{}] * len(names)
+    positions = GpsBatch.read(names, paths)
+    if mode == 'grid':
+        positions.snap(grid)
+    else:
+        positions.jitter(meters)
+    return positions.gps_ifds()
+
 @main.route('/batch_result')
 def batch_result():
-    filenames = session.get('batch_files', [])
-    if not filenames:
+    batch_id = BatchManifest.current()
+    if not batch_id:
         flash('No active batch.')
         return redirect(url_for('main.index'))
-    
-    valid_files = [f for f in filenames if os.path.exists(ImageHandler.get_path(f))]
-    
-    if len(valid_files) != len(filenames):
-         session['batch_files'] = valid_files
-         filenames = valid_files
 
-    if not filenames:
+    # Filters and counts come from the batch's columnar EXIF index, not the files
+    exif_index = BatchExifIndex.for_batch(batch_id)
+    filter_args = _filter_args(request.args)
+    filters = _batch_filters(filter_args)
+    matching = exif_index.select(**filters) if filters else None
+
+    # One page of the manifest; deleted or expired files are left out by the index
+    page = request.args.get('page', 1, type=int)
+    entries, pages = BatchManifest.page(batch_id, page, current_app.config.get('BATCH_PAGE_SIZE', 48), matching)
+
+    if not entries and matching is None:
+         BatchManifest.clear(batch_id)
          flash('All files in batch have been deleted.')
          return redirect(url_for('main.index'))
 
-    return render_template('batch_results.html', filenames=filenames, template_list=MetadataTemplates.list_templates())
+    return render_template('batch_results.html', entries=entries, page=min(max(1, page), pages), pages=pages,
+                           total=len(exif_index.names), template_list=MetadataTemplates.list_templates(),
+                           has_heif=BatchManifest.has_format(batch_id, 'HEIF'),
+                           summary=exif_index.summary(), matching=matching, filter_args=filter_args,
+                           makes=exif_index.values('Make'), models=exif_index.values('Model'))
 
 @main.route('/batch_action', methods=['POST'])
 def batch_action():
-    filenames = session.get('batch_files', [])
+    batch_id = BatchManifest.current()
+    entries = BatchManifest.files(batch_id) if batch_id else []
     action = request.form.get('action')
     
-    if not filenames:
+    if not entries:
         flash('No batch to process.')
         return redirect(url_for('main.index'))
 
-    processed_count = 0
-    
     if action == 'purify':
-        new_filenames = []
-        for fname in filenames:
-            file_path = ImageHandler.get_path(fname)
-            if not os.path.exists(file_path): continue
-            
-            purified_path = ExifManager.remove_exif(file_path)
-            if purified_path:
-                new_fname = os.path.basename(purified_path)
-                if new_fname != fname:
-                    ImageHandler.delete_file(fname)
-                new_filenames.append(new_fname)
-                processed_count += 1
-            else:
-                new_filenames.append(fname)
-        session['batch_files'] = new_filenames
-        flash(f'Purified {processed_count} images.')
-
-    elif action.startswith('template_'):
+        label = 'Purified {count} images.'
+        batch_action_name, options = 'purify', {}
+    elif action and action.startswith('template_'):
         template_name = action.replace('template_', '')
-        kept_tags = MetadataTemplates.get_template(template_name)
-        
-        if kept_tags:
-            new_filenames = []
-            for fname in filenames:
-                file_path = ImageHandler.get_path(fname)
-                if not os.path.exists(file_path): continue
-                
-                optimized_path = ExifManager.keep_only_tags(file_path, kept_tags)
-                if optimized_path:
-                    new_fname = os.path.basename(optimized_path)
-                    if new_fname != fname:
-                         ImageHandler.delete_file(fname)
-                    new_filenames.append(new_fname)
-                    processed_count += 1
-                else:
-                    new_filenames.append(fname)
-            session['batch_files'] = new_filenames
-            flash(f'Optimized {processed_count} images for {template_name}.')
+        kept_tags = MetadataTemplates.get_compiled(template_name)
+        if not kept_tags:
+            flash('Invalid template')
+            return redirect(url_for('main.batch_result'))
+        label = f'Optimized {{count}} images for {template_name}.'
+        batch_action_name, options = 'template', {'kept_tags': kept_tags}
+    elif action == 'transcode':
+        options = _transcode_options(request.form)
+        if options['format'] not in TRANSCODE_FORMATS:
+            flash('Unsupported format')
+            return redirect(url_for('main.batch_result'))
+        label = f"Converted {{count}} images to {options['format']}."
+        batch_action_name = 'transcode'
+    elif action == 'watermark':
+        text = request.form.get('watermark_text')
+        if not text:
+            flash('Watermark text is required')
+            return redirect(url_for('main.batch_result'))
+        opacity = _watermark_opacity(request.form)
+        if opacity is None:
+            flash('Invalid opacity')
+            return redirect(url_for('main.batch_result'))
+        label = 'Watermarked {count} images.'
+        # Workers reuse one rendered overlay for every file of the same dimensions
+        batch_action_name, options = 'watermark', {
+            'text': text,
+            'position': request.form.get('watermark_position', 'center'),
+            'opacity': opacity,
+        }
+    elif action == 'coarsen':
+        mode = request.form.get('coarsen_mode', 'grid')
+        try:
+            grid = float(request.form.get('grid') or current_app.config.get('GPS_COARSEN_GRID', 0.01))
+            meters = float(request.form.get('jitter_meters') or current_app.config.get('GPS_JITTER_METERS', 500))
+        except ValueError:
+            grid = meters = -1
+        if mode not in COARSEN_MODES or grid <= 0 or meters < 0:
+            flash('Invalid location settings')
+            return redirect(url_for('main.batch_result'))
+        label = 'Removed the location of {count} images.' if mode == 'remove' else 'Coarsened the location of {count} images.'
+        # GPS IFDs are rewritten in the EXIF block, pixels are not touched
+        batch_action_name, options = 'gps', {}
+    else:
+        flash('Unknown batch action.')
+        return redirect(url_for('main.batch_result'))
+
+    # With filters set, only the matching files are processed
+    filter_args = _filter_args(request.form)
+    filters = _batch_filters(filter_args)
+    if filters:
+        selected = set(BatchExifIndex.for_batch(batch_id).select(**filters))
+        entries_to_process = [e for e in entries if e['name'] in selected]
+    else:
+        entries_to_process = entries
+
+    # Only HEIC/HEIF files are converted and only located files coarsened,
+    # the rest stay in the batch as they are
+    if batch_action_name == 'transcode':
+        entries_to_process = [e for e in entries_to_process if e['format'] == 'HEIF']
+    elif batch_action_name == 'gps':
+        entries_to_process = [e for e in entries_to_process if e['has_gps']]
+    targets = [e['name'] for e in entries_to_process]
+    paths = [ImageHandler.get_path(f) for f in targets]
+    file_options = None
+    if batch_action_name == 'gps':
+        file_options = [{'gps': ifd} for ifd in _coarsened_gps(targets, paths, mode, grid, meters)]
+    results = BatchProcessor.run(batch_action_name, targets, paths, options, file_options=file_options)
+
+    # All results are recorded in the manifest in one transaction
+    processed_count = 0
+    renamed = {}
+    for res in results:
+        fname = res['filename']
+        if res['result']:
+            renamed[fname] = ImageHandler.replace_file(fname, res['result'])
+            processed_count += 1
+        else:
+            flash(f"{fname}: {res['error']}")
+
+    BatchManifest.record(batch_id, action, renamed, entries)
+    flash(label.format(count=processed_count))
     
-    return redirect(url_for('main.batch_result'))
+    return redirect(url_for('main.batch_result', **filter_args))
 
 @main.route('/download_batch', methods=['POST'])
 def download_batch():
-    filenames = session.get('batch_files', [])
+    batch_id = BatchManifest.current()
+    filenames = BatchManifest.names(batch_id) if batch_id else []
     if not filenames:
         flash('No files to download.')
         return redirect(url_for('main.index'))
 
-    import zipfile
-    import io
+    # Resolve paths now: the response body is generated after the request context ends
+    entries = []
+    for fname in filenames:
+        file_path = ImageHandler.get_path(fname)
+        if os.path.exists(file_path):
+            entries.append((file_path, fname))
 
-    # Create in-memory zip
-    memory_file = io.BytesIO()
-    with zipfile.ZipFile(memory_file, 'w', zipfile.ZIP_DEFLATED) as zf:
-        for fname in filenames:
-            file_path = ImageHandler.get_path(fname)
-            if os.path.exists(file_path):
-                zf.write(file_path, arcname=fname)
-    
-    memory_file.seek(0)
-    return send_file(
-        memory_file,
+    return Response(
+        ZipStreamer.stream(entries),
         mimetype='application/zip',
-        as_attachment=True,
-        download_name='picturify_batch.zip'
+        headers={'Content-Disposition': 'attachment; filename=picturify_batch.zip'}
+    )
+
+@main.route('/batch_gps.<fmt>')
+def batch_gps(fmt):
+    """Exports the positions of the batch's (matching) files as GeoJSON or CSV."""
+    batch_id = BatchManifest.current()
+    if fmt not in EXPORT_FORMATS or not batch_id:
+        flash('No positions to export.')
+        return redirect(url_for('main.index'))
+
+    filters = _batch_filters(_filter_args(request.args))
+    if filters:
+        names = BatchExifIndex.for_batch(batch_id).select(**filters)
+    else:
+        names = BatchManifest.names(batch_id)
+    positions = GpsBatch.read(names, [ImageHandler.get_path(f) for f in names])
+
+    if fmt == 'csv':
+        body, mimetype = positions.to_csv(), 'text/csv'
+    else:
+        body, mimetype = positions.to_geojson(), 'application/geo+json'
+    return Response(
+        body,
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename=picturify_batch.{fmt}'}
     )
 
 @main.route('/delete_batch_file/<filename>', methods=['POST'])
 def delete_batch_file(filename):
-    current_batch = session.get('batch_files', [])
-    if filename in current_batch:
-        current_batch.remove(filename)
-        session['batch_files'] = current_batch
+    if BatchManifest.remove(BatchManifest.current(), filename):
         ImageHandler.delete_file(filename)
         flash(f'Removed {filename}')
     else:
@@ -411,11 +557,9 @@ def delete_batch_file(filename):
 
 @main.route('/clear_batch', methods=['POST'])
 def clear_batch():
-    """Removes all files in the current batch from disk and session."""
-    current_batch = session.get('batch_files', [])
-    for fname in current_batch:
+    """Removes all files in the current batch from disk and the manifest."""
+    for fname in BatchManifest.clear(BatchManifest.current()):
         ImageHandler.delete_file(fname)
     
-    session.pop('batch_files', None)
     flash('Batch cleared and files deleted.')
     return redirect(url_for('main.index'))
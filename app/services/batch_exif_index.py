@@ -0,0 +1,278 @@
+import json
+import math
+import time
+import base64
+import hashlib
+import logging
+import threading
+from array import array
+from collections import Counter, OrderedDict
+from app.services.image_handler import ImageHandler
+from app.services.exif_manager import ExifManager
+
+
+logger = logging.getLogger(__name__)
+
+EXIF_DATE_FORMAT = '%Y:%m:%d %H:%M:%S'
+
+# Longer values (maker notes, thumbnails, ...) are not indexed
+MAX_VALUE_LENGTH = 256
+
+# Per-file flags, stored as one byte per file
+FLAG_COLUMNS = ('has_exif', 'has_gps')
+
+# Derived numbers, stored as doubles (NaN = missing)
+NUMBER_COLUMNS = ('DateTimeOriginal', 'GPSLatitude', 'GPSLongitude')
+
+# Tags identifying the device or its owner
+SERIAL_TAGS = ('BodySerialNumber', 'LensSerialNumber', 'CameraOwnerName')
+
+# Decoded indexes of recently used batches, per process
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+CACHE_SIZE = 8
+
+
+class BatchExifIndex:
+    """
+    Columnar EXIF index of one batch, built in a single pass over its files.
+    Rows are the batch's files in upload order. Each tag is a dictionary
+    encoded column (distinct values plus an array of codes, -1 = missing),
+    flags are byte arrays and dates and coordinates double arrays, so
+    filters and counts scan flat arrays instead of per-file dicts.
+    The index is saved in the FileIndex database and rebuilt when the
+    batch's files change, re-reading only the files it has not seen at
+    their current manifest version (a file rewritten under the same name
+    gets a new version).
+    """
+
+    def __init__(self, names, flags, numbers, columns, versions=None):
+        self.names = names
+        self.versions = versions if versions is not None else array('i', [0]) * len(names)
+        self.flags = flags
+        self.numbers = numbers
+        self.columns = columns
+
+    # --- Building ---
+
+    @staticmethod
+    def _record(exif):
+        """Converts get_exif_data output to (flags, numbers, {tag: text})."""
+        gps = exif.get('GPSInfo') or {}
+        lat, lon = ExifManager.get_lat_lon(exif) if gps else (None, None)
+        taken = math.nan
+        try:
+            taken = time.mktime(time.strptime(str(exif.get('DateTimeOriginal', '')).strip('\x00 '), EXIF_DATE_FORMAT))
+        except (ValueError, OverflowError):
+            pass
+        flags = {'has_exif': int(bool(exif)), 'has_gps': int(bool(gps))}
+        numbers = {
+            'DateTimeOriginal': taken,
+            'GPSLatitude': math.nan if lat is None else lat,
+            'GPSLongitude': math.nan if lon is None else lon,
+        }
+        tags = {}
+        for tag, value in exif.items():
+            if tag == 'GPSInfo' or not isinstance(tag, str):
+                continue
+            text = str(value).strip('\x00 ')
+            if text and len(text) <= MAX_VALUE_LENGTH:
+                tags[tag] = text
+        return flags, numbers, tags
+
+    def _row(self, i):
+        return (
+            {name: column[i] for name, column in self.flags.items()},
+            {name: column[i] for name, column in self.numbers.items()},
+            {tag: values[codes[i]] for tag, (values, codes) in self.columns.items() if codes[i] >= 0},
+        )
+
+    @staticmethod
+    def build(names, read_exif, previous=None, versions=None, fresh=()):
+        """
+        Builds the index of names in one pass. read_exif(name) returns the
+        get_exif_data dict of a file. Rows of previous are reused for files
+        at the same version (all 0 if versions is not given), except the
+        names in fresh, which are always read.
+        """
+        count = len(names)
+        versions = array('i', versions) if versions is not None else array('i', [0]) * count
+        known = {}
+        if previous:
+            known = {(name, version): i for i, (name, version) in enumerate(zip(previous.names, previous.versions))}
+        fresh = set(fresh)
+        flags = {name: array('b', bytes(count)) for name in FLAG_COLUMNS}
+        numbers = {name: array('d', [math.nan]) * count for name in NUMBER_COLUMNS}
+        columns = {}
+
+        for i, name in enumerate(names):
+            row = known.get((name, versions[i])) if name not in fresh else None
+            if row is not None:
+                record = previous._row(row)
+            else:
+                try:
+                    record = BatchExifIndex._record(read_exif(name))
+                except Exception as e:
+                    logger.error(f"Error indexing EXIF of {name}: {e}")
+                    record = BatchExifIndex._record({})
+            row_flags, row_numbers, tags = record
+            for column, value in row_flags.items():
+                flags[column][i] = value
+            for column, value in row_numbers.items():
+                numbers[column][i] = value
+            for tag, text in tags.items():
+                values, codes, lookup = columns.setdefault(tag, ([], array('i', [-1]) * count, {}))
+                code = lookup.get(text)
+                if code is None:
+                    code = lookup[text] = len(values)
+                    values.append(text)
+                codes[i] = code
+
+        return BatchExifIndex(
+            list(names), flags, numbers,
+            {tag: (values, codes) for tag, (values, codes, _) in columns.items()},
+            versions
+        )
+
+    # --- Queries ---
+
+    def select(self, has_gps=None, tags=None, date_from=None, date_to=None):
+        """
+        Returns the names of the files matching every given filter:
+        GPS presence, exact tag values ({tag: value}) and a
+        DateTimeOriginal range (epoch seconds, inclusive).
+        """
+        mask = bytearray(b'\x01') * len(self.names)
+        if has_gps is not None:
+            wanted = int(bool(has_gps))
+            mask = bytearray(m and f == wanted for m, f in zip(mask, self.flags['has_gps']))
+        for tag, value in (tags or {}).items():
+            values, codes = self.columns.get(tag, ([], None))
+            try:
+                code = values.index(value)
+            except ValueError:
+                return []
+            mask = bytearray(m and c == code for m, c in zip(mask, codes))
+        if date_from is not None or date_to is not None:
+            low = -math.inf if date_from is None else date_from
+            high = math.inf if date_to is None else date_to
+            # NaN (no date) fails both comparisons
+            mask = bytearray(m and low <= t <= high for m, t in zip(mask, self.numbers['DateTimeOriginal']))
+        return [name for name, m in zip(self.names, mask) if m]
+
+    def _rows(self, names):
+        if names is None:
+            return range(len(self.names))
+        positions = {name: i for i, name in enumerate(self.names)}
+        return [positions[name] for name in names if name in positions]
+
+    def counts(self, tag, names=None, limit=10):
+        """Returns the most common [(value, count)] of a tag among names (default: all files)."""
+        if tag not in self.columns:
+            return []
+        values, codes = self.columns[tag]
+        counter = Counter(codes[i] for i in self._rows(names))
+        counter.pop(-1, None)
+        return [(values[code], count) for code, count in counter.most_common(limit)]
+
+    def values(self, tag):
+        """Returns the distinct values of a tag, sorted."""
+        return sorted(self.columns[tag][0]) if tag in self.columns else []
+
+    def summary(self, names=None):
+        """Aggregate counts over names (default: all files)."""
+        rows = self._rows(names)
+        dates = [self.numbers['DateTimeOriginal'][i] for i in rows]
+        dates = [t for t in dates if not math.isnan(t)]
+        serial_rows = set()
+        for tag in SERIAL_TAGS:
+            if tag in self.columns:
+                codes = self.columns[tag][1]
+                serial_rows.update(i for i in rows if codes[i] >= 0)
+        return {
+            'files': len(rows),
+            'with_exif': sum(self.flags['has_exif'][i] for i in rows),
+            'with_gps': sum(self.flags['has_gps'][i] for i in rows),
+            'with_serials': len(serial_rows),
+            'first_taken': time.strftime('%Y-%m-%d', time.localtime(min(dates))) if dates else None,
+            'last_taken': time.strftime('%Y-%m-%d', time.localtime(max(dates))) if dates else None,
+            'makes': self.counts('Make', names),
+        }
+
+    # --- Storage ---
+
+    def dumps(self):
+        def encode(arr):
+            return base64.b64encode(arr.tobytes()).decode('ascii')
+
+        return json.dumps({
+            'names': self.names,
+            'versions': encode(self.versions),
+            'flags': {name: encode(column) for name, column in self.flags.items()},
+            'numbers': {name: encode(column) for name, column in self.numbers.items()},
+            'columns': {tag: [values, encode(codes)] for tag, (values, codes) in self.columns.items()},
+        })
+
+    @staticmethod
+    def loads(data):
+        def decode(typecode, text):
+            arr = array(typecode)
+            arr.frombytes(base64.b64decode(text))
+            return arr
+
+        data = json.loads(data)
+        return BatchExifIndex(
+            data['names'],
+            {name: decode('b', text) for name, text in data['flags'].items()},
+            {name: decode('d', text) for name, text in data['numbers'].items()},
+            {tag: (values, decode('i', text)) for tag, (values, text) in data['columns'].items()},
+            decode('i', data['versions']) if 'versions' in data else None,
+        )
+
+    @staticmethod
+    def for_batch(batch_id, known_exif=None):
+        """
+        Returns the index of a batch's live files, rebuilding it if they
+        changed since it was saved. known_exif ({name: get_exif_data dict})
+        holds files the caller has just parsed: they replace any indexed row
+        and spare reading the files again.
+        """
+        known_exif = known_exif or {}
+        index = ImageHandler.get_index()
+        files = index.batch_versions(batch_id)
+        names = [name for name, _ in files]
+        versions = [version for _, version in files]
+        signature = hashlib.sha256('\0'.join(f'{name}\1{version}' for name, version in files).encode()).hexdigest()
+        key = (index.db_path, batch_id)
+
+        with _cache_lock:
+            cached = _cache.get(key)
+            if cached is not None and cached[0] == signature and not known_exif:
+                _cache.move_to_end(key)
+                return cached[1]
+
+        saved = index.batch_exif(batch_id)
+        previous = cached[1] if cached is not None else None
+        if saved is not None:
+            previous = BatchExifIndex.loads(saved[1])
+            if saved[0] != signature or known_exif:
+                saved = None
+        if saved is not None:
+            built = previous
+        else:
+            def read_exif(name):
+                return known_exif[name] if name in known_exif else BatchExifIndex._read_exif(name)
+
+            built = BatchExifIndex.build(names, read_exif, previous, versions, fresh=known_exif)
+            index.save_batch_exif(batch_id, signature, built.dumps())
+
+        with _cache_lock:
+            _cache[key] = (signature, built)
+            _cache.move_to_end(key)
+            while len(_cache) > CACHE_SIZE:
+                _cache.popitem(last=False)
+        return built
+
+    @staticmethod
+    def _read_exif(name):
+        return ExifManager.get_exif_data(ImageHandler.get_path(name), ImageHandler.get_content_hash(name))
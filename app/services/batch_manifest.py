@@ -0,0 +1,136 @@
+import json
+import os
+import uuid
+import logging
+from flask import current_app, session
+from app.services.image_handler import ImageHandler
+from app.services.exif_manager import ExifManager
+from app.services.ingest import sniff_format
+from app.services.batch_exif_index import BatchExifIndex
+
+
+logger = logging.getLogger(__name__)
+
+
+class BatchManifest:
+    """
+    The current browser session's batch, kept in the FileIndex database.
+    The session cookie only holds the batch ID; each file's size, format,
+    EXIF and GPS presence and lineage (upload name plus the actions applied
+    since) are stored server-side, so pages read one slice of the batch
+    without touching the files. Each file is parsed once, when it enters
+    the batch, for both the manifest and the BatchExifIndex.
+    """
+
+    @staticmethod
+    def current(create=False):
+        """Returns the ID of the session's batch, creating one if asked, else None."""
+        batch_id = session.get('batch_id')
+        if batch_id is None and create:
+            batch_id = uuid.uuid4().hex
+            ImageHandler.get_index().touch_batch(batch_id, ImageHandler.get_session_id())
+            session['batch_id'] = batch_id
+        return batch_id
+
+    @staticmethod
+    def read_exif(filename):
+        return ExifManager.get_exif_data(ImageHandler.get_path(filename), ImageHandler.get_content_hash(filename))
+
+    @staticmethod
+    def describe(filename, exif, origin=None, lineage=()):
+        """Returns the manifest entry of a stored file from its headers and parsed EXIF."""
+        path = ImageHandler.get_path(filename)
+        with open(path, 'rb') as f:
+            fmt = sniff_format(f.read(32))
+        return {
+            'name': filename,
+            'origin': origin or filename,
+            'lineage': json.dumps(list(lineage)),
+            'size': os.path.getsize(path),
+            'format': fmt,
+            'has_exif': int(bool(exif)),
+            'has_gps': int(bool(exif.get('GPSInfo'))),
+        }
+
+    @staticmethod
+    def count(batch_id):
+        return ImageHandler.get_index().batch_count(batch_id) if batch_id else 0
+
+    @staticmethod
+    def add(batch_id, uploads):
+        """
+        Adds [(stored filename, upload name)] to a batch. Returns False,
+        adding nothing, if the batch would exceed MAX_BATCH_SIZE.
+        """
+        exif = {name: BatchManifest.read_exif(name) for name, _ in uploads}
+        entries = [BatchManifest.describe(name, exif[name], origin) for name, origin in uploads]
+        if not ImageHandler.get_index().add_batch_files(
+            batch_id, entries, current_app.config.get('MAX_BATCH_SIZE', 10)
+        ):
+            return False
+        # The EXIF index is updated from the same parse
+        BatchExifIndex.for_batch(batch_id, exif)
+        return True
+
+    @staticmethod
+    def page(batch_id, page, per_page, names=None):
+        """
+        Returns (entries, page_count) for a 1-based page of the batch, or
+        of its files in names (in batch order) when given.
+        """
+        index = ImageHandler.get_index()
+        total = index.batch_count(batch_id) if names is None else len(names)
+        pages = max(1, -(-total // per_page))
+        page = min(max(1, page), pages)
+        if names is None:
+            entries = index.batch_files(batch_id, (page - 1) * per_page, per_page)
+        else:
+            entries = index.batch_files(batch_id, names=names[(page - 1) * per_page:page * per_page])
+        for entry in entries:
+            entry['lineage'] = json.loads(entry['lineage'])
+        return entries, pages
+
+    @staticmethod
+    def files(batch_id):
+        """Returns every live file of a batch, in upload order."""
+        return ImageHandler.get_index().batch_files(batch_id)
+
+    @staticmethod
+    def names(batch_id):
+        return ImageHandler.get_index().batch_names(batch_id)
+
+    @staticmethod
+    def has_format(batch_id, fmt):
+        return ImageHandler.get_index().batch_has_format(batch_id, fmt)
+
+    @staticmethod
+    def record(batch_id, action, renamed, entries):
+        """
+        Records the outcome of a batch operation in one transaction:
+        renamed maps processed files to their new names; entries are the
+        files' manifest rows before the operation.
+        """
+        updates = {}
+        exif = {}
+        for entry in entries:
+            new_name = renamed.get(entry['name'])
+            if new_name is None:
+                continue
+            try:
+                exif[new_name] = BatchManifest.read_exif(new_name)
+                lineage = json.loads(entry['lineage']) + [action]
+                updates[entry['name']] = BatchManifest.describe(new_name, exif[new_name], entry['origin'], lineage)
+            except OSError as e:
+                logger.error(f"Error describing {new_name}: {e}")
+        ImageHandler.get_index().update_batch_files(batch_id, updates)
+        BatchExifIndex.for_batch(batch_id, exif)
+
+    @staticmethod
+    def remove(batch_id, filename):
+        return bool(batch_id) and ImageHandler.get_index().remove_batch_file(batch_id, filename)
+
+    @staticmethod
+    def clear(batch_id):
+        """Deletes the batch and returns the names of its files."""
+        session.pop('batch_id', None)
+        return ImageHandler.get_index().drop_batch(batch_id) if batch_id else []
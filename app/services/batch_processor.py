@@ -0,0 +1,172 @@
+import time
+import math
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from flask import Flask, current_app
+from app.services.exif_manager import ExifManager
+from app.services.watermark_manager import WatermarkManager
+from app.services.heif_editor import HeifEditor
+from app.services.metrics import Metrics
+
+
+logger = logging.getLogger(__name__)
+
+# Config keys forwarded to pool workers, which run outside the Flask app
+WORKER_CONFIG_KEYS = ('UPLOAD_FOLDER', 'IMAGE_QUALITY', 'IMAGE_SUBSAMPLING', 'INDEX_DB_PATH')
+
+# Actions sent to the pool even for a single file: a full decode and
+# encode must not hold the request thread
+POOLED_ACTIONS = {'transcode'}
+
+_executor = None
+_executor_settings = None
+_executor_lock = threading.Lock()
+
+# Minimal app used by pool workers so services can read current_app.config
+_worker_app = None
+
+
+def _init_worker():
+    global _worker_app
+    _worker_app = Flask('picturify-worker')
+
+
+def _run_task(action, file_path, options, config, dest_path=None):
+    """Runs a single batch operation inside a pool worker."""
+    app = _worker_app or Flask('picturify-worker')
+    app.config.update(config)
+    with app.app_context():
+        try:
+            return _dispatch(action, file_path, options, dest_path)
+        finally:
+            # Pool workers are recycled: save metrics after every task
+            Metrics.flush()
+
+
+def _dispatch(action, file_path, options, dest_path=None):
+    if action == 'purify':
+        return ExifManager.remove_exif(file_path, dest_path, quality=options.get('quality'))
+    if action == 'template':
+        return ExifManager.keep_only_tags(file_path, options['kept_tags'], dest_path, quality=options.get('quality'))
+    if action == 'edit':
+        return ExifManager.modify_exif(file_path, options['changes'], dest_path, quality=options.get('quality'))
+    if action == 'watermark':
+        return WatermarkManager.apply_watermark(
+            file_path, options['text'], options.get('position', 'center'),
+            options.get('opacity', 0.5), dest_path
+        )
+    if action == 'transcode':
+        fmt = options.get('format', 'JPEG')
+        return HeifEditor.transcode(
+            file_path, dest_path or HeifEditor.transcode_path(file_path, fmt), fmt, options.get('quality', 90)
+        )
+    if action == 'gps':
+        return ExifManager.replace_gps(file_path, options.get('gps'), dest_path)
+    raise ValueError(f"Unknown batch action: {action}")
+
+
+class BatchProcessor:
+    @staticmethod
+    def get_executor():
+        """
+        Returns the process pool of this (gunicorn) worker, created on first use.
+        The pool is recreated if its settings change or it was broken.
+        """
+        global _executor, _executor_settings
+        settings = (
+            current_app.config.get('BATCH_WORKERS', 2),
+            current_app.config.get('BATCH_MAX_TASKS_PER_CHILD', 100),
+        )
+        with _executor_lock:
+            if _executor is None or _executor_settings != settings:
+                if _executor is not None:
+                    _executor.shutdown(wait=False, cancel_futures=True)
+                workers, max_tasks = settings
+                # Avoid forking the threaded gunicorn worker where possible
+                methods = multiprocessing.get_all_start_methods()
+                method = 'forkserver' if 'forkserver' in methods else 'spawn'
+                _executor = ProcessPoolExecutor(
+                    max_workers=workers,
+                    mp_context=multiprocessing.get_context(method),
+                    initializer=_init_worker,
+                    max_tasks_per_child=max_tasks or None,
+                )
+                _executor_settings = settings
+            return _executor
+
+    @staticmethod
+    def reset_executor():
+        global _executor, _executor_settings
+        with _executor_lock:
+            if _executor is not None:
+                _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = None
+            _executor_settings = None
+
+    @staticmethod
+    def run(action, filenames, file_paths, options=None, dest_paths=None, file_options=None):
+        """
+        Runs action ('purify', 'template', 'edit', 'watermark', 'transcode' or 'gps') on every file,
+        writing to dest_paths if given (default: next to each source).
+        file_options, if given, holds one dict per file merged over options
+        (e.g. the GPS IFD each file gets).
+        Returns a list of dicts, in input order:
+            {'filename': str, 'result': output path or None, 'error': str or None}
+        """
+        options = options or {}
+        dest_paths = dest_paths or [None] * len(file_paths)
+        per_file = [{**options, **extra} for extra in file_options] if file_options else [options] * len(file_paths)
+        workers = current_app.config.get('BATCH_WORKERS', 2)
+
+        if workers <= 0 or (len(file_paths) <= 1 and action not in POOLED_ACTIONS):
+            # Inline mode: no pool, run in the request thread
+            results = []
+            for fname, path, dest, opts in zip(filenames, file_paths, dest_paths, per_file):
+                try:
+                    out = _dispatch(action, path, opts, dest)
+                    results.append({'filename': fname, 'result': out, 'error': None if out else 'Processing failed'})
+                except Exception as e:
+                    logger.error(f"Batch {action} failed for {fname}: {e}")
+                    results.append({'filename': fname, 'result': None, 'error': str(e)})
+            return results
+
+        config = {key: current_app.config.get(key) for key in WORKER_CONFIG_KEYS}
+        timeout = current_app.config.get('BATCH_TASK_TIMEOUT', 60)
+
+        executor = BatchProcessor.get_executor()
+        futures = [
+            executor.submit(_run_task, action, path, opts, config, dest)
+            for path, dest, opts in zip(file_paths, dest_paths, per_file)
+        ]
+
+        # Each file gets `timeout` seconds once a worker picks it up,
+        # so the deadline grows with the number of pool rounds.
+        rounds = math.ceil(len(futures) / workers)
+        deadline = time.monotonic() + timeout * rounds
+
+        results = []
+        broken = False
+        for fname, future in zip(filenames, futures):
+            try:
+                out = future.result(timeout=max(0, deadline - time.monotonic()))
+                results.append({'filename': fname, 'result': out, 'error': None if out else 'Processing failed'})
+            except FutureTimeoutError:
+                # A task that already started keeps its worker until it ends
+                future.cancel()
+                logger.error(f"Batch {action} timed out for {fname}")
+                results.append({'filename': fname, 'result': None, 'error': 'Timed out'})
+            except BrokenProcessPool as e:
+                broken = True
+                logger.error(f"Batch {action} failed for {fname}: {e}")
+                results.append({'filename': fname, 'result': None, 'error': 'Worker crashed'})
+            except Exception as e:
+                logger.error(f"Batch {action} failed for {fname}: {e}")
+                results.append({'filename': fname, 'result': None, 'error': str(e)})
+
+        if broken:
+            BatchProcessor.reset_executor()
+        return results
@@ -0,0 +1,93 @@
+import os
+import shutil
+import logging
+from flask import current_app
+
+
+logger = logging.getLogger(__name__)
+
+
+class ContentStore:
+    """
+    Stores uploads once per content hash under BLOB_FOLDER/<ab>/<sha256>.
+    Files in the upload folder are hard links to their blob, so the link
+    count doubles as the reference count: a blob with a single link is no
+    longer used by any upload and can be released.
+    Blobs are never written in place; edits always produce new files.
+    """
+
+    @staticmethod
+    def blob_path(sha256, blob_folder=None):
+        blob_folder = blob_folder or current_app.config['BLOB_FOLDER']
+        return os.path.join(blob_folder, sha256[:2], sha256)
+
+    @staticmethod
+    def link(sha256, dest_path):
+        """
+        Points dest_path at an existing blob. Returns False if there is no
+        blob for sha256 (or it was released concurrently).
+        """
+        blob = ContentStore.blob_path(sha256)
+        try:
+            os.link(blob, dest_path)
+            return True
+        except FileNotFoundError:
+            return False
+        except OSError:
+            # No hard link support (other filesystem, ...): fall back to a copy
+            if not os.path.exists(blob):
+                return False
+            shutil.copyfile(blob, dest_path)
+            return True
+
+    @staticmethod
+    def add(sha256, source_path, dest_path):
+        """
+        Moves a freshly written file to dest_path and records it as the blob
+        for sha256. dest_path is linked first, so a concurrent release of the
+        blob can never lose the upload.
+        """
+        blob = ContentStore.blob_path(sha256)
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        try:
+            os.link(source_path, dest_path)
+        except OSError:
+            # No hard link support: keep a plain file, nothing to deduplicate against
+            os.replace(source_path, dest_path)
+            return
+        try:
+            os.link(source_path, blob)
+        except FileExistsError:
+            pass  # Stored concurrently by another request
+        os.remove(source_path)
+
+    @staticmethod
+    def release(sha256, blob_folder=None):
+        """
+        Deletes the blob for sha256 if no upload links to it any more.
+        Returns True if the content is no longer stored.
+        """
+        if not sha256:
+            return False
+        blob = ContentStore.blob_path(sha256, blob_folder)
+        try:
+            if os.stat(blob).st_nlink <= 1:
+                os.remove(blob)
+                return True
+            return False
+        except FileNotFoundError:
+            return True
+        except OSError as e:
+            logger.error(f"Error releasing blob {sha256}: {e}")
+            return False
+
+    @staticmethod
+    def collect(blob_folder):
+        """Releases every blob no upload links to. Runs once at reaper startup."""
+        if not os.path.exists(blob_folder):
+            return
+        for shard in os.scandir(blob_folder):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                ContentStore.release(entry.name, blob_folder)
@@ -0,0 +1,389 @@
+import os
+import json
+import stat
+import time
+import queue
+import signal
+import hashlib
+import logging
+import threading
+import multiprocessing
+from app.services.exif_manager import ExifManager
+from app.services.watermark_manager import WatermarkManager
+from app.services.metadata_templates import MetadataTemplates
+from app.services.processing_options import ProcessingOptions
+from app.services.run_manifest import RunManifest
+
+
+logger = logging.getLogger(__name__)
+
+OPERATIONS = ('analyze', 'purify', 'template', 'watermark')
+
+# How files already recorded in the manifest are recognised:
+# 'mtime' = same size and modification time, 'hash' = same SHA-256, 'none' = never skipped
+SKIP_MODES = ('mtime', 'hash', 'none')
+
+# Kept in the output directory
+MANIFEST_NAME = '.picturify-manifest.sqlite'
+ANALYSIS_NAME = 'analysis.ndjson'
+
+# Manifest records written per transaction
+RECORD_BATCH = 256
+
+HASH_CHUNK_BYTES = 1024 * 1024
+
+# Job of this worker process (see _init_worker)
+_job = None
+
+
+def _init_worker(job, ignore_interrupt=False):
+    global _job
+    _job = job
+    if ignore_interrupt:
+        # Ctrl+C reaches the whole process group: the parent stops the workers
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _worker(job, tasks, results):
+    """Worker process: processes tasks until it gets None, then sends None back."""
+    _init_worker(job, ignore_interrupt=True)
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            results.put(_process(task))
+    finally:
+        results.put(None)
+
+
+def _file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _output_stat(dest):
+    """Returns the (size, mtime_ns) of an output, or (None, None) if it is missing."""
+    try:
+        file_stat = os.stat(dest)
+    except OSError:
+        return None, None
+    return file_stat.st_size, file_stat.st_mtime_ns
+
+
+def _process(task):
+    """
+    Runs the job's operation on one file. task is
+    (relative path, source path, destination path or None, size, mtime_ns, recorded hash).
+    Returns the file's manifest record, plus 'data' for analyses.
+    """
+    rel, source, dest, size, mtime_ns, known_hash = task
+    record = {'path': rel, 'task': _job['task'], 'size': size, 'mtime_ns': mtime_ns, 'sha256': None,
+              'status': 'done', 'output': None, 'error': None, 'output_size': None, 'output_mtime_ns': None}
+    try:
+        if _job['skip'] == 'hash':
+            record['sha256'] = _file_hash(source)
+            if known_hash == record['sha256']:
+                record['status'] = 'skipped'
+                if dest:
+                    record['output'] = rel
+                    record['output_size'], record['output_mtime_ns'] = _output_stat(dest)
+                return record
+
+        if _job['operation'] == 'analyze':
+            # An unreadable file is a failure, not a file without metadata
+            record['data'] = ExifManager.get_exif_data(source, options=_job['options'], raise_errors=True)
+            return record
+
+        # Written next to its destination under a hidden name, then renamed
+        # into place, so an interrupted run never leaves a partial output
+        dest_dir, dest_name = os.path.split(dest)
+        os.makedirs(dest_dir, exist_ok=True)
+        tmp_path = os.path.join(dest_dir, f".tmp-{os.getpid()}-{dest_name}")
+        try:
+            out = _run_operation(source, tmp_path)
+            if not out:
+                record.update(status='failed', error='Processing failed')
+                return record
+            # Temporary files are created private (0600): give the output the source's mode
+            os.chmod(out, stat.S_IMODE(os.stat(source).st_mode))
+            os.replace(out, dest)
+            record['output'] = rel
+            record['output_size'], record['output_mtime_ns'] = _output_stat(dest)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    except Exception as e:
+        logger.error(f"Processing {rel} failed: {e}")
+        record.update(status='failed', error=str(e))
+    return record
+
+
+def _run_operation(source, dest):
+    job = _job
+    operation = job['operation']
+    if operation == 'purify':
+        return ExifManager.remove_exif(source, dest, quality=job.get('quality'), options=job['options'])
+    if operation == 'template':
+        return ExifManager.keep_only_tags(
+            source, job['kept_tags'], dest, quality=job.get('quality'), options=job['options']
+        )
+    if operation == 'watermark':
+        return WatermarkManager.apply_watermark(
+            source, job['text'], job.get('position', 'center'), job.get('opacity', 0.5), dest, options=job['options']
+        )
+    raise ValueError(f"Unknown operation: {operation}")
+
+
+def _json_default(value):
+    # EXIF rationals and other numbers become floats, anything else text
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return str(value)
+
+
+class DirectoryPipeline:
+    """
+    Processes a directory tree outside of the web app: every image under
+    input_dir is analyzed, purified, filtered through a template or
+    watermarked, with outputs mirroring the tree under output_dir.
+
+    A feeder thread walks the tree into a bounded task queue, worker
+    processes read from it and send results through a bounded result queue,
+    and the main process records them in the RunManifest, so memory stays
+    flat however many files there are. Files the manifest already has for
+    the same task are skipped (see SKIP_MODES), which makes runs resumable.
+    """
+
+    def __init__(self, operation, input_dir, output_dir, workers=None, queue_size=None, skip='mtime',
+                 quality=None, template=None, text=None, position='center', opacity=0.5,
+                 processing_options=None, progress=None, progress_seconds=5):
+        if operation not in OPERATIONS:
+            raise ValueError(f"operation must be one of: {', '.join(OPERATIONS)}")
+        if skip not in SKIP_MODES:
+            raise ValueError(f"skip must be one of: {', '.join(SKIP_MODES)}")
+        if not os.path.isdir(input_dir):
+            raise ValueError(f"Not a directory: {input_dir}")
+
+        self.operation = operation
+        self.input_dir = os.path.abspath(input_dir)
+        self.output_dir = os.path.abspath(output_dir)
+        self.workers = (os.cpu_count() or 1) if workers is None else workers
+        self.queue_size = queue_size or 4 * max(1, self.workers)
+        self.skip = skip
+        self.processing_options = ProcessingOptions.resolve(processing_options)
+        self.progress = progress
+        self.progress_seconds = progress_seconds
+
+        params = {}
+        self.job = {'operation': operation, 'skip': skip, 'options': self.processing_options}
+        if operation in ('purify', 'template') and quality is not None:
+            self.job['quality'] = params['quality'] = quality
+        if operation == 'template':
+            kept_tags = MetadataTemplates.get_compiled(template) if template else None
+            if not kept_tags:
+                raise ValueError(f"Unknown template: {template}")
+            self.job['kept_tags'] = kept_tags
+            params['template'] = template
+        if operation == 'watermark':
+            if not text:
+                raise ValueError("Watermark text is required")
+            self.job.update(text=text, position=position, opacity=float(opacity))
+            params.update(text=text, position=position, opacity=float(opacity))
+        # Files are recorded per task: another template, text, ... processes them again
+        self.task = f"{operation}:{json.dumps(params, sort_keys=True)}" if params else operation
+        self.job['task'] = self.task
+
+        self.manifest = None
+        self._stop = threading.Event()
+        self._skipped = 0
+
+    # --- Feeding ---
+
+    def _walk(self):
+        """Yields (relative path, path, stat) of every image under input_dir, in a stable order."""
+        for dir_path, dir_names, file_names in os.walk(self.input_dir):
+            dir_names[:] = sorted(
+                d for d in dir_names
+                if not d.startswith('.') and os.path.join(dir_path, d) != self.output_dir
+            )
+            for name in sorted(file_names):
+                if name.startswith('.') or not self.processing_options.allowed_file(name):
+                    continue
+                path = os.path.join(dir_path, name)
+                try:
+                    file_stat = os.stat(path)
+                except OSError as e:
+                    logger.error(f"Cannot read {path}: {e}")
+                    continue
+                yield os.path.relpath(path, self.input_dir), path, file_stat
+
+    def _tasks(self):
+        """Yields the tasks of the files that still need processing."""
+        for rel, path, file_stat in self._walk():
+            dest = None if self.operation == 'analyze' else os.path.join(self.output_dir, rel)
+            known_hash = None
+            record = self.manifest.lookup(rel, self.task) if self.skip != 'none' else None
+            if record and record['status'] == 'done' and self._output_intact(dest, record):
+                if self.skip == 'mtime' and (record['size'], record['mtime_ns']) == (
+                        file_stat.st_size, file_stat.st_mtime_ns):
+                    self._skipped += 1
+                    continue
+                known_hash = record['sha256']
+            yield rel, path, dest, file_stat.st_size, file_stat.st_mtime_ns, known_hash
+
+    @staticmethod
+    def _output_intact(dest, record):
+        """
+        True if dest is still the output the record was written with. Every
+        task mirrors the tree into the same output directory, so another
+        task may have replaced (or removed) it since.
+        """
+        if dest is None:
+            return True
+        return _output_stat(dest) == (record['output_size'], record['output_mtime_ns'])
+
+    def _feed(self, tasks, worker_count):
+        try:
+            for task in self._tasks():
+                while not self._stop.is_set():
+                    try:
+                        tasks.put(task, timeout=0.5)
+                        break
+                    except queue.Full:
+                        continue
+                if self._stop.is_set():
+                    return
+        except Exception as e:
+            logger.error(f"Error walking {self.input_dir}: {e}")
+        finally:
+            if not self._stop.is_set():
+                for _ in range(worker_count):
+                    tasks.put(None)
+
+    # --- Running ---
+
+    def run(self):
+        """Processes the tree and returns the run's report (see report)."""
+        os.makedirs(self.output_dir, exist_ok=True)
+        self.manifest = RunManifest(os.path.join(self.output_dir, MANIFEST_NAME))
+        self._stop.clear()
+        self._skipped = 0
+        self._stats = {'processed': 0, 'failed': 0, 'bytes': 0}
+        self._pending = []
+        self._analysis = open(os.path.join(self.output_dir, ANALYSIS_NAME), 'a', encoding='utf-8') \
+            if self.operation == 'analyze' else None
+        self._started = time.monotonic()
+        self._last_progress = self._started
+        run_id = self.manifest.start_run(self.task)
+        try:
+            if self.workers <= 0:
+                self._run_inline()
+            else:
+                self._run_pool()
+        finally:
+            self._flush()
+            if self._analysis:
+                self._analysis.close()
+            report = self.report()
+            self.manifest.finish_run(run_id, report['processed'], report['skipped'], report['failed'], report['bytes'])
+        return report
+
+    def _run_inline(self):
+        _init_worker(self.job)
+        for task in self._tasks():
+            self._handle(_process(task))
+
+    def _run_pool(self):
+        # Same start method as the BatchProcessor pool
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+        tasks = context.Queue(maxsize=self.queue_size)
+        results = context.Queue(maxsize=self.queue_size)
+        processes = [
+            context.Process(target=_worker, args=(self.job, tasks, results), name=f'picturify-worker-{i}', daemon=True)
+            for i in range(self.workers)
+        ]
+        for process in processes:
+            process.start()
+        feeder = threading.Thread(target=self._feed, args=(tasks, len(processes)), name='picturify-feeder', daemon=True)
+        feeder.start()
+
+        finished = 0
+        try:
+            while finished < len(processes):
+                try:
+                    result = results.get(timeout=1)
+                except queue.Empty:
+                    # A crashed worker never says goodbye: its file is redone on the next run
+                    crashed = sum(1 for p in processes if p.exitcode not in (None, 0))
+                    if crashed and finished + crashed >= len(processes):
+                        logger.error(f"{crashed} worker(s) crashed")
+                        break
+                    self._maybe_report()
+                    continue
+                if result is None:
+                    finished += 1
+                else:
+                    self._handle(result)
+        finally:
+            self._stop.set()
+            for process in processes:
+                if process.is_alive() and finished < len(processes):
+                    process.terminate()
+                process.join(timeout=5)
+            # Leftover None markers must not keep the interpreter alive
+            tasks.cancel_join_thread()
+            feeder.join(timeout=5)
+
+    def _handle(self, record):
+        data = record.pop('data', None)
+        if record['status'] == 'failed':
+            self._stats['failed'] += 1
+        elif record['status'] == 'skipped':
+            # Same content as recorded: only its size and mtime changed
+            self._skipped += 1
+            record['status'] = 'done'
+        else:
+            self._stats['processed'] += 1
+            self._stats['bytes'] += record['size']
+            if data is not None:
+                self._analysis.write(json.dumps(
+                    {'path': record['path'], 'sha256': record['sha256'], 'exif_data': data}, default=_json_default
+                ) + '\n')
+        self._pending.append(record)
+        if len(self._pending) >= RECORD_BATCH:
+            self._flush()
+        self._maybe_report()
+
+    def _flush(self):
+        if self._pending:
+            self.manifest.record(self._pending)
+            self._pending = []
+        if self._analysis:
+            self._analysis.flush()
+
+    def _maybe_report(self):
+        now = time.monotonic()
+        if self.progress and now - self._last_progress >= self.progress_seconds:
+            self._last_progress = now
+            self._flush()  # Progress shown is progress saved
+            self.progress(self.report())
+
+    def report(self):
+        """Counts and throughput of the current (or last) run."""
+        seconds = max(time.monotonic() - self._started, 1e-9)
+        return {
+            'task': self.task,
+            'processed': self._stats['processed'],
+            'skipped': self._skipped,
+            'failed': self._stats['failed'],
+            'bytes': self._stats['bytes'],
+            'seconds': round(seconds, 3),
+            'files_per_second': round(self._stats['processed'] / seconds, 2),
+            'megabytes_per_second': round(self._stats['bytes'] / seconds / (1024 * 1024), 2),
+        }
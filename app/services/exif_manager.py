@@ -2,23 +2,71 @@ from PIL import Image
 from PIL.ExifTags import TAGS, GPSTAGS
 import piexif
 import os
+import copy
 import logging
 import shutil
-from flask import current_app
+import threading
+from collections import OrderedDict
+from app.services.segment_editor import SegmentEditor
+from app.services.heif_editor import HeifEditor
+from app.services.tag_index import TagIndex
+from app.services.metadata_templates import MetadataTemplates
+from app.services.metrics import Metrics
+from app.services.processing_options import ProcessingOptions
 
 
 logger = logging.getLogger(__name__)
 
+# EXIF analysis results keyed by content hash (LRU, per process)
+_analysis_cache = OrderedDict()
+_analysis_lock = threading.Lock()
+
 class ExifManager:
     @staticmethod
-    def get_exif_data(image_path):
+    def get_exif_data(image_path, content_hash=None, options=None, raise_errors=False):
         """
         Extracts and converts EXIF data into a readable dictionary.
+        JPEG, PNG, WebP and HEIF metadata is read without decoding the image;
+        other formats go through Pillow.
+        Results are memoized per content_hash when one is given.
+        Unreadable files give {} unless raise_errors is set.
         """
+        if content_hash:
+            with _analysis_lock:
+                cached = _analysis_cache.get(content_hash)
+                if cached is not None:
+                    _analysis_cache.move_to_end(content_hash)
+                    Metrics.inc('picturify_analysis_cache_total', result='hit')
+                    return copy.deepcopy(cached)
+            Metrics.inc('picturify_analysis_cache_total', result='miss')
+
+        with Metrics.timer('get_exif_data', 'parse'):
+            exif_data = ExifManager._read_exif_data(image_path, raise_errors)
+
+        if content_hash:
+            max_entries = ProcessingOptions.resolve(options).analysis_cache_size
+            with _analysis_lock:
+                _analysis_cache[content_hash] = copy.deepcopy(exif_data)
+                while len(_analysis_cache) > max_entries:
+                    _analysis_cache.popitem(last=False)
+        return exif_data
+
+    @staticmethod
+    def _read_exif_data(image_path, raise_errors=False):
         exif_data = {}
         try:
-            image = Image.open(image_path)
-            info = image._getexif()
+            try:
+                raw = ExifManager._read_exif_block(image_path)
+                info = None
+                if raw:
+                    exif = Image.Exif()
+                    exif.load(raw)
+                    info = exif._get_merged_dict()
+            except ValueError:
+                with Image.open(image_path) as image:
+                    # getexif() works for every format (TIFF, HEIF, ...), unlike _getexif()
+                    info = image.getexif()._get_merged_dict()
+
             if info:
                 for tag, value in info.items():
                     decoded = TAGS.get(tag, tag)
@@ -37,31 +85,60 @@ class ExifManager:
                                 value = str(value)
                         exif_data[decoded] = value
         except Exception as e:
+            if raise_errors:
+                raise
             logger.error(f"Error extracting EXIF: {e}")
-            pass
         return exif_data
 
     @staticmethod
-    def remove_exif(source_path, dest_path=None, quality=None):
+    def _read_exif_block(image_path):
+        """
+        Returns the raw EXIF block read from the container (JPEG, PNG, WebP
+        or HEIF), or None. Raises ValueError for formats Pillow must open.
+        """
+        try:
+            return SegmentEditor.read_exif_block(image_path)
+        except ValueError:
+            return HeifEditor.read_exif(image_path)
+
+    @staticmethod
+    def wants_recompression(quality):
+        """
+        True if the caller asked for a lossy re-encode (quality below 100).
+        None or 100 means "no compression" and keeps the pixel data untouched.
+        """
+        return quality is not None and int(quality) < 100
+
+    @staticmethod
+    def remove_exif(source_path, dest_path=None, quality=None, options=None):
         """
         Removes EXIF data and saves the image.
+        JPEG, PNG, WebP, TIFF and HEIF files are stripped losslessly in their
+        container unless a lower quality is requested; other formats go
+        through Pillow.
         """
         if dest_path is None:
             dir_name, file_name = os.path.split(source_path)
             dest_path = os.path.join(dir_name, f"purified_{file_name}")
-            
-        if quality is None:
-            quality = current_app.config['IMAGE_QUALITY']
+
+        if not ExifManager.wants_recompression(quality):
+            for strip in (SegmentEditor.strip, HeifEditor.strip):
+                try:
+                    with Metrics.timer('remove_exif', 'write'):
+                        return strip(source_path, dest_path)
+                except ValueError:
+                    continue  # Not a container we can walk, fall back to Pillow
+                except Exception as e:
+                    logger.error(f"Error stripping metadata: {e}")
+                    return None
 
         try:
-            with Image.open(source_path) as image:
-                image.load() 
+            with Metrics.timer('remove_exif', 'decode'):
+                with Image.open(source_path) as image:
+                    image.load() 
                 
-            image.save(
-                dest_path, 
-                quality=quality, 
-                subsampling=current_app.config['IMAGE_SUBSAMPLING']
-            )
+            with Metrics.timer('remove_exif', 'encode'):
+                ExifManager._write_image(image, dest_path, **ProcessingOptions.resolve(options).save_kwargs(quality))
             return dest_path
         except Exception as e:
             logger.error(f"Error purifying image: {e}")
@@ -115,9 +192,10 @@ class ExifManager:
         return ((d, 1), (m, 1), (int(s * 100), 100))
 
     @staticmethod
-    def modify_exif(source_path, changes, dest_path=None, quality=None):
+    def modify_exif(source_path, changes, dest_path=None, quality=None, options=None):
         """
         Modifies specific EXIF tags.
+        Pixel data is only re-encoded when quality is below 100.
         """
         if dest_path is None:
             dir_name, file_name = os.path.split(source_path)
@@ -126,15 +204,12 @@ class ExifManager:
             else:
                  dest_path = source_path
                  
-        if quality is None:
-            quality = current_app.config['IMAGE_QUALITY']
-
         try:
-            image = Image.open(source_path)
-            
+            exif_bytes = ExifManager.load_exif_bytes(source_path, 'modify_exif')
+
             # Load existing EXIF or create new if missing
-            if "exif" in image.info:
-                exif_dict = piexif.load(image.info["exif"])
+            if exif_bytes:
+                exif_dict = piexif.load(exif_bytes)
             else:
                 exif_dict = {"0th": {}, "Exif": {}, "GPS": {}, "1st": {}, "thumbnail": None}
 
@@ -165,7 +240,7 @@ class ExifManager:
 
                 group, tag_id = ExifManager._find_tag_info(key)
                 
-                if group and tag_id:
+                if group and tag_id is not None:
                     if key == 'UserComment':
                          encoded_val = b'ASCII\x00\x00\x00' + value.encode('ascii', 'ignore')
                          exif_dict[group][tag_id] = encoded_val
@@ -185,20 +260,14 @@ class ExifManager:
                                 pass
 
             exif_bytes = piexif.dump(exif_dict)
-            image.save(
-                dest_path, 
-                exif=exif_bytes, 
-                quality=quality, 
-                subsampling=current_app.config['IMAGE_SUBSAMPLING']
-            )
-            return dest_path
+            return ExifManager._save_exif(source_path, dest_path, exif_bytes, quality, 'modify_exif', options)
 
         except Exception as e:
             logger.error(f"Error modifying EXIF: {e}")
             return None
 
     @staticmethod
-    def delete_tags(source_path, tags_to_delete, dest_path=None, quality=None):
+    def delete_tags(source_path, tags_to_delete, dest_path=None, quality=None, options=None):
         """
         Removes specific EXIF tags from the image.
         """
@@ -209,43 +278,36 @@ class ExifManager:
             else:
                  dest_path = source_path
                  
-        if quality is None:
-             quality = current_app.config['IMAGE_QUALITY']
-
         try:
-            image = Image.open(source_path)
-            
-            if "exif" in image.info:
-                exif_dict = piexif.load(image.info["exif"])
+            exif_bytes = ExifManager.load_exif_bytes(source_path, 'delete_tags')
+
+            if exif_bytes:
+                exif_dict = piexif.load(exif_bytes)
             else:
-                # Save with new quality settings even if no EXIF is present
-                image.save(dest_path, quality=quality, subsampling=current_app.config['IMAGE_SUBSAMPLING'])
-                return dest_path
+                # Apply new quality settings even if no EXIF is present
+                return ExifManager._save_exif(source_path, dest_path, None, quality, 'delete_tags', options)
 
             for tag_name in tags_to_delete:
                 group, tag_id = ExifManager._find_tag_info(tag_name)
-                if group and tag_id:
+                if group and tag_id is not None:
                     if tag_id in exif_dict[group]:
                         del exif_dict[group][tag_id]
             
             exif_bytes = piexif.dump(exif_dict)
-            image.save(
-                dest_path, 
-                exif=exif_bytes, 
-                quality=quality, 
-                subsampling=current_app.config['IMAGE_SUBSAMPLING']
-            )
-            return dest_path
+            return ExifManager._save_exif(source_path, dest_path, exif_bytes, quality, 'delete_tags', options)
         except Exception as e:
             logger.error(f"Error deleting EXIF tags: {e}")
             return None
 
     @staticmethod
-    def keep_only_tags(source_path, kept_tags, dest_path=None, quality=None):
+    def keep_only_tags(source_path, kept_tags, dest_path=None, quality=None, options=None):
         """
         Removes all EXIF tags EXCEPT those in kept_tags.
-        kept_tags is a list of tag names (str).
+        kept_tags is a list of template rules (tag names, globs or @groups),
+        or a template already compiled by MetadataTemplates.compile.
         """
+        kept = kept_tags if isinstance(kept_tags, dict) else MetadataTemplates.compile(kept_tags)
+
         if dest_path is None:
             dir_name, file_name = os.path.split(source_path)
             # Use 'optimized_' prefix to distinguish
@@ -254,91 +316,127 @@ class ExifManager:
             else:
                  dest_path = source_path
                  
-        if quality is None:
-             quality = current_app.config['IMAGE_QUALITY']
-
         try:
-            image = Image.open(source_path)
-            
-            if "exif" in image.info:
+            exif_bytes = ExifManager.load_exif_bytes(source_path, 'keep_only_tags')
+
+            if exif_bytes:
                 try:
-                    exif_dict = piexif.load(image.info["exif"])
+                    exif_dict = piexif.load(exif_bytes)
                 except Exception:
                     return None
             else:
-                return dest_path
+                return ExifManager._save_exif(source_path, dest_path, None, quality, 'keep_only_tags', options)
 
-            # Helper to check if a tag should be kept
-            def should_keep(group_name, tag_id):
-                # Get tag name
-                try:
-                    if group_name == "0th":
-                        tag_name = piexif.TAGS["Image"][tag_id]["name"]
-                    elif group_name == "Exif":
-                        tag_name = piexif.TAGS["Exif"][tag_id]["name"]
-                    elif group_name == "GPS":
-                         # Use PIL's GPSTAGS
-                         tag_name = GPSTAGS.get(tag_id, None)
-                    else:
-                        return False # remove 1st/Interop if not explicitly handled
-                    
-                    if not tag_name: return False
-                    return tag_name in kept_tags
-                except KeyError:
-                    return False
-
-            # Iterate and Filter Tags
-            new_0th = {}
-            for tag_id, val in exif_dict["0th"].items():
-                if should_keep("0th", tag_id):
-                    new_0th[tag_id] = val
-            exif_dict["0th"] = new_0th
-
-            new_exif = {}
-            for tag_id, val in exif_dict["Exif"].items():
-                if should_keep("Exif", tag_id):
-                    new_exif[tag_id] = val
-            exif_dict["Exif"] = new_exif
-
-            new_gps = {}
-            for tag_id, val in exif_dict["GPS"].items():
-                if should_keep("GPS", tag_id):
-                    new_gps[tag_id] = val
-            exif_dict["GPS"] = new_gps
+            # Filter each IFD against the compiled per-IFD sets of kept tag IDs
+            for group in ("0th", "Exif", "GPS"):
+                kept_ids = kept[group]
+                exif_dict[group] = {
+                    tag_id: val for tag_id, val in exif_dict[group].items() if tag_id in kept_ids
+                }
 
             exif_dict["1st"] = {} 
             exif_dict["thumbnail"] = None 
 
             exif_bytes = piexif.dump(exif_dict)
-            image.save(
-                dest_path, 
-                exif=exif_bytes, 
-                quality=quality, 
-                subsampling=current_app.config['IMAGE_SUBSAMPLING']
-            )
-            return dest_path
+            return ExifManager._save_exif(source_path, dest_path, exif_bytes, quality, 'keep_only_tags', options)
 
         except Exception as e:
             logger.error(f"Error optimizing EXIF tags: {e}")
             return None
 
+    @staticmethod
+    def replace_gps(source_path, gps_ifd, dest_path=None):
+        """
+        Replaces the whole GPS IFD (piexif {tag_id: value}; empty or None
+        removes the position), keeping every other tag. Only JPEG and HEIF
+        files are supported: their EXIF block is rewritten in place and the
+        pixel data is never decoded.
+        """
+        if dest_path is None:
+            dir_name, file_name = os.path.split(source_path)
+            if not file_name.startswith("located_"):
+                 dest_path = os.path.join(dir_name, f"located_{file_name}")
+            else:
+                 dest_path = source_path
+
+        try:
+            exif_bytes = ExifManager.load_exif_bytes(source_path, 'replace_gps')
+            if exif_bytes:
+                exif_dict = piexif.load(exif_bytes)
+            else:
+                exif_dict = {"0th": {}, "Exif": {}, "GPS": {}, "1st": {}, "thumbnail": None}
+            exif_dict["GPS"] = dict(gps_ifd or {})
+            exif_bytes = piexif.dump(exif_dict)
+
+            for replace in (SegmentEditor.replace_jpeg_exif, HeifEditor.replace_exif):
+                try:
+                    with Metrics.timer('replace_gps', 'write'):
+                        return replace(source_path, dest_path, exif_bytes)
+                except ValueError:
+                    continue
+            logger.error(f"Cannot rewrite GPS of {os.path.basename(source_path)}: only JPEG and HEIF are supported")
+            return None
+        except Exception as e:
+            logger.error(f"Error replacing GPS data: {e}")
+            return None
+
+    @staticmethod
+    def load_exif_bytes(source_path, operation='load_exif'):
+        """
+        Returns the raw EXIF block of an image, or None.
+        JPEG, PNG, WebP and HEIF containers are parsed directly; other formats go through Pillow.
+        """
+        with Metrics.timer(operation, 'parse'):
+            try:
+                return ExifManager._read_exif_block(source_path)
+            except ValueError:
+                with Image.open(source_path) as image:
+                    return image.info.get("exif")
+
+    @staticmethod
+    def _save_exif(source_path, dest_path, exif_bytes, quality=None, operation='save_exif', options=None):
+        """
+        Writes the image to dest_path with exif_bytes as its EXIF block.
+        JPEGs get the new block spliced in place of the old APP1 segment and
+        HEIFs in their Exif item; pixels are only re-encoded when a lower
+        quality is requested or the container cannot be edited.
+        """
+        if not ExifManager.wants_recompression(quality):
+            for replace in (SegmentEditor.replace_jpeg_exif, HeifEditor.replace_exif):
+                try:
+                    with Metrics.timer(operation, 'write'):
+                        return replace(source_path, dest_path, exif_bytes)
+                except ValueError:
+                    continue  # Not a container we can edit, fall back to Pillow
+
+        with Metrics.timer(operation, 'decode'):
+            with Image.open(source_path) as image:
+                image.load()
+
+        save_kwargs = ProcessingOptions.resolve(options).save_kwargs(quality)
+        if exif_bytes:
+            save_kwargs["exif"] = exif_bytes
+
+        with Metrics.timer(operation, 'encode'):
+            ExifManager._write_image(image, dest_path, **save_kwargs)
+        return dest_path
+
+    @staticmethod
+    def _write_image(image, dest_path, **save_kwargs):
+        """
+        Saves a Pillow image through a temporary file renamed over dest_path.
+        Stored uploads are hard links into the ContentStore and must never be
+        truncated in place.
+        """
+        ext = os.path.splitext(dest_path)[1].lower()
+        fmt = Image.registered_extensions().get(ext, image.format)
+        with SegmentEditor.atomic_output(dest_path) as f:
+            image.save(f, format=fmt, **save_kwargs)
+
     @staticmethod
     def _find_tag_info(tag_name):
         """
         Helper to find which IFD group and ID a tag string belongs to.
         Returns (group_name, tag_id)
         """
-        # Check 0th IFD (Image)
-        for tag_id, name in piexif.TAGS["Image"].items():
-            if name["name"] == tag_name:
-                return "0th", tag_id
-        # Check Exif IFD
-        for tag_id, name in piexif.TAGS["Exif"].items():
-            if name["name"] == tag_name:
-                return "Exif", tag_id
-        # Check GPS using PIL.ExifTags.GPSTAGS
-        for tag_id, name in GPSTAGS.items():
-            if name == tag_name:
-                return "GPS", tag_id
-                
-        return None, None
+        return TagIndex.lookup(tag_name)
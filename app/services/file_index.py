@@ -0,0 +1,523 @@
+import os
+import time
+import sqlite3
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+# Schema migrations, applied in order; the index of the last applied
+# step + 1 is stored in PRAGMA user_version.
+MIGRATIONS = [
+    [
+        """CREATE TABLE IF NOT EXISTS files (
+            name TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            expires_at REAL NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS files_expiry ON files (expires_at)",
+        """CREATE TABLE IF NOT EXISTS counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )""",
+    ],
+    [
+        # LRU order and owning session, for byte budgets
+        "ALTER TABLE files ADD COLUMN session TEXT",
+        "ALTER TABLE files ADD COLUMN accessed REAL NOT NULL DEFAULT 0",
+        "CREATE INDEX files_lru ON files (accessed)",
+        "CREATE INDEX files_session_lru ON files (session, accessed)",
+        # Running totals per scope ('' = global, 'session:<id>'), kept by triggers
+        """CREATE TABLE usage (
+            scope TEXT PRIMARY KEY,
+            files INTEGER NOT NULL,
+            bytes INTEGER NOT NULL
+        )""",
+        """CREATE TRIGGER files_usage_insert AFTER INSERT ON files BEGIN
+            INSERT INTO usage (scope, files, bytes) VALUES ('', 1, NEW.size)
+                ON CONFLICT(scope) DO UPDATE SET files = files + 1, bytes = bytes + excluded.bytes;
+            INSERT INTO usage (scope, files, bytes) SELECT 'session:' || NEW.session, 1, NEW.size
+                WHERE NEW.session IS NOT NULL
+                ON CONFLICT(scope) DO UPDATE SET files = files + 1, bytes = bytes + excluded.bytes;
+        END""",
+        """CREATE TRIGGER files_usage_delete AFTER DELETE ON files BEGIN
+            UPDATE usage SET files = files - 1, bytes = bytes - OLD.size
+                WHERE scope IN ('', 'session:' || OLD.session);
+            DELETE FROM usage WHERE scope = 'session:' || OLD.session AND files <= 0;
+        END""",
+        """CREATE TRIGGER files_usage_update AFTER UPDATE OF size, session ON files BEGIN
+            UPDATE usage SET files = files - 1, bytes = bytes - OLD.size
+                WHERE scope IN ('', 'session:' || OLD.session);
+            INSERT INTO usage (scope, files, bytes) VALUES ('', 1, NEW.size)
+                ON CONFLICT(scope) DO UPDATE SET files = files + 1, bytes = bytes + excluded.bytes;
+            INSERT INTO usage (scope, files, bytes) SELECT 'session:' || NEW.session, 1, NEW.size
+                WHERE NEW.session IS NOT NULL
+                ON CONFLICT(scope) DO UPDATE SET files = files + 1, bytes = bytes + excluded.bytes;
+        END""",
+        "INSERT INTO usage (scope, files, bytes) SELECT '', COUNT(*), COALESCE(SUM(size), 0) FROM files",
+    ],
+    [
+        # Content hash of uploads stored in the ContentStore (NULL for derived files)
+        "ALTER TABLE files ADD COLUMN sha256 TEXT",
+    ],
+    [
+        # Derived artifacts (recompressed downloads, ...) stored in the VariantCache
+        """CREATE TABLE variants (
+            key TEXT PRIMARY KEY,
+            source TEXT NOT NULL,
+            format TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            accessed REAL NOT NULL
+        )""",
+        "CREATE INDEX variants_source ON variants (source)",
+        "CREATE INDEX variants_lru ON variants (accessed)",
+    ],
+    [
+        # Metrics snapshot of each process ('retired' = processes that exited)
+        """CREATE TABLE metrics (
+            key TEXT PRIMARY KEY,
+            pid INTEGER NOT NULL,
+            data TEXT NOT NULL,
+            updated REAL NOT NULL
+        )""",
+    ],
+    [
+        # Storage tier of each file ('disk' or 'memory'), for the memory tier's byte budget
+        "ALTER TABLE files ADD COLUMN tier TEXT NOT NULL DEFAULT 'disk'",
+        "CREATE INDEX files_tier_lru ON files (tier, accessed)",
+    ],
+    [
+        # Server-side batches of a browser session, with per-file state and lineage
+        """CREATE TABLE batches (
+            id TEXT PRIMARY KEY,
+            session TEXT,
+            updated REAL NOT NULL
+        )""",
+        """CREATE TABLE batch_files (
+            batch_id TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            origin TEXT NOT NULL,
+            lineage TEXT NOT NULL DEFAULT '[]',
+            size INTEGER NOT NULL,
+            format TEXT,
+            has_exif INTEGER NOT NULL,
+            has_gps INTEGER NOT NULL,
+            PRIMARY KEY (batch_id, position)
+        )""",
+        "CREATE INDEX batch_files_name ON batch_files (name)",
+    ],
+    [
+        # Serialized columnar EXIF index of a batch (see BatchExifIndex)
+        """CREATE TABLE batch_exif (
+            batch_id TEXT PRIMARY KEY,
+            signature TEXT NOT NULL,
+            data TEXT NOT NULL
+        )""",
+    ],
+    [
+        # Bumped whenever a batch file is rewritten, even under the same name
+        "ALTER TABLE batch_files ADD COLUMN version INTEGER NOT NULL DEFAULT 0",
+    ],
+]
+
+# Per-file state kept in a batch manifest
+BATCH_COLUMNS = ('name', 'origin', 'lineage', 'size', 'format', 'has_exif', 'has_gps')
+
+_instances = {}
+_instances_lock = threading.Lock()
+
+
+class FileIndex:
+    """
+    SQLite index of the files stored in the upload folder, shared by every
+    worker process on the host. Keeps each file's size, expiry time, owning
+    session and last access, plus running byte totals, so cleanup and quota
+    enforcement never have to list or stat the directory.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self._migrate()
+
+    @staticmethod
+    def get(db_path):
+        """Returns the shared FileIndex instance for db_path."""
+        with _instances_lock:
+            index = _instances.get(db_path)
+            if index is None:
+                index = FileIndex(db_path)
+                _instances[db_path] = index
+            return index
+
+    def _connect(self):
+        # One connection per thread and process
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _migrate(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        try:
+            # Serialise concurrent workers starting at the same time
+            conn.execute("BEGIN IMMEDIATE")
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            for statements in MIGRATIONS[version:]:
+                for statement in statements:
+                    conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {len(MIGRATIONS)}")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def register(self, name, size, expires_at, session=None, sha256=None, tier='disk', now=None):
+        """
+        Adds or refreshes a file. A refreshed file keeps its session if none
+        is given; its content hash and tier are always replaced.
+        """
+        now = time.time() if now is None else now
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO files (name, size, expires_at, session, accessed, sha256, tier) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET size = excluded.size, expires_at = excluded.expires_at, "
+                "session = COALESCE(excluded.session, session), accessed = excluded.accessed, "
+                "sha256 = excluded.sha256, tier = excluded.tier",
+                (name, size, expires_at, session, now, sha256, tier)
+            )
+
+    def touch(self, name, now=None):
+        """Marks a file as recently used for LRU eviction."""
+        now = time.time() if now is None else now
+        with self._connect() as conn:
+            conn.execute("UPDATE files SET accessed = ? WHERE name = ?", (now, name))
+
+    def content_hash(self, name):
+        with self._connect() as conn:
+            row = conn.execute("SELECT sha256 FROM files WHERE name = ?", (name,)).fetchone()
+            return row[0] if row else None
+
+    def session_of(self, name):
+        with self._connect() as conn:
+            row = conn.execute("SELECT session FROM files WHERE name = ?", (name,)).fetchone()
+            return row[0] if row else None
+
+    def usage(self, session=None):
+        """Returns (file_count, total_bytes), globally or for one session."""
+        scope = '' if session is None else f'session:{session}'
+        with self._connect() as conn:
+            row = conn.execute("SELECT files, bytes FROM usage WHERE scope = ?", (scope,)).fetchone()
+            return tuple(row) if row else (0, 0)
+
+    def least_recent(self, session=None, limit=16):
+        """Returns [(name, size, sha256)] in LRU order, globally or for one session."""
+        with self._connect() as conn:
+            if session is None:
+                return conn.execute(
+                    "SELECT name, size, sha256 FROM files ORDER BY accessed LIMIT ?", (limit,)
+                ).fetchall()
+            return conn.execute(
+                "SELECT name, size, sha256 FROM files WHERE session = ? ORDER BY accessed LIMIT ?",
+                (session, limit)
+            ).fetchall()
+
+    def tier_bytes(self, tier):
+        with self._connect() as conn:
+            return conn.execute("SELECT COALESCE(SUM(size), 0) FROM files WHERE tier = ?", (tier,)).fetchone()[0]
+
+    def least_recent_in_tier(self, tier, limit=16):
+        """Returns [(name, size)] of the files in a storage tier, in LRU order."""
+        with self._connect() as conn:
+            return conn.execute(
+                "SELECT name, size FROM files WHERE tier = ? ORDER BY accessed LIMIT ?", (tier, limit)
+            ).fetchall()
+
+    def set_tier(self, name, tier):
+        with self._connect() as conn:
+            conn.execute("UPDATE files SET tier = ? WHERE name = ?", (tier, name))
+
+    def claim(self, name):
+        """Removes name from the index. Returns True if this caller removed it."""
+        with self._connect() as conn:
+            return conn.execute("DELETE FROM files WHERE name = ?", (name,)).rowcount == 1
+
+    def remove(self, name):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM files WHERE name = ?", (name,))
+
+    def due(self, now, limit=500):
+        """Returns [(name, size, sha256)] of files expired at `now`, oldest first."""
+        with self._connect() as conn:
+            return conn.execute(
+                "SELECT name, size, sha256 FROM files WHERE expires_at <= ? ORDER BY expires_at LIMIT ?",
+                (now, limit)
+            ).fetchall()
+
+    def claim_expired(self, name, now):
+        """
+        Removes name from the index if it is still expired. Returns True if the
+        caller now owns the deletion (the file was not refreshed in between).
+        """
+        with self._connect() as conn:
+            cur = conn.execute("DELETE FROM files WHERE name = ? AND expires_at <= ?", (name, now))
+            return cur.rowcount == 1
+
+    def add_counters(self, **deltas):
+        with self._connect() as conn:
+            for name, delta in deltas.items():
+                conn.execute(
+                    "INSERT INTO counters (name, value) VALUES (?, ?) "
+                    "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+                    (name, delta)
+                )
+
+    def counters(self):
+        with self._connect() as conn:
+            return dict(conn.execute("SELECT name, value FROM counters").fetchall())
+
+    def variant_hit(self, key, now=None):
+        """Returns the format of a cached variant and refreshes its LRU position, or None."""
+        now = time.time() if now is None else now
+        with self._connect() as conn:
+            row = conn.execute("SELECT format FROM variants WHERE key = ?", (key,)).fetchone()
+            if row:
+                conn.execute("UPDATE variants SET accessed = ? WHERE key = ?", (now, key))
+            return row[0] if row else None
+
+    def add_variant(self, key, source, fmt, size, now=None):
+        now = time.time() if now is None else now
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO variants (key, source, format, size, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, source, fmt, size, now)
+            )
+
+    def remove_variants(self, source=None, key=None):
+        """Removes variants of a source (or a single key). Returns the removed keys."""
+        with self._connect() as conn:
+            column, value = ('source', source) if key is None else ('key', key)
+            keys = [row[0] for row in conn.execute(f"SELECT key FROM variants WHERE {column} = ?", (value,))]
+            conn.execute(f"DELETE FROM variants WHERE {column} = ?", (value,))
+            return keys
+
+    def variant_bytes(self):
+        with self._connect() as conn:
+            return conn.execute("SELECT COALESCE(SUM(size), 0) FROM variants").fetchone()[0]
+
+    def least_recent_variants(self, limit=16):
+        """Returns [(key, size)] of cached variants in LRU order."""
+        with self._connect() as conn:
+            return conn.execute(
+                "SELECT key, size FROM variants ORDER BY accessed LIMIT ?", (limit,)
+            ).fetchall()
+
+    def save_metrics(self, key, pid, data, now=None):
+        now = time.time() if now is None else now
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO metrics (key, pid, data, updated) VALUES (?, ?, ?, ?)",
+                (key, pid, data, now)
+            )
+
+    def load_metrics(self):
+        """Returns [(key, pid, data)] of every saved metrics snapshot."""
+        with self._connect() as conn:
+            return conn.execute("SELECT key, pid, data FROM metrics").fetchall()
+
+    def retire_metrics(self, key, fold):
+        """
+        Moves a snapshot into the 'retired' one, as fold(retired_data, data).
+        Atomic, so concurrent scrapes cannot count it twice.
+        """
+        with self._connect() as conn:
+            row = conn.execute("DELETE FROM metrics WHERE key = ? RETURNING data", (key,)).fetchone()
+            if row is None:
+                return
+            retired = conn.execute("SELECT data FROM metrics WHERE key = 'retired'").fetchone()
+            conn.execute(
+                "INSERT OR REPLACE INTO metrics (key, pid, data, updated) VALUES ('retired', 0, ?, ?)",
+                (fold(retired[0] if retired else None, row[0]), time.time())
+            )
+
+    # --- Batches ---
+    # Batch rows whose file left the index (deleted, expired, evicted) are
+    # hidden by joining on files, so reads never stat the upload folder.
+
+    def touch_batch(self, batch_id, session=None, now=None):
+        """Creates a batch, or marks an existing one as recently used."""
+        now = time.time() if now is None else now
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO batches (id, session, updated) VALUES (?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET updated = excluded.updated",
+                (batch_id, session, now)
+            )
+
+    def add_batch_files(self, batch_id, entries, limit=None):
+        """
+        Appends entries (dicts with BATCH_COLUMNS, lineage as JSON text) to a
+        batch in one transaction. Returns False, adding nothing, if the batch
+        would then hold more than limit live files.
+        """
+        with self._connect() as conn:
+            if limit is not None and self._batch_count(conn, batch_id) + len(entries) > limit:
+                return False
+            start = conn.execute(
+                "SELECT COALESCE(MAX(position), -1) + 1 FROM batch_files WHERE batch_id = ?", (batch_id,)
+            ).fetchone()[0]
+            conn.executemany(
+                f"INSERT INTO batch_files (batch_id, position, {', '.join(BATCH_COLUMNS)}) "
+                f"VALUES (?, ?, {', '.join('?' * len(BATCH_COLUMNS))})",
+                [(batch_id, start + i, *(entry[c] for c in BATCH_COLUMNS)) for i, entry in enumerate(entries)]
+            )
+            conn.execute("UPDATE batches SET updated = ? WHERE id = ?", (time.time(), batch_id))
+            return True
+
+    @staticmethod
+    def _batch_count(conn, batch_id):
+        return conn.execute(
+            "SELECT COUNT(*) FROM batch_files b JOIN files f ON f.name = b.name WHERE b.batch_id = ?", (batch_id,)
+        ).fetchone()[0]
+
+    def batch_count(self, batch_id):
+        """Returns the number of live files in a batch."""
+        with self._connect() as conn:
+            return self._batch_count(conn, batch_id)
+
+    def batch_files(self, batch_id, offset=0, limit=-1, names=None):
+        """
+        Returns the live files of a batch in upload order, as dicts of
+        BATCH_COLUMNS, optionally only those in names.
+        """
+        columns = ', '.join(f'b.{c}' for c in BATCH_COLUMNS)
+        where, params = "b.batch_id = ?", [batch_id]
+        if names is not None:
+            where += f" AND b.name IN ({', '.join('?' * len(names))})"
+            params += list(names)
+        with self._connect() as conn:
+            rows = conn.execute(
+                f"SELECT {columns} FROM batch_files b JOIN files f ON f.name = b.name "
+                f"WHERE {where} ORDER BY b.position LIMIT ? OFFSET ?",
+                (*params, limit, offset)
+            ).fetchall()
+        return [dict(zip(BATCH_COLUMNS, row)) for row in rows]
+
+    def batch_names(self, batch_id):
+        with self._connect() as conn:
+            return [row[0] for row in conn.execute(
+                "SELECT b.name FROM batch_files b JOIN files f ON f.name = b.name "
+                "WHERE b.batch_id = ? ORDER BY b.position", (batch_id,)
+            )]
+
+    def batch_versions(self, batch_id):
+        """Returns [(name, version)] of the live files of a batch, in upload order."""
+        with self._connect() as conn:
+            return [tuple(row) for row in conn.execute(
+                "SELECT b.name, b.version FROM batch_files b JOIN files f ON f.name = b.name "
+                "WHERE b.batch_id = ? ORDER BY b.position", (batch_id,)
+            )]
+
+    def batch_has_format(self, batch_id, fmt):
+        with self._connect() as conn:
+            return conn.execute(
+                "SELECT EXISTS (SELECT 1 FROM batch_files b JOIN files f ON f.name = b.name "
+                "WHERE b.batch_id = ? AND b.format = ?)", (batch_id, fmt)
+            ).fetchone()[0] == 1
+
+    def update_batch_files(self, batch_id, updates, now=None):
+        """
+        Applies the results of a batch operation in one transaction.
+        updates maps an old name to a dict with the new BATCH_COLUMNS values
+        (lineage included) and bumps its version. Rows of files no longer
+        indexed are dropped.
+        """
+        now = time.time() if now is None else now
+        assignments = ', '.join(f'{c} = ?' for c in BATCH_COLUMNS if c != 'origin')
+        with self._connect() as conn:
+            conn.executemany(
+                f"UPDATE batch_files SET {assignments}, version = version + 1 WHERE batch_id = ? AND name = ?",
+                [(*(entry[c] for c in BATCH_COLUMNS if c != 'origin'), batch_id, old)
+                 for old, entry in updates.items()]
+            )
+            conn.execute(
+                "DELETE FROM batch_files WHERE batch_id = ? AND name NOT IN (SELECT name FROM files)", (batch_id,)
+            )
+            conn.execute("UPDATE batches SET updated = ? WHERE id = ?", (now, batch_id))
+
+    def remove_batch_file(self, batch_id, name):
+        """Removes a file from a batch. Returns True if it was in the batch."""
+        with self._connect() as conn:
+            cur = conn.execute("DELETE FROM batch_files WHERE batch_id = ? AND name = ?", (batch_id, name))
+            return cur.rowcount > 0
+
+    def drop_batch(self, batch_id):
+        """Deletes a batch. Returns the names of its files."""
+        with self._connect() as conn:
+            names = [row[0] for row in conn.execute(
+                "DELETE FROM batch_files WHERE batch_id = ? RETURNING name", (batch_id,)
+            )]
+            conn.execute("DELETE FROM batches WHERE id = ?", (batch_id,))
+            conn.execute("DELETE FROM batch_exif WHERE batch_id = ?", (batch_id,))
+            return names
+
+    def prune_batches(self, idle_before):
+        """Deletes rows of files no longer indexed, then empty batches idle since idle_before."""
+        with self._connect() as conn:
+            conn.execute("DELETE FROM batch_files WHERE name NOT IN (SELECT name FROM files)")
+            conn.execute(
+                "DELETE FROM batches WHERE updated < ? AND id NOT IN (SELECT batch_id FROM batch_files)",
+                (idle_before,)
+            )
+            conn.execute("DELETE FROM batch_exif WHERE batch_id NOT IN (SELECT id FROM batches)")
+
+    def batch_exif(self, batch_id):
+        """Returns (signature, data) of a batch's saved EXIF index, or None."""
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT signature, data FROM batch_exif WHERE batch_id = ?", (batch_id,)
+            ).fetchone()
+            return tuple(row) if row else None
+
+    def save_batch_exif(self, batch_id, signature, data):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO batch_exif (batch_id, signature, data) VALUES (?, ?, ?)",
+                (batch_id, signature, data)
+            )
+
+    def rebuild(self, storage, max_age_seconds):
+        """
+        Reconciles the index with the files in storage. Runs once at startup:
+        unknown files are indexed by mtime, entries for missing files dropped.
+        """
+        on_disk = {}
+        for name, tier, st in storage.scan():
+            # A file in both tiers is served from memory
+            on_disk.setdefault(name, (st.st_size, st.st_mtime + max_age_seconds, tier))
+
+        with self._connect() as conn:
+            known = {row[0] for row in conn.execute("SELECT name FROM files")}
+            conn.executemany(
+                "DELETE FROM files WHERE name = ?",
+                [(name,) for name in known - on_disk.keys()]
+            )
+            conn.executemany(
+                "UPDATE files SET tier = ? WHERE name = ?",
+                [(tier, name) for name, (_, _, tier) in on_disk.items() if name in known]
+            )
+            conn.executemany(
+                "INSERT INTO files (name, size, expires_at, accessed, tier) VALUES (?, ?, ?, ?, ?)",
+                [(name, size, expires, expires - max_age_seconds, tier)
+                 for name, (size, expires, tier) in on_disk.items() if name not in known]
+            )
@@ -0,0 +1,142 @@
+import time
+import logging
+import threading
+from app.services.file_index import FileIndex
+from app.services.content_store import ContentStore
+from app.services.storage import Storage
+from app.services.variant_cache import VariantCache
+
+try:
+    import fcntl
+except ImportError:  # Windows: every process reaps, deletions are idempotent
+    fcntl = None
+
+
+logger = logging.getLogger(__name__)
+
+_started = set()
+_started_lock = threading.Lock()
+
+
+def acquire_leadership(lock_path):
+    """
+    Returns an open lock file if this process holds the host-wide lock at
+    lock_path, else None. Used by every background loop that must run once
+    per host (the FileReaper, the JobRunner).
+    """
+    f = open(lock_path, 'a')
+    if fcntl is None:
+        return f
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return f  # Held until the process exits
+    except OSError:
+        f.close()
+        return None
+
+
+class FileReaper:
+    """
+    Background thread deleting expired uploads from the FileIndex, and
+    temporary files abandoned by crashed workers.
+    Every worker process starts one, but only the holder of a host-wide
+    file lock does the work, so reaping runs once per host.
+    """
+
+    @staticmethod
+    def init_app(app):
+        if not app.config.get('REAPER_ENABLED', True):
+            return
+        storage = Storage.get(app.config)
+        db_path = app.config['INDEX_DB_PATH']
+        blob_folder = app.config['BLOB_FOLDER']
+        variant_folder = app.config['VARIANT_FOLDER']
+        with _started_lock:
+            if (storage.root, db_path) in _started:
+                return
+            _started.add((storage.root, db_path))
+
+        thread = threading.Thread(
+            target=FileReaper._run,
+            args=(
+                storage,
+                db_path,
+                blob_folder,
+                variant_folder,
+                app.config.get('MAX_FILE_AGE_SECONDS', 3600),
+                app.config.get('REAPER_INTERVAL_SECONDS', 30),
+            ),
+            name='picturify-reaper',
+            daemon=True
+        )
+        thread.start()
+
+    @staticmethod
+    def _run(storage, db_path, blob_folder, variant_folder, max_age_seconds, interval):
+        index = FileIndex.get(db_path)
+        lock_file = None
+        while True:
+            try:
+                if lock_file is None:
+                    lock_file = acquire_leadership(db_path + '.reaper.lock')
+                    if lock_file is not None:
+                        # New leader: reconcile once with what is actually on disk
+                        index.rebuild(storage, max_age_seconds)
+                        ContentStore.collect(blob_folder)
+                if lock_file is not None:
+                    FileReaper.reap(storage, index, blob_folder, variant_folder)
+                    FileReaper.sweep(storage, index, max_age_seconds)
+                    index.prune_batches(time.time() - max_age_seconds)
+            except Exception as e:
+                logger.error(f"Error during cleanup: {e}")
+            time.sleep(interval)
+
+    @staticmethod
+    def reap(storage, index, blob_folder=None, variant_folder=None, now=None):
+        """
+        Deletes every indexed file whose expiry time has passed, with its
+        cached variants when variant_folder is given.
+        Returns (files_reclaimed, bytes_reclaimed).
+        """
+        now = time.time() if now is None else now
+        files = 0
+        reclaimed = 0
+        while True:
+            due = index.due(now)
+            if not due:
+                break
+            for name, size, content_hash in due:
+                if not index.claim_expired(name, now):
+                    continue  # Refreshed since the query
+                source = None
+                try:
+                    if variant_folder:
+                        source = VariantCache.source_key(storage.path(name), content_hash)
+                    if storage.remove(name):
+                        files += 1
+                        reclaimed += size
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    logger.error(f"Error removing expired file {name}: {e}")
+                released = bool(blob_folder) and ContentStore.release(content_hash, blob_folder)
+                # Content-addressed variants stay valid while another upload shares the blob
+                if source and (content_hash is None or released):
+                    try:
+                        VariantCache.invalidate(source, index, variant_folder)
+                    except Exception as e:
+                        logger.error(f"Error invalidating variants of {name}: {e}")
+        if files:
+            index.add_counters(files_reclaimed=files, bytes_reclaimed=reclaimed)
+        return files, reclaimed
+
+    @staticmethod
+    def sweep(storage, index, max_age_seconds, now=None):
+        """
+        Deletes temporary files older than max_age_seconds (see
+        Storage.sweep_hidden). Returns (files_reclaimed, bytes_reclaimed).
+        """
+        files, reclaimed = storage.sweep_hidden(max_age_seconds, now)
+        if files:
+            index.add_counters(files_reclaimed=files, bytes_reclaimed=reclaimed)
+        return files, reclaimed
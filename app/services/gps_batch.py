@@ -0,0 +1,269 @@
+import io
+import csv
+import json
+import math
+import random
+import logging
+from array import array
+import piexif
+from app.services.exif_manager import ExifManager
+
+try:
+    import numpy as np
+except ImportError:  # Optional: the pure Python path gives the same results
+    np = None
+
+
+logger = logging.getLogger(__name__)
+
+# Metres per degree of latitude (and of longitude at the equator)
+METERS_PER_DEGREE = 111320.0
+
+# Denominator of the seconds rational written back to GPS IFDs (1/10000")
+SECONDS_PRECISION = 10000
+
+EXPORT_FORMATS = ('geojson', 'csv')
+
+NO_DMS = (0, 0, 0, 0, 0, 0)
+
+
+class GpsBatch:
+    """
+    GPS coordinates of many files as flat columns: read in one pass over
+    the files' EXIF, converted from rationals to degrees (and back) for the
+    whole batch at once, with NumPy when it is installed.
+    Columns are array('d') with NaN for files without a position.
+    """
+
+    def __init__(self, names, lat, lon, alt):
+        self.names = names
+        self.lat = lat
+        self.lon = lon
+        self.alt = alt
+
+    @staticmethod
+    def read(names, paths):
+        """Reads the GPS IFD of every file and converts all coordinates at once."""
+        return GpsBatch.collect(zip(names, paths))
+
+    @staticmethod
+    def collect(files):
+        """
+        Reads (name, path) pairs as they are produced, so each path only has
+        to exist until the next pair is requested (e.g. streamed uploads).
+        Raw rationals are gathered first and converted in one pass at the end.
+        """
+        names = []
+        # Six integers per coordinate: degrees, minutes, seconds as num/den
+        lat_rationals, lon_rationals, alt_rationals = array('q'), array('q'), array('q')
+        lat_signs, lon_signs, alt_signs = array('d'), array('d'), array('d')
+
+        for name, path in files:
+            names.append(name)
+            try:
+                gps = GpsBatch._read_gps(path)
+            except Exception as e:
+                logger.error(f"Error reading GPS of {name}: {e}")
+                gps = {}
+            lat, lat_ref = gps.get(piexif.GPSIFD.GPSLatitude), gps.get(piexif.GPSIFD.GPSLatitudeRef)
+            lon, lon_ref = gps.get(piexif.GPSIFD.GPSLongitude), gps.get(piexif.GPSIFD.GPSLongitudeRef)
+            if GpsBatch._is_dms(lat) and GpsBatch._is_dms(lon) and lat_ref and lon_ref:
+                lat_rationals.extend(v for pair in lat for v in pair)
+                lon_rationals.extend(v for pair in lon for v in pair)
+                lat_signs.append(-1.0 if lat_ref in (b'S', 'S') else 1.0)
+                lon_signs.append(-1.0 if lon_ref in (b'W', 'W') else 1.0)
+            else:
+                # Zero denominators convert to NaN
+                lat_rationals.extend(NO_DMS)
+                lon_rationals.extend(NO_DMS)
+                lat_signs.append(math.nan)
+                lon_signs.append(math.nan)
+            alt = gps.get(piexif.GPSIFD.GPSAltitude)
+            if isinstance(alt, tuple) and len(alt) == 2:
+                alt_rationals.extend(alt)
+                alt_signs.append(-1.0 if gps.get(piexif.GPSIFD.GPSAltitudeRef) == 1 else 1.0)
+            else:
+                alt_rationals.extend((0, 0))
+                alt_signs.append(1.0)
+
+        return GpsBatch(
+            names,
+            GpsBatch.to_degrees(lat_rationals, lat_signs),
+            GpsBatch.to_degrees(lon_rationals, lon_signs),
+            GpsBatch._divide(alt_rationals, alt_signs),
+        )
+
+    @staticmethod
+    def _read_gps(path):
+        exif_bytes = ExifManager.load_exif_bytes(path, 'read_gps')
+        if not exif_bytes:
+            return {}
+        return piexif.load(exif_bytes).get('GPS') or {}
+
+    @staticmethod
+    def _is_dms(value):
+        return (isinstance(value, tuple) and len(value) == 3
+                and all(isinstance(pair, tuple) and len(pair) == 2 for pair in value))
+
+    # --- Vectorized conversions ---
+
+    @staticmethod
+    def to_degrees(rationals, signs):
+        """
+        Converts flat (d_num, d_den, m_num, m_den, s_num, s_den) rationals to
+        signed decimal degrees. Zero denominators give NaN.
+        """
+        if np is not None:
+            r = np.frombuffer(rationals, dtype=np.int64).reshape(-1, 3, 2).astype(np.float64)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                dms = np.where(r[..., 1] != 0, r[..., 0] / r[..., 1], np.nan)
+            degrees = (dms @ np.array([1.0, 1 / 60.0, 1 / 3600.0])) * np.frombuffer(signs, dtype=np.float64)
+            return array('d', degrees.tobytes())
+
+        degrees = array('d', [math.nan]) * len(signs)
+        for i, sign in enumerate(signs):
+            d_num, d_den, m_num, m_den, s_num, s_den = rationals[6 * i:6 * i + 6]
+            if d_den and m_den and s_den:
+                degrees[i] = sign * (d_num / d_den + m_num / m_den / 60.0 + s_num / s_den / 3600.0)
+        return degrees
+
+    @staticmethod
+    def _divide(rationals, signs):
+        if np is not None:
+            r = np.frombuffer(rationals, dtype=np.int64).reshape(-1, 2).astype(np.float64)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                values = np.where(r[:, 1] != 0, r[:, 0] / r[:, 1], np.nan) * np.frombuffer(signs, dtype=np.float64)
+            return array('d', values.tobytes())
+        return array('d', (
+            sign * rationals[2 * i] / rationals[2 * i + 1] if rationals[2 * i + 1] else math.nan
+            for i, sign in enumerate(signs)
+        ))
+
+    @staticmethod
+    def to_rationals(degrees):
+        """
+        Converts degrees to [((d, 1), (m, 1), (s, SECONDS_PRECISION))], the
+        GPS IFD encoding (the sign goes in the Ref tag). NaN gives None.
+        """
+        if np is not None:
+            values = np.abs(np.frombuffer(degrees, dtype=np.float64))
+            valid = ~np.isnan(values)
+            units = np.rint(np.where(valid, values, 0) * 3600 * SECONDS_PRECISION).astype(np.int64)
+            d, rest = np.divmod(units, 3600 * SECONDS_PRECISION)
+            m, s = np.divmod(rest, 60 * SECONDS_PRECISION)
+            return [((int(d[i]), 1), (int(m[i]), 1), (int(s[i]), SECONDS_PRECISION)) if valid[i] else None
+                    for i in range(len(values))]
+
+        result = []
+        for value in degrees:
+            if math.isnan(value):
+                result.append(None)
+                continue
+            # Whole units of 1/SECONDS_PRECISION arc-second: no 60" carry issues
+            units = round(abs(value) * 3600 * SECONDS_PRECISION)
+            d, rest = divmod(units, 3600 * SECONDS_PRECISION)
+            m, s = divmod(rest, 60 * SECONDS_PRECISION)
+            result.append(((d, 1), (m, 1), (s, SECONDS_PRECISION)))
+        return result
+
+    # --- Coarsening ---
+
+    def snap(self, grid_degrees):
+        """Snaps every position to the nearest point of a grid_degrees grid."""
+        if grid_degrees <= 0:
+            raise ValueError("Grid size must be positive")
+        if np is not None:
+            lat = np.frombuffer(self.lat, dtype=np.float64)
+            lon = np.frombuffer(self.lon, dtype=np.float64)
+            self.lat = array('d', np.clip(np.round(lat / grid_degrees) * grid_degrees, -90, 90).tobytes())
+            self.lon = array('d', GpsBatch._wrap(np.round(lon / grid_degrees) * grid_degrees).tobytes())
+            return self
+        self.lat = array('d', (v if math.isnan(v) else max(-90.0, min(90.0, round(v / grid_degrees) * grid_degrees))
+                               for v in self.lat))
+        self.lon = array('d', (v if math.isnan(v) else GpsBatch._wrap(round(v / grid_degrees) * grid_degrees)
+                               for v in self.lon))
+        return self
+
+    def jitter(self, meters, rng=None):
+        """
+        Moves every position to a uniformly random point within meters of it.
+        Uses OS entropy unless rng (a random.Random) is given.
+        """
+        count = len(self.names)
+        if np is not None:
+            if rng is None:
+                generator = np.random.default_rng()  # Seeded from OS entropy
+                u, v = generator.random(count), generator.random(count)
+            else:
+                u, v = np.array([rng.random() for _ in range(count)]), np.array([rng.random() for _ in range(count)])
+            # Uniform over the disc: radius grows with the square root
+            r, a = meters * np.sqrt(u), 2 * np.pi * v
+            lat = np.frombuffer(self.lat, dtype=np.float64)
+            lon = np.frombuffer(self.lon, dtype=np.float64)
+            d_lat = r * np.cos(a) / METERS_PER_DEGREE
+            d_lon = r * np.sin(a) / (METERS_PER_DEGREE * np.maximum(np.cos(np.radians(lat)), 1e-6))
+            self.lat = array('d', np.clip(lat + d_lat, -90, 90).tobytes())
+            self.lon = array('d', GpsBatch._wrap(lon + d_lon).tobytes())
+            return self
+
+        rng = rng or random.SystemRandom()
+        radius = [meters * math.sqrt(rng.random()) for _ in range(count)]
+        angle = [2 * math.pi * rng.random() for _ in range(count)]
+        lat_out, lon_out = array('d'), array('d')
+        for lat, lon, r, a in zip(self.lat, self.lon, radius, angle):
+            d_lat = r * math.cos(a) / METERS_PER_DEGREE
+            d_lon = r * math.sin(a) / (METERS_PER_DEGREE * max(math.cos(math.radians(lat)), 1e-6)) \
+                if not math.isnan(lat) else math.nan
+            lat_out.append(max(-90.0, min(90.0, lat + d_lat)) if not math.isnan(lat) else lat)
+            lon_out.append(GpsBatch._wrap(lon + d_lon))
+        self.lat, self.lon = lat_out, lon_out
+        return self
+
+    @staticmethod
+    def _wrap(lon):
+        """Wraps longitudes into [-180, 180)."""
+        return (lon + 180.0) % 360.0 - 180.0
+
+    def gps_ifds(self):
+        """Returns the GPS fields to write for each file ({} for files without a position)."""
+        lat_rationals = GpsBatch.to_rationals(self.lat)
+        lon_rationals = GpsBatch.to_rationals(self.lon)
+        ifds = []
+        for lat, lon, lat_dms, lon_dms in zip(self.lat, self.lon, lat_rationals, lon_rationals):
+            if lat_dms is None or lon_dms is None:
+                ifds.append({})
+                continue
+            ifds.append({
+                piexif.GPSIFD.GPSLatitudeRef: b'S' if lat < 0 else b'N',
+                piexif.GPSIFD.GPSLatitude: lat_dms,
+                piexif.GPSIFD.GPSLongitudeRef: b'W' if lon < 0 else b'E',
+                piexif.GPSIFD.GPSLongitude: lon_dms,
+            })
+        return ifds
+
+    # --- Export ---
+
+    def located(self):
+        """Yields (name, lat, lon, alt) of the files with a position; alt is None if unknown."""
+        for name, lat, lon, alt in zip(self.names, self.lat, self.lon, self.alt):
+            if not (math.isnan(lat) or math.isnan(lon)):
+                yield name, lat, lon, None if math.isnan(alt) else alt
+
+    def to_geojson(self):
+        features = []
+        for name, lat, lon, alt in self.located():
+            coordinates = [round(lon, 7), round(lat, 7)] + ([round(alt, 2)] if alt is not None else [])
+            features.append({
+                'type': 'Feature',
+                'geometry': {'type': 'Point', 'coordinates': coordinates},
+                'properties': {'filename': name},
+            })
+        return json.dumps({'type': 'FeatureCollection', 'features': features})
+
+    def to_csv(self):
+        out = io.StringIO()
+        writer = csv.writer(out)
+        writer.writerow(['filename', 'latitude', 'longitude', 'altitude'])
+        for name, lat, lon, alt in self.located():
+            writer.writerow([name, f'{lat:.7f}', f'{lon:.7f}', '' if alt is None else f'{alt:.2f}'])
+        return out.getvalue()
@@ -0,0 +1,309 @@
+import os
+import shutil
+import logging
+import pillow_heif
+from PIL import Image
+from app.services.segment_editor import SegmentEditor, EXIF_HEADER, COPY_CHUNK_SIZE, MAX_METADATA_BYTES
+from app.services.ingest import sniff_format
+
+
+logger = logging.getLogger(__name__)
+
+# Pool workers import this module without ImageHandler
+pillow_heif.register_heif_opener()
+
+# Payload of a blanked Exif item: TIFF header offset, then an empty big-endian IFD0
+EMPTY_EXIF_ITEM = b'\x00\x00\x00\x06' + EXIF_HEADER + b'MM\x00*\x00\x00\x00\x08' + b'\x00\x00' + b'\x00\x00\x00\x00'
+
+# Payload of a blanked XMP item
+EMPTY_XMP = b'<x:xmpmeta xmlns:x="adobe:ns:meta/"/>'
+
+XMP_CONTENT_TYPE = b'application/rdf+xml'
+
+# Extensions and Pillow formats of the explicit transcode targets
+TRANSCODE_FORMATS = {'JPEG': 'jpg', 'PNG': 'png', 'WEBP': 'webp'}
+
+
+class HeifEditor:
+    """
+    Metadata of HEIC/HEIF files, kept in their container.
+    EXIF is read with pillow-heif without decoding the image. Exif and XMP
+    items are rewritten in the file's item boxes (meta/iloc/iinf); the HEVC
+    data is copied byte for byte. Like SegmentEditor, methods raise
+    ValueError for files they cannot handle so callers can fall back to Pillow.
+    """
+
+    @staticmethod
+    def is_heif(path):
+        with open(path, 'rb') as f:
+            return sniff_format(f.read(32)) == 'HEIF'
+
+    @staticmethod
+    def read_exif(source_path):
+        """Returns the raw EXIF block (starting with Exif\\0\\0) of a HEIF file, or None."""
+        if not HeifEditor.is_heif(source_path):
+            raise ValueError("Not a HEIF file")
+        exif = pillow_heif.open_heif(source_path).info.get('exif')
+        if not exif or exif == EMPTY_EXIF_ITEM[4:]:
+            return None
+        return exif
+
+    @staticmethod
+    def strip(source_path, dest_path, xmp=True):
+        """
+        Copies a HEIF file to dest_path with its Exif (and XMP) items blanked:
+        old bytes are zeroed and the items hold an empty EXIF/XMP block.
+        """
+        return HeifEditor._rewrite(source_path, dest_path, None, xmp)
+
+    @staticmethod
+    def replace_exif(source_path, dest_path, exif_bytes):
+        """
+        Copies a HEIF file to dest_path with exif_bytes as its Exif item
+        (blanked if exif_bytes is None). A block larger than the old one is
+        appended in a new mdat box. Files without an Exif item raise ValueError.
+        """
+        return HeifEditor._rewrite(source_path, dest_path, exif_bytes, False)
+
+    @staticmethod
+    def _rewrite(source_path, dest_path, exif_bytes, xmp):
+        if not HeifEditor.is_heif(source_path):
+            raise ValueError("Not a HEIF file")
+        with open(source_path, 'rb') as src:
+            items, file_size = HeifEditor._read_items(src)
+            exif_items = [item for item in items if item['type'] == b'Exif']
+            if exif_bytes is not None and not exif_items:
+                raise ValueError("HEIF file has no Exif item")
+
+            if exif_bytes is None:
+                payload = EMPTY_EXIF_ITEM
+            elif exif_bytes.startswith(EXIF_HEADER):
+                payload = len(EXIF_HEADER).to_bytes(4, 'big') + exif_bytes
+            else:
+                payload = b'\x00\x00\x00\x00' + exif_bytes
+
+            patches = [(item, payload) for item in exif_items]
+            if xmp:
+                patches += [(item, EMPTY_XMP) for item in items if item['content_type'] == XMP_CONTENT_TYPE]
+
+            src.seek(0)
+            with SegmentEditor.atomic_output(dest_path) as dst:
+                shutil.copyfileobj(src, dst, COPY_CHUNK_SIZE)
+                end = file_size
+                for item, data in patches:
+                    end = HeifEditor._patch_item(dst, item, data, end)
+        return dest_path
+
+    @staticmethod
+    def _patch_item(f, item, data, end):
+        """
+        Writes data as the payload of item in the open copy f, zeroing the old
+        bytes. Returns the new end of file.
+        """
+        if len(item['extents']) != 1:
+            raise ValueError("Fragmented HEIF metadata item")
+        extent = item['extents'][0]
+        if extent['length'] == 0:
+            raise ValueError("HEIF item extends to end of file")
+
+        f.seek(extent['position'])
+        f.write(b'\x00' * extent['length'])
+
+        if len(data) <= extent['length']:
+            f.seek(extent['position'])
+            f.write(data)
+            HeifEditor._write_field(f, extent['length_field'], len(data))
+            return end
+
+        # Does not fit: append in a new mdat box and point the extent at it
+        if item['construction_method'] != 0 or extent['offset_field'] is None:
+            raise ValueError("HEIF item cannot be relocated")
+        f.seek(end)
+        f.write((len(data) + 8).to_bytes(4, 'big') + b'mdat' + data)
+        HeifEditor._write_field(f, extent['offset_field'], end + 8 - item['base_offset'])
+        HeifEditor._write_field(f, extent['length_field'], len(data))
+        return end + 8 + len(data)
+
+    @staticmethod
+    def _write_field(f, field, value):
+        position, size = field
+        if size == 0 or value >= 1 << (8 * size):
+            raise ValueError("Value does not fit the iloc field")
+        f.seek(position)
+        f.write(value.to_bytes(size, 'big'))
+
+    # --- ISOBMFF parsing ---
+
+    @staticmethod
+    def _iter_boxes(f, start, end):
+        """Yields (type, payload_start, box_end) of the boxes between start and end."""
+        position = start
+        while position + 8 <= end:
+            f.seek(position)
+            header = f.read(8)
+            size = int.from_bytes(header[:4], 'big')
+            payload = position + 8
+            if size == 1:
+                size = int.from_bytes(f.read(8), 'big')
+                payload += 8
+            elif size == 0:
+                size = end - position
+            if size < payload - position or position + size > end:
+                raise ValueError("Malformed HEIF box")
+            yield header[4:], payload, position + size
+            position += size
+
+    @staticmethod
+    def _read_items(f):
+        """
+        Returns ([item], file_size) where each item is a dict with its type,
+        content_type and extents (absolute positions, and where the iloc
+        offset and length fields of each extent are).
+        """
+        f.seek(0, os.SEEK_END)
+        file_size = f.tell()
+
+        meta = None
+        for box_type, payload, box_end in HeifEditor._iter_boxes(f, 0, file_size):
+            if box_type == b'meta':
+                meta = (payload + 4, box_end)  # FullBox: skip version and flags
+                break
+        if meta is None:
+            raise ValueError("HEIF file has no meta box")
+        if meta[1] - meta[0] > MAX_METADATA_BYTES:
+            raise ValueError("HEIF meta box too large")
+
+        boxes = {}
+        for box_type, payload, box_end in HeifEditor._iter_boxes(f, *meta):
+            boxes.setdefault(box_type, (payload, box_end))
+        if b'iloc' not in boxes or b'iinf' not in boxes:
+            raise ValueError("HEIF file has no item boxes")
+
+        types = HeifEditor._read_iinf(f, *boxes[b'iinf'])
+        idat_start = boxes[b'idat'][0] if b'idat' in boxes else None
+        items = HeifEditor._read_iloc(f, *boxes[b'iloc'], idat_start)
+        for item in items:
+            item['type'], item['content_type'] = types.get(item['id'], (None, None))
+        return items, file_size
+
+    @staticmethod
+    def _read_iinf(f, start, end):
+        """Returns {item_id: (item_type, content_type)}."""
+        f.seek(start)
+        version = f.read(4)[0]
+        f.read(2 if version == 0 else 4)  # entry_count
+        types = {}
+        for box_type, payload, box_end in HeifEditor._iter_boxes(f, f.tell(), end):
+            if box_type != b'infe':
+                continue
+            f.seek(payload)
+            data = f.read(box_end - payload)
+            version = data[0]
+            if version < 2:
+                continue  # No item types before version 2
+            id_size = 2 if version == 2 else 4
+            item_id = int.from_bytes(data[4:4 + id_size], 'big')
+            item_type = data[6 + id_size:10 + id_size]
+            content_type = None
+            if item_type == b'mime':
+                # item_name and content_type are null-terminated strings
+                fields = data[10 + id_size:].split(b'\x00')
+                content_type = fields[1] if len(fields) > 1 else None
+            types[item_id] = (item_type, content_type)
+        return types
+
+    @staticmethod
+    def _read_iloc(f, start, end, idat_start):
+        f.seek(start)
+        data = f.read(end - start)
+
+        def read(pos, size):
+            if pos + size > len(data):
+                raise ValueError("Truncated iloc box")
+            return int.from_bytes(data[pos:pos + size], 'big'), pos + size
+
+        version = data[0]
+        if version > 2:
+            raise ValueError("Unsupported iloc version")
+        offset_size, length_size = data[4] >> 4, data[4] & 0x0F
+        base_offset_size = data[5] >> 4
+        index_size = data[5] & 0x0F if version in (1, 2) else 0
+        pos = 6
+        item_count, pos = read(pos, 2 if version < 2 else 4)
+
+        items = []
+        for _ in range(item_count):
+            item_id, pos = read(pos, 2 if version < 2 else 4)
+            construction_method = 0
+            if version in (1, 2):
+                value, pos = read(pos, 2)
+                construction_method = value & 0x0F
+            _, pos = read(pos, 2)  # data_reference_index
+            base_offset, pos = read(pos, base_offset_size)
+            extent_count, pos = read(pos, 2)
+
+            if construction_method == 0:
+                origin = 0
+            elif construction_method == 1 and idat_start is not None:
+                origin = idat_start
+            else:
+                origin = None  # Item references: nothing stored to patch
+
+            extents = []
+            for _ in range(extent_count):
+                _, pos = read(pos, index_size)
+                offset_field = (start + pos, offset_size) if offset_size else None
+                offset, pos = read(pos, offset_size)
+                length_field = (start + pos, length_size)
+                length, pos = read(pos, length_size)
+                if origin is not None:
+                    extents.append({
+                        'position': origin + base_offset + offset,
+                        'length': length,
+                        'offset_field': offset_field,
+                        'length_field': length_field,
+                    })
+            items.append({
+                'id': item_id,
+                'construction_method': construction_method,
+                'base_offset': base_offset,
+                'extents': extents,
+            })
+        return items
+
+    # --- Transcoding ---
+
+    @staticmethod
+    def transcode(source_path, dest_path, fmt='JPEG', quality=90):
+        """
+        Decodes a HEIF file and encodes it as fmt (JPEG, PNG or WEBP) with
+        its EXIF and ICC profile. Only run on explicit request: this is a
+        full HEVC decode.
+        """
+        fmt = fmt.upper()
+        if fmt not in TRANSCODE_FORMATS:
+            raise ValueError(f"Unsupported transcode format: {fmt}")
+
+        with Image.open(source_path) as img:
+            img.load()
+            save_kwargs = {}
+            exif = img.getexif()
+            if len(exif):  # A stripped file keeps an empty block: not carried over
+                save_kwargs['exif'] = exif
+            if img.info.get('icc_profile'):
+                save_kwargs['icc_profile'] = img.info['icc_profile']
+            image = img
+            if fmt == 'JPEG' and image.mode != 'RGB':
+                image = image.convert('RGB')
+            if fmt != 'PNG':
+                save_kwargs['quality'] = quality
+            with SegmentEditor.atomic_output(dest_path) as f:
+                image.save(f, fmt, **save_kwargs)
+        return dest_path
+
+    @staticmethod
+    def transcode_path(source_path, fmt):
+        """Default destination of a transcode: converted_<name>.<ext> next to the source."""
+        dir_name, file_name = os.path.split(source_path)
+        stem = file_name.rsplit('.', 1)[0]
+        return os.path.join(dir_name, f"converted_{stem}.{TRANSCODE_FORMATS[fmt.upper()]}")
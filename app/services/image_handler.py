@@ -2,9 +2,16 @@ import os
 import uuid
 import logging
 from werkzeug.utils import secure_filename
-from flask import current_app
+from flask import session, has_request_context
 import time
 from PIL import Image
+from app.services.file_index import FileIndex
+from app.services.ingest import IngestFile, sniff_format
+from app.services.content_store import ContentStore
+from app.services.variant_cache import VariantCache
+from app.services.metrics import Metrics
+from app.services.storage import Storage
+from app.services.processing_options import ProcessingOptions
 
 
 logger = logging.getLogger(__name__)
@@ -16,152 +23,256 @@ pillow_heif.register_heif_opener()
 
 class ImageHandler:
     @staticmethod
-    def allowed_file(filename):
-        return '.' in filename and \
-               filename.rsplit('.', 1)[1].lower() in current_app.config['ALLOWED_EXTENSIONS']
+    def allowed_file(filename, options=None):
+        return ProcessingOptions.resolve(options).allowed_file(filename)
 
     @staticmethod
     def save_image(file):
         if not file or not ImageHandler.allowed_file(file.filename):
             return None
-        
-        # Basic Magic Number Check (Skipped for HEIC as imghdr doesn't support it well)
-        # We rely on PIL to verify it later
-        
-        ImageHandler.enforce_storage_limit()
-        
+
+        ImageHandler.enforce_storage_limit(ImageHandler._upload_size(file), ImageHandler.get_session_id())
+
         filename = secure_filename(file.filename)
-        ext = filename.rsplit('.', 1)[1].lower()
-        
+
         # Create a unique filename
         unique_id = uuid.uuid4().hex
-        
-        if ext in ['heic', 'heif']:
-            # Convert to JPG
-            filename = f"{filename.rsplit('.', 1)[0]}.jpg"
-            unique_filename = f"{unique_id}_{filename}"
-            file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], unique_filename)
-            
-            try:
-                # Save temp heic
-                temp_path = os.path.join(current_app.config['UPLOAD_FOLDER'], f"{unique_id}_temp.{ext}")
-                file.save(temp_path)
-                
-                with Image.open(temp_path) as img:
-                    img.convert('RGB').save(file_path, 'JPEG', quality=95)
-                
-                # Remove temp file
-                os.remove(temp_path)
-                
-            except Exception as e:
-                logger.error(f"Error converting HEIC: {e}")
-                if os.path.exists(temp_path):
-                    os.remove(temp_path)
-                return None
-        else:
-            unique_filename = f"{unique_id}_{filename}"
-            file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], unique_filename)
-            
-            try:
-                file.save(file_path)
-            except Exception as e:
-                logger.error(f"Error saving file: {e}")
-                return None
 
-        # Deep Verification using PIL
         try:
-            with Image.open(file_path) as img:
-                img.verify()
+            with Metrics.timer('save_image', 'ingest'):
+                ingest = ImageHandler._ingest(file)
         except Exception as e:
-            logger.error(f"Invalid image file (PIL verification failed): {e}")
-            if os.path.exists(file_path):
+            logger.error(f"Error saving file: {e}")
+            return None
+
+        sha256 = ingest.sha256
+        file_path = None
+        try:
+            # Magic number check on the bytes captured while the upload was written
+            fmt = sniff_format(ingest.head)
+            if ingest.size == 0 or fmt is None:
+                raise ValueError("unrecognised image data")
+
+            if fmt == 'HEIF' and filename.rsplit('.', 1)[-1].lower() not in ('heic', 'heif'):
+                # Kept as HEIF: the extension must say so
+                filename = f"{filename.rsplit('.', 1)[0]}.heic"
+            unique_filename = f"{unique_id}_{filename}"
+            # Always on disk, next to the ContentStore it is linked from
+            file_path = ImageHandler.get_storage().writable_path(unique_filename)
+
+            # Known content: link to the stored copy, no validation or conversion needed
+            with Metrics.timer('save_image', 'write'):
+                linked = ContentStore.link(sha256, file_path)
+            if not linked:
+                ImageHandler._store_new_content(ingest, fmt, sha256, file_path)
+        except Exception as e:
+            logger.error(f"Invalid image file: {e}")
+            if file_path and os.path.exists(file_path):
                 os.remove(file_path)
             return None
+        finally:
+            # Deletes the spooled upload unless it was moved into the store
+            ingest.close()
 
+        ImageHandler.register_file(unique_filename, ImageHandler.get_session_id(), sha256)
         return unique_filename
 
     @staticmethod
-    def get_path(filename):
+    def _store_new_content(ingest, fmt, sha256, file_path):
+        """Validates a first-seen upload and moves it into the content store."""
+        # Header-only parse: format and dimensions, no pixel decoding
+        ingest.seek(0)
+        with Metrics.timer('save_image', 'parse'), Image.open(ingest) as img:
+            if img.format != fmt and not (fmt == 'JPEG' and img.format == 'MPO'):
+                raise ValueError(f"content is {img.format}, expected {fmt}")
+            width, height = img.size
+            if not width or not height:
+                raise ValueError("empty image")
+
+        # Stored as uploaded, HEIC included: the upload is already on disk
+        # next to the store, move it in
+        ingest.detach()
+        try:
+            with Metrics.timer('save_image', 'write'):
+                ContentStore.add(sha256, ingest.path, file_path)
+        finally:
+            if os.path.exists(ingest.path):
+                os.remove(ingest.path)
+
+    @staticmethod
+    def _ingest(file, options=None):
+        """
+        Returns the upload as an IngestFile. Uploads parsed by IngestRequest
+        are already spooled into the upload folder; other streams are copied
+        once.
+        """
+        if isinstance(file.stream, IngestFile):
+            return file.stream
+        return IngestFile.from_stream(file.stream, ProcessingOptions.resolve(options).upload_folder)
+
+    @staticmethod
+    def _upload_size(file):
+        try:
+            pos = file.stream.tell()
+            file.stream.seek(0, os.SEEK_END)
+            size = file.stream.tell()
+            file.stream.seek(pos)
+            return size
+        except Exception:
+            return file.content_length or 0
+
+    @staticmethod
+    def get_index(options=None):
+        return FileIndex.get(ProcessingOptions.resolve(options).index_db_path)
+
+    @staticmethod
+    def get_storage(options=None):
+        return Storage.get(ProcessingOptions.resolve(options).storage_config())
+
+    @staticmethod
+    def register_file(filename, session_id=None, content_hash=None, tier='disk', options=None):
+        """
+        Records a stored file in the index so the reaper expires it
+        MAX_FILE_AGE_SECONDS from now. Call again after rewriting a file.
+        content_hash is set for uploads linked to the ContentStore.
+        """
+        try:
+            options = ProcessingOptions.resolve(options)
+            size = os.path.getsize(ImageHandler.get_path(filename, options))
+            ImageHandler.get_index(options).register(
+                secure_filename(filename), size, time.time() + options.max_file_age_seconds,
+                session=session_id, sha256=content_hash, tier=tier
+            )
+        except Exception as e:
+            logger.error(f"Error indexing file {filename}: {e}")
+
+    @staticmethod
+    def get_content_hash(filename, options=None):
+        """Returns the content hash of an uploaded (not derived) file, or None."""
+        try:
+            return ImageHandler.get_index(options).content_hash(secure_filename(filename))
+        except Exception as e:
+            logger.error(f"Error reading index for {filename}: {e}")
+            return None
+
+    @staticmethod
+    def touch_file(filename):
+        """Marks a file as recently used so LRU eviction keeps it longer."""
+        try:
+            ImageHandler.get_index().touch(secure_filename(filename))
+        except Exception as e:
+            logger.error(f"Error touching file {filename}: {e}")
+
+    @staticmethod
+    def replace_file(filename, new_path):
+        """
+        Moves the result of an operation on filename into storage, registers
+        it and deletes the original if the operation wrote to a new file.
+        Returns the new filename.
+        """
+        new_filename = os.path.basename(new_path)
+        storage = ImageHandler.get_storage()
+        index = ImageHandler.get_index()
+        session_id = index.session_of(secure_filename(filename))
+        try:
+            tier = storage.adopt(new_path, new_filename)
+        except OSError as e:
+            logger.error(f"Error storing file {new_filename}: {e}")
+            tier = 'disk'
+        ImageHandler.register_file(new_filename, session_id or ImageHandler.get_session_id(), tier=tier)
+        if new_filename != filename:
+            ImageHandler.delete_file(filename)
+        if tier == 'memory':
+            try:
+                spilled = storage.spill(index)
+                if spilled:
+                    Metrics.inc('picturify_storage_spills_total', spilled)
+            except Exception as e:
+                logger.error(f"Error spilling memory tier: {e}")
+        return new_filename
+
+    @staticmethod
+    def get_path(filename, options=None):
         # Prevent Path Traversal by enforcing secure_filename
-        return os.path.join(current_app.config['UPLOAD_FOLDER'], secure_filename(filename))
+        return ImageHandler.get_storage(options).path(secure_filename(filename))
 
     @staticmethod
-    def delete_file(filename):
+    def delete_file(filename, options=None):
         if not filename: return
-        file_path = ImageHandler.get_path(filename)
+        options = ProcessingOptions.resolve(options)
+        file_path = ImageHandler.get_path(filename, options)
+        content_hash = ImageHandler.get_content_hash(filename, options)
         if os.path.exists(file_path):
-            try:
-                os.remove(file_path)
-            except Exception as e:
-                logger.error(f"Error deleting file {filename}: {e}")
+            ImageHandler._remove_stored(file_path, content_hash, options)
+        try:
+            ImageHandler.get_index(options).remove(secure_filename(filename))
+        except Exception as e:
+            logger.error(f"Error unindexing file {filename}: {e}")
 
     @staticmethod
-    def enforce_storage_limit():
-        upload_folder = current_app.config['UPLOAD_FOLDER']
-        max_files = current_app.config.get('MAX_STORED_FILES', 100)
-        
-        if not os.path.exists(upload_folder):
+    def _remove_stored(file_path, content_hash, options):
+        """Removes a stored file, its blob if unreferenced, and stale cached variants."""
+        try:
+            source = VariantCache.source_key(file_path, content_hash)
+            os.remove(file_path)
+        except FileNotFoundError:
             return
-
-        # List all files with full path
-        files = []
-        for f in os.listdir(upload_folder):
-            fp = os.path.join(upload_folder, f)
-            if os.path.isfile(fp):
-                files.append(fp)
-        
-        # If we are strictly below or equal limit, do nothing
-        if len(files) < max_files:
+        except Exception as e:
+            logger.error(f"Error deleting file {os.path.basename(file_path)}: {e}")
             return
-            
-        # Sort by modification time (oldest first)
-        files.sort(key=os.path.getmtime)
-        
-        # Calculate how many to remove. 
-        # We want to remove enough so that after adding 1 new file, we are still within limit.
-        num_to_remove = len(files) - max_files + 1
-        
-        for i in range(num_to_remove):
+        # Content-addressed variants stay valid while another upload shares the blob
+        if content_hash is None or ContentStore.release(content_hash, options.blob_folder):
             try:
-                os.remove(files[i])
-                os.remove(files[i])
+                VariantCache.invalidate(source, ImageHandler.get_index(options), options.variant_folder)
             except Exception as e:
-                logger.error(f"Error removing old file {files[i]}: {e}")
+                logger.error(f"Error invalidating variants of {os.path.basename(file_path)}: {e}")
+
+    @staticmethod
+    def get_session_id():
+        """Returns a stable ID for the current browser session, or None outside a request."""
+        if not has_request_context():
+            return None
+        if 'sid' not in session:
+            session['sid'] = uuid.uuid4().hex
+        return session['sid']
 
     @staticmethod
-    def cleanup_old_files(max_age_seconds=3600):
+    def enforce_storage_limit(incoming_bytes=0, session_id=None, options=None):
         """
-        Removes files older than max_age_seconds.
-        Optimized to avoid scanning thousands of files on every request.
+        Evicts least recently used files until incoming_bytes fits within the
+        session's byte budget and the global byte and file-count budgets.
+        Totals come from the index, so this costs no directory scan.
         """
-        upload_folder = current_app.config['UPLOAD_FOLDER']
-        now = time.time()
-        
-        if not os.path.exists(upload_folder):
-            return
+        options = ProcessingOptions.resolve(options)
+        index = ImageHandler.get_index(options)
+        storage = ImageHandler.get_storage(options)
 
-        # Optimization: Don't scan ALL files every time.
-        # Scan a random subset or stop after deleting a few?
-        # A simple approach for synchronous web requests is to limit the scan.
-        try:
-             # Just listdir can be slow if directory is huge, but it's the fastest way to get handles.
-            files = os.listdir(upload_folder)
-            
-            # If we have too many files, just check a random sample of them (e.g. 50)
-            # This ensures we don't block for long even if there are 10,000 files.
-            import random
-            if len(files) > 50:
-                files = random.sample(files, 50)
-                
-            for filename in files:
-                file_path = os.path.join(upload_folder, filename)
-                # Ensure we only check files
-                if os.path.isfile(file_path):
-                    try:
-                        # cached stat call?
-                        if os.stat(file_path).st_mtime < now - max_age_seconds:
-                            os.remove(file_path)
-                    except OSError:
-                        pass # File might have been deleted by another thread/process
-        except Exception as e:
-            logger.error(f"Error during cleanup: {e}")
+        if session_id is not None:
+            budget = options.max_session_bytes
+            if budget:
+                ImageHandler._evict(
+                    index, storage, options, lambda: index.usage(session_id)[1] + incoming_bytes > budget, session_id
+                )
+
+        max_bytes = options.max_stored_bytes
+        max_files = options.max_stored_files
+
+        def over_global():
+            count, total = index.usage()
+            return (max_files and count + 1 > max_files) or (max_bytes and total + incoming_bytes > max_bytes)
+
+        ImageHandler._evict(index, storage, options, over_global)
+
+    @staticmethod
+    def _evict(index, storage, options, over_budget, session_id=None):
+        while over_budget():
+            candidates = index.least_recent(session_id)
+            if not candidates:
+                return
+            for name, size, content_hash in candidates:
+                if not index.claim(name):
+                    continue  # Already removed by another worker
+                Metrics.inc('picturify_evictions_total')
+                ImageHandler._remove_stored(storage.path(name), content_hash, options)
+                if not over_budget():
+                    return
@@ -0,0 +1,104 @@
+import os
+import shutil
+import hashlib
+import tempfile
+import logging
+from flask import Request, current_app
+
+
+logger = logging.getLogger(__name__)
+
+# Bytes kept from the start of an upload for magic-number sniffing
+SNIFF_BYTES = 32
+
+HEIF_BRANDS = {b'heic', b'heix', b'hevc', b'hevx', b'heim', b'heis', b'mif1', b'msf1'}
+
+
+def sniff_format(head):
+    """Returns the Pillow format name matching the magic bytes of head, or None."""
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'JPEG'
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'PNG'
+    if head[:4] in (b'II*\x00', b'MM\x00*'):
+        return 'TIFF'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'WEBP'
+    if head[4:8] == b'ftyp' and head[8:12] in HEIF_BRANDS:
+        return 'HEIF'
+    return None
+
+
+class IngestFile:
+    """
+    Upload sink written once, directly inside the upload folder.
+    Hashes and measures the data as it is written and keeps its first bytes
+    for sniffing. commit() renames it into place; otherwise it is deleted
+    when closed.
+    """
+
+    def __init__(self, folder):
+        fd, self.path = tempfile.mkstemp(dir=folder, prefix='.ingest_')
+        self._file = os.fdopen(fd, 'w+b')
+        self._hash = hashlib.sha256()
+        self.size = 0
+        self.head = b''
+        self.committed = False
+
+    @staticmethod
+    def from_stream(stream, folder):
+        """Copies a readable stream into a new IngestFile in one pass."""
+        ingest = IngestFile(folder)
+        try:
+            shutil.copyfileobj(stream, ingest, 1024 * 1024)
+            ingest.seek(0)
+        except Exception:
+            ingest.close()
+            raise
+        return ingest
+
+    def write(self, data):
+        self._hash.update(data)
+        if len(self.head) < SNIFF_BYTES:
+            self.head += bytes(data[:SNIFF_BYTES - len(self.head)])
+        self.size += len(data)
+        return self._file.write(data)
+
+    @property
+    def sha256(self):
+        return self._hash.hexdigest()
+
+    def commit(self, dest_path):
+        self._file.flush()
+        try:
+            os.replace(self.path, dest_path)
+        except OSError:
+            # Destination on another filesystem
+            shutil.copyfile(self.path, dest_path)
+            os.remove(self.path)
+        self.path = dest_path
+        self.committed = True
+
+    def detach(self):
+        """Hands the spooled file over to the caller: close() will no longer delete it."""
+        self._file.flush()
+        self.committed = True
+
+    def close(self):
+        self._file.close()
+        if not self.committed:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+    def __getattr__(self, name):
+        # read, seek, tell, readline, ... go straight to the file
+        return getattr(self._file, name)
+
+
+class IngestRequest(Request):
+    """Request class spooling file uploads straight into the upload folder."""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return IngestFile(current_app.config['UPLOAD_FOLDER'])
@@ -0,0 +1,291 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import sqlite3
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+OPERATIONS = ('purify', 'template', 'edit', 'watermark')
+
+# Job states: 'open' accepts more files, 'queued'/'running' are picked up by
+# the JobRunner, 'done' and 'cancelled' are final.
+# Item states: 'pending' (job still open), 'queued', 'running', 'done',
+# 'failed', 'cancelled'.
+
+# Schema migrations, applied in order (see FileIndex)
+MIGRATIONS = [
+    [
+        """CREATE TABLE jobs (
+            id TEXT PRIMARY KEY,
+            operation TEXT NOT NULL,
+            options TEXT NOT NULL,
+            status TEXT NOT NULL,
+            total INTEGER NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL,
+            finished_at REAL
+        )""",
+        "CREATE INDEX jobs_status ON jobs (status, created_at)",
+        """CREATE TABLE job_items (
+            job_id TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            PRIMARY KEY (job_id, seq)
+        )""",
+        "CREATE INDEX job_items_status ON job_items (status, job_id, seq)",
+    ],
+]
+
+_instances = {}
+_instances_lock = threading.Lock()
+
+
+class JobQueue:
+    """
+    Persistent queue of batch jobs, shared by every worker process on the host.
+    Job state lives in SQLite and job files under JOBS_FOLDER/<job id>/
+    (inputs in in/, results in out/), so queued and interrupted jobs survive
+    a restart.
+    """
+
+    def __init__(self, db_path, jobs_folder):
+        self.db_path = db_path
+        self.jobs_folder = jobs_folder
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self._migrate()
+
+    @staticmethod
+    def get(db_path, jobs_folder):
+        """Returns the shared JobQueue instance for db_path."""
+        with _instances_lock:
+            queue = _instances.get(db_path)
+            if queue is None:
+                queue = JobQueue(db_path, jobs_folder)
+                _instances[db_path] = queue
+            return queue
+
+    def _connect(self):
+        # One connection per thread and process
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _migrate(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            for statements in MIGRATIONS[version:]:
+                for statement in statements:
+                    conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {len(MIGRATIONS)}")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def job_dir(self, job_id, kind='in'):
+        return os.path.join(self.jobs_folder, job_id, kind)
+
+    def input_path(self, job_id, seq, name):
+        return os.path.join(self.job_dir(job_id, 'in'), f"{seq:06d}_{name}")
+
+    def output_path(self, job_id, seq, name):
+        return os.path.join(self.job_dir(job_id, 'out'), f"{seq:06d}_{name}")
+
+    def create(self, operation, options, now=None):
+        """Creates an open job and returns its ID."""
+        if operation not in OPERATIONS:
+            raise ValueError(f"Unknown operation: {operation}")
+        now = time.time() if now is None else now
+        job_id = uuid.uuid4().hex
+        os.makedirs(self.job_dir(job_id, 'in'))
+        os.makedirs(self.job_dir(job_id, 'out'))
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, operation, options, status, created_at) VALUES (?, ?, ?, 'open', ?)",
+                (job_id, operation, json.dumps(options), now)
+            )
+        return job_id
+
+    def reserve(self, job_id, count, max_total):
+        """
+        Reserves count item slots in an open job. Returns the first sequence
+        number, or None if the job no longer accepts files or would exceed
+        max_total items.
+        """
+        with self._connect() as conn:
+            cur = conn.execute(
+                "UPDATE jobs SET total = total + ? WHERE id = ? AND status = 'open' AND total + ? <= ? "
+                "RETURNING total",
+                (count, job_id, count, max_total)
+            )
+            row = cur.fetchone()
+            return row[0] - count if row else None
+
+    def add_items(self, job_id, items):
+        """Records [(seq, name)] whose input files are already in place."""
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT INTO job_items (job_id, seq, name, status) VALUES (?, ?, ?, 'pending')",
+                [(job_id, seq, name) for seq, name in items]
+            )
+
+    def start(self, job_id):
+        """Queues an open job. Returns False if it was not open."""
+        with self._connect() as conn:
+            cur = conn.execute("UPDATE jobs SET status = 'queued' WHERE id = ? AND status = 'open'", (job_id,))
+            if cur.rowcount != 1:
+                return False
+            conn.execute("UPDATE job_items SET status = 'queued' WHERE job_id = ? AND status = 'pending'", (job_id,))
+            self._finish_if_complete(conn, job_id)
+            return True
+
+    def job(self, job_id):
+        """Returns the job with per-state item counts, or None."""
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT id, operation, options, status, total, created_at, finished_at FROM jobs WHERE id = ?",
+                (job_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            counts = dict(conn.execute(
+                "SELECT status, COUNT(*) FROM job_items WHERE job_id = ? GROUP BY status", (job_id,)
+            ).fetchall())
+        job_id, operation, options, status, total, created_at, finished_at = row
+        return {
+            'id': job_id,
+            'operation': operation,
+            'options': json.loads(options),
+            'status': status,
+            'total': total,
+            'counts': counts,
+            'created_at': created_at,
+            'finished_at': finished_at,
+        }
+
+    def items(self, job_id, offset=0, limit=100, status=None):
+        """Returns [(seq, name, status, error)] of a job, in submission order."""
+        with self._connect() as conn:
+            if status is None:
+                return conn.execute(
+                    "SELECT seq, name, status, error FROM job_items WHERE job_id = ? ORDER BY seq LIMIT ? OFFSET ?",
+                    (job_id, limit, offset)
+                ).fetchall()
+            return conn.execute(
+                "SELECT seq, name, status, error FROM job_items WHERE job_id = ? AND status = ? "
+                "ORDER BY seq LIMIT ? OFFSET ?",
+                (job_id, status, limit, offset)
+            ).fetchall()
+
+    def item(self, job_id, seq):
+        """Returns (seq, name, status, error) of one item, or None."""
+        with self._connect() as conn:
+            return conn.execute(
+                "SELECT seq, name, status, error FROM job_items WHERE job_id = ? AND seq = ?", (job_id, seq)
+            ).fetchone()
+
+    def claim(self, limit):
+        """
+        Marks up to limit queued items of the oldest active job as running and
+        returns (job_id, operation, options, [(seq, name)]), or None if idle.
+        """
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT j.id, j.operation, j.options FROM jobs j "
+                "WHERE j.status IN ('queued', 'running') AND EXISTS "
+                "(SELECT 1 FROM job_items i WHERE i.job_id = j.id AND i.status = 'queued') "
+                "ORDER BY j.created_at LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None
+            job_id, operation, options = row
+            items = conn.execute(
+                "UPDATE job_items SET status = 'running', attempts = attempts + 1 "
+                "WHERE job_id = ? AND seq IN (SELECT seq FROM job_items WHERE job_id = ? AND status = 'queued' "
+                "ORDER BY seq LIMIT ?) RETURNING seq, name",
+                (job_id, job_id, limit)
+            ).fetchall()
+            conn.execute("UPDATE jobs SET status = 'running' WHERE id = ? AND status = 'queued'", (job_id,))
+        return job_id, operation, json.loads(options), sorted(items)
+
+    def complete(self, job_id, results, now=None):
+        """Records [(seq, error or None)] of running items and finishes the job once all items are."""
+        with self._connect() as conn:
+            conn.executemany(
+                "UPDATE job_items SET status = ?, error = ? WHERE job_id = ? AND seq = ? AND status = 'running'",
+                [('failed' if error else 'done', error, job_id, seq) for seq, error in results]
+            )
+            self._finish_if_complete(conn, job_id, now)
+
+    def _finish_if_complete(self, conn, job_id, now=None):
+        now = time.time() if now is None else now
+        conn.execute(
+            "UPDATE jobs SET status = 'done', finished_at = ? WHERE id = ? AND status IN ('queued', 'running') "
+            "AND NOT EXISTS (SELECT 1 FROM job_items WHERE job_id = ? AND status IN ('queued', 'running'))",
+            (now, job_id, job_id)
+        )
+
+    def requeue_running(self, max_attempts):
+        """
+        Puts items left running by a dead runner back in the queue. Items that
+        already had max_attempts are failed, so a file crashing the worker
+        cannot block its job forever. Returns the number of requeued items.
+        """
+        with self._connect() as conn:
+            failed = conn.execute(
+                "UPDATE job_items SET status = 'failed', error = 'Worker crashed' "
+                "WHERE status = 'running' AND attempts >= ? RETURNING job_id",
+                (max_attempts,)
+            ).fetchall()
+            requeued = conn.execute(
+                "UPDATE job_items SET status = 'queued' WHERE status = 'running'"
+            ).rowcount
+            for job_id in {row[0] for row in failed}:
+                self._finish_if_complete(conn, job_id)
+        return requeued
+
+    def cancel(self, job_id):
+        """Stops a job: its remaining items are never run. Returns False if unknown."""
+        with self._connect() as conn:
+            cur = conn.execute(
+                "UPDATE jobs SET status = 'cancelled', finished_at = COALESCE(finished_at, ?) WHERE id = ?",
+                (time.time(), job_id)
+            )
+            conn.execute(
+                "UPDATE job_items SET status = 'cancelled' WHERE job_id = ? AND status IN ('pending', 'queued')",
+                (job_id,)
+            )
+            return cur.rowcount == 1
+
+    def delete(self, job_id):
+        """Removes a job and its files."""
+        with self._connect() as conn:
+            conn.execute("DELETE FROM job_items WHERE job_id = ?", (job_id,))
+            conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+        shutil.rmtree(os.path.join(self.jobs_folder, job_id), ignore_errors=True)
+
+    def expired(self, before, limit=100):
+        """Returns IDs of jobs finished, or left open, before the given time."""
+        with self._connect() as conn:
+            return [row[0] for row in conn.execute(
+                "SELECT id FROM jobs WHERE (status IN ('done', 'cancelled') AND finished_at <= ?) "
+                "OR (status = 'open' AND created_at <= ?) LIMIT ?",
+                (before, before, limit)
+            )]
@@ -0,0 +1,113 @@
+import os
+import time
+import logging
+import threading
+from flask import current_app
+from app.services.job_queue import JobQueue
+from app.services.batch_processor import BatchProcessor
+from app.services.file_reaper import acquire_leadership
+from app.services.metadata_templates import MetadataTemplates
+
+
+logger = logging.getLogger(__name__)
+
+_started = set()
+_started_lock = threading.Lock()
+
+
+class JobRunner:
+    """
+    Background thread executing queued jobs on the BatchProcessor pool.
+    Like the FileReaper, every worker process starts one but only the holder
+    of a host-wide file lock runs jobs. A process taking over the lock first
+    requeues the items its predecessor left running.
+    """
+
+    @staticmethod
+    def init_app(app):
+        if not app.config.get('JOBS_ENABLED', True):
+            return
+        db_path = app.config['JOBS_DB_PATH']
+        with _started_lock:
+            if db_path in _started:
+                return
+            _started.add(db_path)
+
+        thread = threading.Thread(target=JobRunner._run, args=(app,), name='picturify-jobs', daemon=True)
+        thread.start()
+
+    @staticmethod
+    def get_queue():
+        return JobQueue.get(current_app.config['JOBS_DB_PATH'], current_app.config['JOBS_FOLDER'])
+
+    @staticmethod
+    def _run(app):
+        lock_file = None
+        interval = app.config.get('JOBS_POLL_SECONDS', 1)
+        while True:
+            try:
+                with app.app_context():
+                    if lock_file is None:
+                        lock_file = acquire_leadership(app.config['JOBS_DB_PATH'] + '.runner.lock')
+                        if lock_file is not None:
+                            requeued = JobRunner.get_queue().requeue_running(app.config.get('JOB_MAX_ATTEMPTS', 3))
+                            if requeued:
+                                logger.info(f"Requeued {requeued} interrupted job items")
+                    if lock_file is not None:
+                        if JobRunner.run_pending():
+                            continue  # Keep going while there is work
+                        JobRunner.expire()
+            except Exception as e:
+                logger.error(f"Error running jobs: {e}")
+            time.sleep(interval)
+
+    @staticmethod
+    def run_pending(limit=None):
+        """
+        Runs one slice of queued items (a few pool rounds) of the oldest job.
+        Returns the number of items processed, 0 if the queue is empty.
+        """
+        queue = JobRunner.get_queue()
+        limit = limit or max(1, current_app.config.get('BATCH_WORKERS', 2)) * 4
+        claimed = queue.claim(limit)
+        if claimed is None:
+            return 0
+        job_id, operation, options, items = claimed
+
+        inputs = [queue.input_path(job_id, seq, name) for seq, name in items]
+        outputs = [queue.output_path(job_id, seq, name) for seq, name in items]
+        try:
+            options = JobRunner._resolve_options(operation, options)
+            results = BatchProcessor.run(operation, [name for _, name in items], inputs, options, outputs)
+            errors = [None if res['result'] else res['error'] for res in results]
+        except Exception as e:
+            logger.error(f"Job {job_id} failed: {e}")
+            errors = [str(e)] * len(items)
+
+        queue.complete(job_id, [(seq, error) for (seq, _), error in zip(items, errors)])
+
+        # Inputs are not needed once processed
+        for path in inputs:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        return len(items)
+
+    @staticmethod
+    def _resolve_options(operation, options):
+        """Turns stored (JSON) options into what the batch operation expects."""
+        if operation == 'template':
+            kept_tags = MetadataTemplates.get_compiled(options['template'])
+            if not kept_tags:
+                raise ValueError(f"Unknown template: {options['template']}")
+            return dict(options, kept_tags=kept_tags)
+        return options
+
+    @staticmethod
+    def expire(now=None):
+        """Deletes jobs finished (or left open) more than JOB_RETENTION_SECONDS ago."""
+        now = time.time() if now is None else now
+        queue = JobRunner.get_queue()
+        for job_id in queue.expired(now - current_app.config.get('JOB_RETENTION_SECONDS', 86400)):
+            queue.delete(job_id)
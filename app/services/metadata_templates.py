@@ -1,21 +1,49 @@
+import json
+import logging
+from functools import lru_cache
+from app.services.tag_index import TagIndex
+
+
+logger = logging.getLogger(__name__)
+
 class MetadataTemplates:
     """
     Defines templates for metadata filtering.
-    Each template contains a list of tag names (strings) that should be PRESERVED.
+    Each template contains a list of rules for tags that should be PRESERVED.
+    A rule is a tag name ('Make'), a glob pattern ('GPS*') or a group ('@camera_settings').
     """
-    
+
+    # Named groups usable in templates as '@name'
+    GROUPS = {
+        'camera': [
+            'Make', 'Model', 'LensMake', 'LensModel', 'LensSpecification',
+            'BodySerialNumber', 'LensSerialNumber', 'CameraOwnerName'
+        ],
+        'camera_settings': [
+            'ExposureTime', 'FNumber', 'ExposureProgram', 'ISOSpeedRatings', 'ISOSpeed',
+            'ShutterSpeedValue', 'ApertureValue', 'BrightnessValue', 'ExposureBiasValue',
+            'MaxApertureValue', 'MeteringMode', 'LightSource', 'Flash', 'FocalLength',
+            'FocalLengthIn35mmFilm', 'ExposureMode', 'WhiteBalance', 'DigitalZoomRatio',
+            'SceneCaptureType', 'GainControl', 'Contrast', 'Saturation', 'Sharpness',
+            'SubjectDistanceRange'
+        ],
+        'dates': ['DateTime', 'DateTimeOriginal', 'DateTimeDigitized', 'OffsetTime*', 'SubSecTime*'],
+        'gps': ['GPS*'],
+        'author': ['Artist', 'Copyright', 'ImageDescription', 'XP*'],
+    }
+
     TEMPLATES = {
         'flickr': [
             # Camera Info
             'Make', 'Model', 'LensModel', 'LensMake', 'LensSpecification',
-            
+
             # Shooting Settings
             'ISOSpeedRatings', 'ISO', 'FNumber', 'ExposureTime', 'FocalLength', 'FocalLengthIn35mmFilm',
             'ExposureBiasValue', 'WhiteBalance', 'Flash', 'MeteringMode', 'ExposureProgram',
-            
+
             # Dates
             'DateTimeOriginal', 'DateTimeDigitized', 'DateTime',
-            
+
             # GPS
             'GPSVersionID', 'GPSLatitudeRef', 'GPSLatitude', 'GPSLongitudeRef', 'GPSLongitude',
             'GPSAltitudeRef', 'GPSAltitude', 'GPSTimeStamp', 'GPSSatellites', 'GPSStatus',
@@ -24,13 +52,13 @@ class MetadataTemplates:
             'GPSDestLatitude', 'GPSDestLongitudeRef', 'GPSDestLongitude', 'GPSDestBearingRef',
             'GPSDestBearing', 'GPSDestDistanceRef', 'GPSDestDistance', 'GPSProcessingMethod',
             'GPSAreaInformation', 'GPSDateStamp', 'GPSDifferential',
-            
+
             # Orientation
             'Orientation',
-            
+
             # Software
             'Software',
-            
+
             # Description/Artist (Optional but usually good for Flickr)
             'ImageDescription', 'Artist', 'Copyright'
         ]
@@ -40,6 +68,75 @@ class MetadataTemplates:
     def get_template(name):
         return MetadataTemplates.TEMPLATES.get(name)
 
+    @staticmethod
+    def get_compiled(name):
+        """Returns the compiled form of a template (see compile), or None."""
+        rules = MetadataTemplates.get_template(name)
+        if not rules:
+            return None
+        return MetadataTemplates.compile(rules)
+
     @staticmethod
     def list_templates():
         return list(MetadataTemplates.TEMPLATES.keys())
+
+    @staticmethod
+    def compile(rules):
+        """
+        Compiles a list of rules into {"0th": frozenset, "Exif": frozenset, "GPS": frozenset}
+        of tag IDs to keep. Results are cached per rule list.
+        """
+        return _compile_rules(tuple(rules))
+
+    @staticmethod
+    def load_file(path):
+        """
+        Loads user templates from a JSON file mapping template names to rule lists.
+        Existing templates with the same name are replaced.
+        """
+        with open(path, 'r', encoding='utf-8') as f:
+            templates = json.load(f)
+
+        if not isinstance(templates, dict):
+            raise ValueError(f"Template file {path} must contain a JSON object")
+
+        for name, rules in templates.items():
+            if not isinstance(rules, list) or not all(isinstance(r, str) for r in rules):
+                logger.error(f"Skipping template '{name}' from {path}: rules must be a list of strings")
+                continue
+            MetadataTemplates.TEMPLATES[name] = rules
+
+    @staticmethod
+    def init_app(app):
+        path = app.config.get('METADATA_TEMPLATES_FILE')
+        if not path:
+            return
+        try:
+            MetadataTemplates.load_file(path)
+        except Exception as e:
+            logger.error(f"Error loading metadata templates from {path}: {e}")
+
+
+def _expand_rule(rule, seen):
+    if rule.startswith('@'):
+        group = rule[1:]
+        if group in seen:
+            return []
+        members = MetadataTemplates.GROUPS.get(group)
+        if members is None:
+            logger.warning(f"Unknown metadata group '{group}'")
+            return []
+        tags = []
+        for member in members:
+            tags.extend(_expand_rule(member, seen | {group}))
+        return tags
+    return TagIndex.match(rule)
+
+
+@lru_cache(maxsize=128)
+def _compile_rules(rules):
+    compiled = {"0th": set(), "Exif": set(), "GPS": set()}
+    for rule in rules:
+        for group, tag_id in _expand_rule(rule, frozenset()):
+            compiled[group].add(tag_id)
+    return {group: frozenset(ids) for group, ids in compiled.items()}
@@ -0,0 +1,321 @@
+import os
+import json
+import time
+import uuid
+import logging
+import ipaddress
+import threading
+from contextlib import contextmanager
+from flask import current_app, g, has_app_context, has_request_context, request, Response, abort
+from app.services.file_index import FileIndex
+
+
+logger = logging.getLogger(__name__)
+
+# Networks allowed to read /metrics and /profiles unless configured
+DEFAULT_ALLOWED_NETWORKS = ('127.0.0.0/8', '::1/128')
+
+# Latency buckets in seconds (+Inf is implicit)
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+HELP = {
+    'picturify_request_duration_seconds': ('histogram', 'Request latency by route'),
+    'picturify_requests_total': ('counter', 'Requests by route and status'),
+    'picturify_operation_seconds': ('histogram', 'Service operation time by operation and phase'),
+    'picturify_request_bytes_total': ('counter', 'Request body bytes received'),
+    'picturify_response_bytes_total': ('counter', 'Response body bytes sent'),
+    'picturify_analysis_cache_total': ('counter', 'EXIF analysis cache lookups by result'),
+    'picturify_variant_cache_total': ('counter', 'Variant and preview cache lookups by result'),
+    'picturify_evictions_total': ('counter', 'Stored files evicted by storage budgets'),
+    'picturify_storage_spills_total': ('counter', 'Files moved from the memory tier to disk'),
+    'picturify_errors_total': ('counter', 'Errors logged, by module'),
+    'picturify_stored_files': ('gauge', 'Files in the upload folder'),
+    'picturify_stored_bytes': ('gauge', 'Bytes in the upload folder'),
+    'picturify_variant_cache_bytes': ('gauge', 'Bytes of cached download variants and previews'),
+    'picturify_cleanup_files_reclaimed_total': ('counter', 'Expired files deleted by the reaper'),
+    'picturify_cleanup_bytes_reclaimed_total': ('counter', 'Bytes freed by the reaper'),
+}
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_last_flush = 0.0
+
+# Identifies this process' snapshot; pids are reused, this is not
+_process_key = None
+_process_pid = None
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def _check_process():
+    """Starts from empty metrics in a forked child, which must not re-count its parent's."""
+    global _process_key, _process_pid, _last_flush
+    if _process_pid != os.getpid():
+        _counters.clear()
+        _histograms.clear()
+        _last_flush = 0.0
+        _process_pid = os.getpid()
+        _process_key = f"{_process_pid}-{uuid.uuid4().hex[:8]}"
+
+
+def address_allowed(addr, networks):
+    """True if addr is an IP address inside one of networks (CIDR strings)."""
+    try:
+        ip = ipaddress.ip_address(addr)
+    except ValueError:
+        return False
+    return any(ip in ipaddress.ip_network(net) for net in networks)
+
+
+def client_allowed(setting):
+    """
+    True if the current request comes from a network listed in the config
+    key setting (loopback by default). Guards /metrics and /profiles.
+    """
+    return address_allowed(request.remote_addr, current_app.config.get(setting, DEFAULT_ALLOWED_NETWORKS))
+
+
+class _ErrorCounter(logging.Handler):
+    """Counts ERROR records of the app's loggers, labelled by module."""
+
+    def emit(self, record):
+        Metrics.inc('picturify_errors_total', module=record.name.rsplit('.', 1)[-1])
+
+
+class Metrics:
+    """
+    Process-local counters and histograms, exported in the Prometheus text
+    format on /metrics. Every process (gunicorn workers, batch pool workers)
+    periodically saves a snapshot to the shared FileIndex; /metrics adds them
+    up, so the totals cover the whole host. Snapshots of dead processes are
+    folded into a retired total, so counters never go backwards.
+    """
+
+    @staticmethod
+    def init_app(app):
+        if not app.config.get('METRICS_ENABLED', True):
+            return
+        app.before_request(Metrics._before_request)
+        app.after_request(Metrics._after_request)
+        app.add_url_rule('/metrics', 'metrics', Metrics.export)
+
+        app_logger = logging.getLogger('app')
+        if not any(isinstance(h, _ErrorCounter) for h in app_logger.handlers):
+            app_logger.addHandler(_ErrorCounter(level=logging.ERROR))
+
+    @staticmethod
+    def inc(name, value=1, **labels):
+        key = _key(name, labels)
+        with _lock:
+            _check_process()
+            _counters[key] = _counters.get(key, 0) + value
+
+    @staticmethod
+    def observe(name, seconds, **labels):
+        key = _key(name, labels)
+        with _lock:
+            _check_process()
+            hist = _histograms.get(key)
+            if hist is None:
+                hist = _histograms[key] = [0] * (len(BUCKETS) + 2)  # buckets..., sum, count
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    hist[i] += 1
+            hist[-2] += seconds
+            hist[-1] += 1
+
+    @staticmethod
+    @contextmanager
+    def timer(operation, phase='total'):
+        """
+        Times a block as picturify_operation_seconds{operation, phase} and
+        adds it to the Server-Timing header of the current request.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            Metrics.observe('picturify_operation_seconds', elapsed, operation=operation, phase=phase)
+            if has_request_context():
+                timings = g.setdefault('server_timing', {})
+                name = f"{operation}.{phase}" if phase != 'total' else operation
+                timings[name] = timings.get(name, 0.0) + elapsed
+
+    # --- Request hooks ---
+
+    @staticmethod
+    def _before_request():
+        g.request_start = time.perf_counter()
+
+    @staticmethod
+    def _after_request(response):
+        start = g.pop('request_start', None)
+        if start is None:
+            return response
+        elapsed = time.perf_counter() - start
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        Metrics.observe('picturify_request_duration_seconds', elapsed, route=route, method=request.method)
+        Metrics.inc('picturify_requests_total', route=route, method=request.method, status=str(response.status_code))
+        if request.content_length:
+            Metrics.inc('picturify_request_bytes_total', request.content_length, route=route)
+
+        if response.is_streamed and not response.direct_passthrough:
+            response.response = Metrics._count_bytes(response.response, route)
+        elif response.content_length:
+            Metrics.inc('picturify_response_bytes_total', response.content_length, route=route)
+
+        entries = [f"total;dur={elapsed * 1000:.1f}"]
+        for name, seconds in g.pop('server_timing', {}).items():
+            entries.append(f"{name.replace('.', '-')};dur={seconds * 1000:.1f}")
+        response.headers['Server-Timing'] = ', '.join(entries)
+
+        Metrics.maybe_flush()
+        return response
+
+    @staticmethod
+    def _count_bytes(iterable, route):
+        sent = 0
+        try:
+            for chunk in iterable:
+                sent += len(chunk)
+                yield chunk
+        finally:
+            Metrics.inc('picturify_response_bytes_total', sent, route=route)
+            if hasattr(iterable, 'close'):
+                iterable.close()
+
+    # --- Aggregation ---
+
+    @staticmethod
+    def snapshot():
+        with _lock:
+            _check_process()
+            return {
+                'counters': [[name, list(labels), value] for (name, labels), value in _counters.items()],
+                'histograms': [[name, list(labels), list(hist)] for (name, labels), hist in _histograms.items()],
+            }
+
+    @staticmethod
+    def maybe_flush():
+        if time.monotonic() - _last_flush >= current_app.config.get('METRICS_FLUSH_SECONDS', 5):
+            Metrics.flush()
+
+    @staticmethod
+    def flush():
+        """Saves this process' snapshot to the shared index."""
+        global _last_flush
+        if not has_app_context():
+            return
+        _last_flush = time.monotonic()
+        try:
+            index = FileIndex.get(current_app.config['INDEX_DB_PATH'])
+            snapshot = json.dumps(Metrics.snapshot())
+            index.save_metrics(_process_key, _process_pid, snapshot)
+        except Exception as e:
+            logger.warning(f"Error saving metrics: {e}")
+
+    @staticmethod
+    def collect(index):
+        """Returns (counters, histograms) summed over every process of the host."""
+        counters, histograms = {}, {}
+        for key, pid, data in index.load_metrics():
+            Metrics._merge(counters, histograms, json.loads(data))
+            if key != 'retired' and not Metrics._alive(pid):
+                # Moved into the retired total, which the sums above already include
+                index.retire_metrics(key, Metrics._fold)
+        return counters, histograms
+
+    @staticmethod
+    def _merge(counters, histograms, snapshot):
+        for name, labels, value in snapshot['counters']:
+            key = (name, tuple(tuple(label) for label in labels))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, hist in snapshot['histograms']:
+            key = (name, tuple(tuple(label) for label in labels))
+            current = histograms.get(key)
+            histograms[key] = list(hist) if current is None else [a + b for a, b in zip(current, hist)]
+
+    @staticmethod
+    def _fold(*snapshots):
+        """Sums JSON snapshots (None for missing) into one."""
+        counters, histograms = {}, {}
+        for data in snapshots:
+            if data:
+                Metrics._merge(counters, histograms, json.loads(data))
+        return json.dumps({
+            'counters': [[name, list(labels), value] for (name, labels), value in counters.items()],
+            'histograms': [[name, list(labels), hist] for (name, labels), hist in histograms.items()],
+        })
+
+    @staticmethod
+    def _alive(pid):
+        if pid == os.getpid():
+            return True
+        try:
+            os.kill(pid, 0)
+            return True
+        except ProcessLookupError:
+            return False
+        except OSError:
+            return True  # Exists, owned by someone else
+
+    # --- Export ---
+
+    @staticmethod
+    def export():
+        if not client_allowed('METRICS_ALLOWED_NETWORKS'):
+            abort(403)
+        Metrics.flush()
+        index = FileIndex.get(current_app.config['INDEX_DB_PATH'])
+        counters, histograms = Metrics.collect(index)
+
+        files, stored_bytes = index.usage()
+        gauges = {
+            ('picturify_stored_files', ()): files,
+            ('picturify_stored_bytes', ()): stored_bytes,
+            ('picturify_variant_cache_bytes', ()): index.variant_bytes(),
+        }
+        for name, value in index.counters().items():
+            # Kept by the reaper: files_reclaimed, bytes_reclaimed
+            counters[(f'picturify_cleanup_{name}_total', ())] = value
+
+        return Response(Metrics.render(counters, histograms, gauges), mimetype='text/plain; version=0.0.4')
+
+    @staticmethod
+    def render(counters, histograms, gauges):
+        lines = []
+        typed = set()
+
+        def header(name, kind):
+            if name in typed:
+                return
+            typed.add(name)
+            help_text = HELP.get(name, (kind, name.replace('_', ' ')))[1]
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        def fmt(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ''
+            escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+            return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+        for (name, labels), value in sorted(gauges.items()):
+            header(name, 'gauge')
+            lines.append(f"{name}{fmt(labels)} {value}")
+        for (name, labels), value in sorted(counters.items()):
+            header(name, 'counter')
+            lines.append(f"{name}{fmt(labels)} {value}")
+        for (name, labels), hist in sorted(histograms.items()):
+            header(name, 'histogram')
+            for bound, count in zip(BUCKETS, hist):
+                lines.append(f"{name}_bucket{fmt(labels, [('le', str(bound))])} {count}")
+            lines.append(f"{name}_bucket{fmt(labels, [('le', '+Inf')])} {hist[-1]}")
+            lines.append(f"{name}_sum{fmt(labels)} {hist[-2]}")
+            lines.append(f"{name}_count{fmt(labels)} {hist[-1]}")
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,67 @@
+import logging
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.sansio.multipart import MultipartDecoder, Field, File, Data, Epilogue, NeedData
+from app.services.ingest import IngestFile
+
+
+logger = logging.getLogger(__name__)
+
+# Bytes read from the request per decoder step
+READ_SIZE = 256 * 1024
+
+# Form fields are small (options), files are spooled to disk
+MAX_FIELD_BYTES = 64 * 1024
+
+
+class MultipartStream:
+    """
+    Incremental multipart/form-data reader. Unlike request.files, which is
+    only available once the whole body is parsed, parts are handed out as
+    soon as each one has been received, so bulk endpoints can process and
+    answer file by file.
+    """
+
+    @staticmethod
+    def iter_parts(stream, boundary, folder, max_parts=None):
+        """
+        Yields (name, filename, value) for each part of the body, in order.
+        Fields have filename None and a str value; files are spooled into
+        folder as an IngestFile (hashed and sniffed while received), rewound
+        and flushed. The caller owns and must close each IngestFile.
+        """
+        decoder = MultipartDecoder(boundary, max_form_memory_size=MAX_FIELD_BYTES, max_parts=max_parts)
+        part = None
+        sink = None
+        try:
+            while True:
+                data = stream.read(READ_SIZE)
+                decoder.receive_data(data or None)
+                event = decoder.next_event()
+                while not isinstance(event, (Epilogue, NeedData)):
+                    if isinstance(event, Field):
+                        part, sink = event, []
+                    elif isinstance(event, File):
+                        part, sink = event, IngestFile(folder)
+                    elif isinstance(event, Data):
+                        if isinstance(sink, list):
+                            sink.append(event.data)
+                            if sum(map(len, sink)) > MAX_FIELD_BYTES:
+                                raise RequestEntityTooLarge()
+                        else:
+                            sink.write(event.data)
+                        if not event.more_data:
+                            if isinstance(part, File):
+                                sink.flush()
+                                sink.seek(0)
+                                ingest, sink = sink, None
+                                yield part.name, part.filename, ingest
+                            else:
+                                yield part.name, None, b''.join(sink).decode('utf-8', 'replace')
+                                sink = None
+                    event = decoder.next_event()
+                if not data or isinstance(event, Epilogue):
+                    return
+        finally:
+            # A part cut short by a disconnect or an error
+            if isinstance(sink, IngestFile):
+                sink.close()
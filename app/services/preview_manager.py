@@ -0,0 +1,98 @@
+import io
+import logging
+import piexif
+from PIL import Image, ImageOps, features
+from flask import current_app
+from app.services.segment_editor import SegmentEditor
+from app.services.variant_cache import VariantCache
+
+
+logger = logging.getLogger(__name__)
+
+# Bounding box (longest side, in pixels) of each preview size
+PREVIEW_SIZES = {'small': 320, 'large': 800}
+
+
+class PreviewManager:
+    """
+    Small, metadata-free previews of stored images for the result and batch
+    pages, cached in the VariantCache per content hash.
+    The full-size image is never decoded: the embedded EXIF thumbnail is
+    used when it is large enough, otherwise JPEGs are decoded at a reduced
+    scale with draft().
+    """
+
+    @staticmethod
+    def output_format():
+        fmt = current_app.config.get('PREVIEW_FORMAT', 'WEBP').upper()
+        if fmt == 'WEBP' and not features.check('webp'):
+            return 'JPEG'
+        return fmt
+
+    @staticmethod
+    def get_or_render(file_path, size_name, content_hash=None):
+        """Returns (path, format) of the cached preview, rendering it on a miss."""
+        size = PREVIEW_SIZES[size_name]
+        fmt = PreviewManager.output_format()
+        quality = current_app.config.get('PREVIEW_QUALITY', 80)
+        return VariantCache.get_or_create(
+            file_path, f"preview|{size}|{fmt}|q{quality}",
+            lambda dest_path: PreviewManager.render(file_path, dest_path, size, fmt, quality),
+            content_hash, operation='preview'
+        )
+
+    @staticmethod
+    def render(file_path, dest_path, size, fmt='WEBP', quality=80):
+        image = PreviewManager._from_exif_thumbnail(file_path, size)
+        if image is None:
+            with Image.open(file_path) as img:
+                # DCT-domain downscale for JPEG: decodes at 1/2, 1/4 or 1/8 scale
+                img.draft('RGB', (size, size))
+                img.thumbnail((size, size))
+                image = ImageOps.exif_transpose(img)
+        else:
+            image.thumbnail((size, size))
+
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'A' in image.getbands() or 'transparency' in image.info else 'RGB')
+        if fmt == 'JPEG' and image.mode == 'RGBA':
+            image = image.convert('RGB')
+
+        # No metadata: previews must not leak what the user is about to strip
+        with SegmentEditor.atomic_output(dest_path) as f:
+            image.save(f, fmt, quality=quality)
+        return fmt
+
+    @staticmethod
+    def _from_exif_thumbnail(file_path, size):
+        """
+        Returns the embedded thumbnail (1st IFD), upright, if its longest side
+        is at least size, else None. Only the metadata block is read.
+        """
+        try:
+            exif_bytes = SegmentEditor.read_exif_block(file_path)
+            if not exif_bytes:
+                return None
+            exif_dict = piexif.load(exif_bytes)
+            thumbnail = exif_dict.get('thumbnail')
+            if not thumbnail:
+                return None
+            image = Image.open(io.BytesIO(thumbnail))
+            if max(image.size) < size:
+                return None
+            image.load()
+        except Exception:
+            return None
+
+        # The thumbnail follows the main image's orientation
+        orientation = exif_dict['0th'].get(piexif.ImageIFD.Orientation, 1)
+        method = {
+            2: Image.Transpose.FLIP_LEFT_RIGHT,
+            3: Image.Transpose.ROTATE_180,
+            4: Image.Transpose.FLIP_TOP_BOTTOM,
+            5: Image.Transpose.TRANSPOSE,
+            6: Image.Transpose.ROTATE_270,
+            7: Image.Transpose.TRANSVERSE,
+            8: Image.Transpose.ROTATE_90,
+        }.get(orientation)
+        return image.transpose(method) if method else image
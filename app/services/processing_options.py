@@ -0,0 +1,90 @@
+from flask import current_app, has_app_context
+from config import Config
+
+
+class ProcessingOptions:
+    """
+    The settings image services need to process and store a file,
+    independent of Flask. Services take an optional options object; without
+    one they use the current app's config, or the Config defaults outside of
+    an app (e.g. the command line tool and its worker processes).
+    """
+
+    def __init__(self, image_quality=Config.IMAGE_QUALITY, image_subsampling=Config.IMAGE_SUBSAMPLING,
+                 allowed_extensions=Config.ALLOWED_EXTENSIONS, analysis_cache_size=Config.ANALYSIS_CACHE_SIZE,
+                 upload_folder=Config.UPLOAD_FOLDER, index_db_path=Config.INDEX_DB_PATH,
+                 blob_folder=Config.BLOB_FOLDER, variant_folder=Config.VARIANT_FOLDER,
+                 storage_layout=Config.STORAGE_LAYOUT, storage_memory_folder=Config.STORAGE_MEMORY_FOLDER,
+                 storage_memory_bytes=Config.STORAGE_MEMORY_BYTES,
+                 storage_memory_max_file_bytes=Config.STORAGE_MEMORY_MAX_FILE_BYTES,
+                 max_file_age_seconds=Config.MAX_FILE_AGE_SECONDS, max_session_bytes=Config.MAX_SESSION_BYTES,
+                 max_stored_bytes=Config.MAX_STORED_BYTES, max_stored_files=Config.MAX_STORED_FILES):
+        self.image_quality = image_quality
+        self.image_subsampling = image_subsampling
+        self.allowed_extensions = frozenset(allowed_extensions)
+        self.analysis_cache_size = analysis_cache_size
+        # Storage (see ImageHandler)
+        self.upload_folder = upload_folder
+        self.index_db_path = index_db_path
+        self.blob_folder = blob_folder
+        self.variant_folder = variant_folder
+        self.storage_layout = storage_layout
+        self.storage_memory_folder = storage_memory_folder
+        self.storage_memory_bytes = storage_memory_bytes
+        self.storage_memory_max_file_bytes = storage_memory_max_file_bytes
+        self.max_file_age_seconds = max_file_age_seconds
+        self.max_session_bytes = max_session_bytes
+        self.max_stored_bytes = max_stored_bytes
+        self.max_stored_files = max_stored_files
+
+    @staticmethod
+    def from_config(config):
+        """Builds options from a Flask config (or any mapping of Config keys)."""
+        return ProcessingOptions(
+            image_quality=config.get('IMAGE_QUALITY', Config.IMAGE_QUALITY),
+            image_subsampling=config.get('IMAGE_SUBSAMPLING', Config.IMAGE_SUBSAMPLING),
+            allowed_extensions=config.get('ALLOWED_EXTENSIONS', Config.ALLOWED_EXTENSIONS),
+            analysis_cache_size=config.get('ANALYSIS_CACHE_SIZE', Config.ANALYSIS_CACHE_SIZE),
+            upload_folder=config.get('UPLOAD_FOLDER', Config.UPLOAD_FOLDER),
+            index_db_path=config.get('INDEX_DB_PATH', Config.INDEX_DB_PATH),
+            blob_folder=config.get('BLOB_FOLDER', Config.BLOB_FOLDER),
+            variant_folder=config.get('VARIANT_FOLDER', Config.VARIANT_FOLDER),
+            storage_layout=config.get('STORAGE_LAYOUT', Config.STORAGE_LAYOUT),
+            storage_memory_folder=config.get('STORAGE_MEMORY_FOLDER', Config.STORAGE_MEMORY_FOLDER),
+            storage_memory_bytes=config.get('STORAGE_MEMORY_BYTES', Config.STORAGE_MEMORY_BYTES),
+            storage_memory_max_file_bytes=config.get(
+                'STORAGE_MEMORY_MAX_FILE_BYTES', Config.STORAGE_MEMORY_MAX_FILE_BYTES),
+            max_file_age_seconds=config.get('MAX_FILE_AGE_SECONDS', Config.MAX_FILE_AGE_SECONDS),
+            max_session_bytes=config.get('MAX_SESSION_BYTES', Config.MAX_SESSION_BYTES),
+            max_stored_bytes=config.get('MAX_STORED_BYTES', Config.MAX_STORED_BYTES),
+            max_stored_files=config.get('MAX_STORED_FILES', Config.MAX_STORED_FILES),
+        )
+
+    @staticmethod
+    def resolve(options=None):
+        """Returns options if given, else those of the current app, else the defaults."""
+        if options is not None:
+            return options
+        if has_app_context():
+            return ProcessingOptions.from_config(current_app.config)
+        return ProcessingOptions()
+
+    def allowed_file(self, filename):
+        return '.' in filename and filename.rsplit('.', 1)[1].lower() in self.allowed_extensions
+
+    def save_kwargs(self, quality=None):
+        """Pillow save arguments for a re-encode (quality defaults to image_quality)."""
+        return {
+            "quality": self.image_quality if quality is None else quality,
+            "subsampling": self.image_subsampling,
+        }
+
+    def storage_config(self):
+        """The storage settings as the config mapping Storage.get expects."""
+        return {
+            'UPLOAD_FOLDER': self.upload_folder,
+            'STORAGE_LAYOUT': self.storage_layout,
+            'STORAGE_MEMORY_FOLDER': self.storage_memory_folder,
+            'STORAGE_MEMORY_BYTES': self.storage_memory_bytes,
+            'STORAGE_MEMORY_MAX_FILE_BYTES': self.storage_memory_max_file_bytes,
+        }
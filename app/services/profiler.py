@@ -0,0 +1,204 @@
+import os
+import re
+import io
+import json
+import time
+import uuid
+import hmac
+import random
+import pstats
+import shutil
+import cProfile
+import logging
+import threading
+import tracemalloc
+from flask import current_app, g, request, render_template, send_from_directory, abort
+from app.services.metrics import client_allowed
+
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = 'X-Picturify-Profile'
+
+# Client-supplied request IDs are used as directory names
+REQUEST_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+# Files written per capture
+CAPTURE_FILES = ('profile.prof', 'profile.txt', 'allocations.txt', 'meta.json')
+
+# cProfile and tracemalloc are process-wide: one capture at a time per process
+_capture_lock = threading.Lock()
+
+
+class Profiler:
+    """
+    Opt-in cProfile and tracemalloc capture of single requests.
+
+    A request is profiled when it carries the PROFILE_HEADER with the
+    PROFILING_TOKEN, or is picked by PROFILING_SAMPLE_RATE. Each capture is
+    written to PROFILING_FOLDER/<request id>/ and listed on /profiles.
+    With PROFILING_ENABLED off (the default) no hook is registered at all.
+    """
+
+    @staticmethod
+    def init_app(app):
+        if not app.config.get('PROFILING_ENABLED', False):
+            return
+        app.before_request(Profiler._before_request)
+        app.after_request(Profiler._after_request)
+        app.teardown_request(Profiler._teardown_request)
+        app.add_url_rule('/profiles', 'profiles', Profiler.index)
+        app.add_url_rule('/profiles/<capture_id>/<name>', 'profile_file', Profiler.download)
+
+    @staticmethod
+    def _requested():
+        token = current_app.config.get('PROFILING_TOKEN')
+        header = request.headers.get(PROFILE_HEADER)
+        if token and header and hmac.compare_digest(header.encode(), token.encode()):
+            return True
+        rate = current_app.config.get('PROFILING_SAMPLE_RATE', 0.0)
+        return rate > 0 and random.random() < rate
+
+    @staticmethod
+    def _before_request():
+        if not Profiler._requested():
+            return
+        if not _capture_lock.acquire(blocking=False):
+            logger.info("Profiling skipped: another capture is running")
+            return
+
+        request_id = request.headers.get('X-Request-ID', '')
+        if not REQUEST_ID_PATTERN.match(request_id):
+            request_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+
+        # Allocations made before start are not traced
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start(current_app.config.get('PROFILING_TRACE_FRAMES', 10))
+        tracemalloc.reset_peak()
+
+        g.profile = {
+            'id': request_id,
+            'profiler': cProfile.Profile(),
+            'started_tracing': started_tracing,
+            'start': time.perf_counter(),
+            'baseline': tracemalloc.take_snapshot(),
+        }
+        g.profile['profiler'].enable()
+
+    @staticmethod
+    def _stop():
+        """Stops the current capture. Returns its state, or None if the request was not profiled."""
+        capture = g.pop('profile', None)
+        if capture is None:
+            return None
+        try:
+            capture['profiler'].disable()
+            capture['elapsed'] = time.perf_counter() - capture['start']
+            capture['snapshot'] = tracemalloc.take_snapshot()
+            capture['peak'] = tracemalloc.get_traced_memory()[1]
+            if capture['started_tracing']:
+                tracemalloc.stop()
+        finally:
+            _capture_lock.release()
+        return capture
+
+    @staticmethod
+    def _after_request(response):
+        capture = Profiler._stop()
+        if capture is None:
+            return response
+        try:
+            Profiler._write(capture, response.status_code)
+            response.headers['X-Profile-Id'] = capture['id']
+        except Exception as e:
+            logger.error(f"Error writing profile {capture['id']}: {e}")
+        return response
+
+    @staticmethod
+    def _teardown_request(exc):
+        # Requests that failed without a response still release the profiler
+        if Profiler._stop() is not None:
+            logger.info("Profiling capture discarded: request failed")
+
+    @staticmethod
+    def _write(capture, status):
+        folder = os.path.join(current_app.config['PROFILING_FOLDER'], capture['id'])
+        os.makedirs(folder, exist_ok=True)
+
+        profiler = capture['profiler']
+        profiler.dump_stats(os.path.join(folder, 'profile.prof'))
+        text = io.StringIO()
+        stats = pstats.Stats(profiler, stream=text)
+        stats.sort_stats('cumulative').print_stats(current_app.config.get('PROFILING_TOP', 40))
+        with open(os.path.join(folder, 'profile.txt'), 'w') as f:
+            f.write(text.getvalue())
+
+        top = current_app.config.get('PROFILING_TOP', 40)
+        diff = capture['snapshot'].compare_to(capture['baseline'], 'lineno')
+        with open(os.path.join(folder, 'allocations.txt'), 'w') as f:
+            f.write(f"Peak traced memory: {capture['peak'] / 1024:.1f} KiB\n")
+            f.write(f"Top {top} allocation sites still held at the end of the request:\n\n")
+            for stat in diff[:top]:
+                f.write(f"{stat}\n")
+
+        meta = {
+            'id': capture['id'],
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'method': request.method,
+            'path': request.path,
+            'status': status,
+            'duration_ms': round(capture['elapsed'] * 1000, 1),
+            'peak_kib': round(capture['peak'] / 1024, 1),
+            'pid': os.getpid(),
+        }
+        with open(os.path.join(folder, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+        Profiler._prune(current_app.config['PROFILING_FOLDER'], current_app.config.get('PROFILING_MAX_CAPTURES', 50))
+
+    @staticmethod
+    def _prune(root, keep):
+        """Deletes all but the keep most recent captures."""
+        captures = Profiler.captures(root)
+        for meta in captures[keep:]:
+            shutil.rmtree(os.path.join(root, meta['id']), ignore_errors=True)
+
+    @staticmethod
+    def captures(root):
+        """Returns the meta of every capture under root, most recent first."""
+        captures = []
+        try:
+            entries = os.listdir(root)
+        except FileNotFoundError:
+            return []
+        for name in entries:
+            path = os.path.join(root, name, 'meta.json')
+            try:
+                with open(path) as f:
+                    meta = json.load(f)
+                meta['mtime'] = os.path.getmtime(path)
+            except (OSError, ValueError):
+                continue
+            captures.append(meta)
+        captures.sort(key=lambda meta: meta['mtime'], reverse=True)
+        return captures
+
+    # --- Views ---
+
+    @staticmethod
+    def index():
+        if not client_allowed('PROFILING_ALLOWED_NETWORKS'):
+            abort(403)
+        captures = Profiler.captures(current_app.config['PROFILING_FOLDER'])
+        return render_template('profiles.html', captures=captures, files=CAPTURE_FILES)
+
+    @staticmethod
+    def download(capture_id, name):
+        if not client_allowed('PROFILING_ALLOWED_NETWORKS'):
+            abort(403)
+        if not REQUEST_ID_PATTERN.match(capture_id) or name not in CAPTURE_FILES:
+            abort(404)
+        folder = os.path.join(current_app.config['PROFILING_FOLDER'], capture_id)
+        mimetype = 'application/octet-stream' if name.endswith('.prof') else None
+        return send_from_directory(folder, name, mimetype=mimetype, as_attachment=name.endswith('.prof'))
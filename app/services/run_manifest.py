@@ -0,0 +1,119 @@
+import os
+import time
+import sqlite3
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+# Schema migrations, applied in order (see FileIndex)
+MIGRATIONS = [
+    [
+        # Last outcome of each source file (path relative to the input directory) per task
+        """CREATE TABLE files (
+            path TEXT NOT NULL,
+            task TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            sha256 TEXT,
+            status TEXT NOT NULL,
+            output TEXT,
+            error TEXT,
+            updated REAL NOT NULL,
+            PRIMARY KEY (path, task)
+        )""",
+        """CREATE TABLE runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            task TEXT NOT NULL,
+            started REAL NOT NULL,
+            finished REAL,
+            processed INTEGER NOT NULL DEFAULT 0,
+            skipped INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            bytes INTEGER NOT NULL DEFAULT 0
+        )""",
+    ],
+    [
+        # Size and mtime of the output as written, so an output another task
+        # overwrote in the same directory is not taken for this task's
+        "ALTER TABLE files ADD COLUMN output_size INTEGER",
+        "ALTER TABLE files ADD COLUMN output_mtime_ns INTEGER",
+    ],
+]
+
+# Columns of a file record
+FILE_COLUMNS = ('path', 'task', 'size', 'mtime_ns', 'sha256', 'status', 'output', 'error',
+                'output_size', 'output_mtime_ns')
+
+
+class RunManifest:
+    """
+    SQLite record of a directory run (see DirectoryPipeline), kept in the
+    output directory. Every finished file is recorded with its size,
+    mtime, content hash and outcome, so an interrupted or repeated run
+    skips the files already done and only processes new or changed ones.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self._migrate()
+
+    def _connect(self):
+        # One connection per thread and process
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _migrate(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            for statements in MIGRATIONS[version:]:
+                for statement in statements:
+                    conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {len(MIGRATIONS)}")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def lookup(self, path, task):
+        """Returns the record of a source file for a task as a dict, or None."""
+        row = self._connect().execute(
+            f"SELECT {', '.join(FILE_COLUMNS)} FROM files WHERE path = ? AND task = ?", (path, task)
+        ).fetchone()
+        return dict(zip(FILE_COLUMNS, row)) if row else None
+
+    def record(self, records, now=None):
+        """Saves file records (dicts with FILE_COLUMNS) in one transaction."""
+        now = time.time() if now is None else now
+        with self._connect() as conn:
+            conn.executemany(
+                f"INSERT OR REPLACE INTO files ({', '.join(FILE_COLUMNS)}, updated) "
+                f"VALUES ({', '.join('?' * len(FILE_COLUMNS))}, ?)",
+                [tuple(r.get(column) for column in FILE_COLUMNS) + (now,) for r in records]
+            )
+
+    def start_run(self, task, now=None):
+        with self._connect() as conn:
+            return conn.execute(
+                "INSERT INTO runs (task, started) VALUES (?, ?)", (task, time.time() if now is None else now)
+            ).lastrowid
+
+    def finish_run(self, run_id, processed, skipped, failed, size, now=None):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE runs SET finished = ?, processed = ?, skipped = ?, failed = ?, bytes = ? WHERE id = ?",
+                (time.time() if now is None else now, processed, skipped, failed, size, run_id)
+            )
@@ -0,0 +1,469 @@
+import os
+import shutil
+import tempfile
+import logging
+from contextlib import contextmanager
+
+
+logger = logging.getLogger(__name__)
+
+# JPEG markers
+SOI = 0xD8
+EOI = 0xD9
+SOS = 0xDA
+APP0 = 0xE0
+APP1 = 0xE1
+APP13 = 0xED
+COM = 0xFE
+
+EXIF_HEADER = b'Exif\x00\x00'
+
+# Markers that carry no length field (TEM, RST0-RST7)
+STANDALONE_MARKERS = {0x01} | set(range(0xD0, 0xD8))
+
+# Segments dropped when purifying: APP1 (Exif/XMP), APP13 (IPTC/Photoshop) and comments
+JPEG_METADATA_MARKERS = {APP1, APP13, COM}
+
+# Copy buffer for the entropy-coded scan data
+COPY_CHUNK_SIZE = 1024 * 1024
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# PNG chunks dropped when purifying (IDAT and the rest are copied verbatim)
+PNG_METADATA_CHUNKS = {b'eXIf', b'tEXt', b'iTXt', b'zTXt', b'tIME'}
+
+# WebP chunks dropped when purifying, and the VP8X flags announcing them
+WEBP_METADATA_CHUNKS = {b'EXIF', b'XMP '}
+VP8X_EXIF_FLAG = 0x08
+VP8X_XMP_FLAG = 0x04
+
+# TIFF field types and their sizes in bytes
+TIFF_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8, 11: 4, 12: 8, 13: 4}
+
+# TIFF tags pointing to the Exif, GPS and Interoperability IFDs
+TIFF_IFD_POINTERS = {34665, 34853, 40965}
+
+# TIFF tags dropped when purifying: descriptive text, XMP, IPTC, Photoshop,
+# Windows XP tags and the Exif/GPS IFDs
+TIFF_METADATA_TAGS = {
+    270, 271, 272, 305, 306, 315, 316, 33432,  # ImageDescription ... Copyright
+    700, 33723, 34377, 37724,                   # XMP, IPTC, Photoshop, ImageSourceData
+    40091, 40092, 40093, 40094, 40095,          # XPTitle ... XPSubject
+    34665, 34853,                               # Exif IFD, GPS IFD
+}
+
+# (offsets, byte counts) tag pairs locating image data
+TIFF_DATA_TAGS = ((273, 279), (324, 325), (513, 514))
+
+# SubIFDs: image data in nested IFDs, not handled
+TIFF_SUB_IFDS = 330
+
+# Upper bound for a single metadata block read into memory
+MAX_METADATA_BYTES = 16 * 1024 * 1024
+
+
+class SegmentEditor:
+    """
+    Edits image containers at the segment level, without decoding pixel data.
+    Methods raise ValueError when the file is not in a format they can handle,
+    so callers can fall back to a full Pillow decode.
+    """
+
+    @staticmethod
+    def iter_jpeg_segments(f):
+        """
+        Walks the JPEG marker segments of an open binary file.
+        Yields (marker, payload) tuples up to and including the first SOS header,
+        leaving the file positioned at the start of the entropy-coded data.
+        """
+        if f.read(2) != b'\xff\xd8':
+            raise ValueError("Not a JPEG file")
+
+        while True:
+            if f.read(1) != b'\xff':
+                raise ValueError("Malformed JPEG marker")
+
+            marker = f.read(1)
+            # Skip optional fill bytes
+            while marker == b'\xff':
+                marker = f.read(1)
+            if not marker:
+                raise ValueError("Unexpected end of JPEG data")
+
+            code = marker[0]
+            if code in STANDALONE_MARKERS:
+                yield code, b''
+                continue
+            if code == EOI:
+                yield code, b''
+                return
+
+            length_bytes = f.read(2)
+            if len(length_bytes) != 2:
+                raise ValueError("Truncated JPEG segment header")
+            length = int.from_bytes(length_bytes, 'big')
+            if length < 2:
+                raise ValueError("Invalid JPEG segment length")
+
+            payload = f.read(length - 2)
+            if len(payload) != length - 2:
+                raise ValueError("Truncated JPEG segment")
+
+            yield code, payload
+
+            if code == SOS:
+                return
+
+    @staticmethod
+    def write_jpeg_segment(f, code, payload=b''):
+        f.write(bytes((0xFF, code)))
+        if code in STANDALONE_MARKERS or code == EOI:
+            return
+        if len(payload) + 2 > 0xFFFF:
+            raise ValueError("JPEG segment too large")
+        f.write((len(payload) + 2).to_bytes(2, 'big'))
+        f.write(payload)
+
+    @staticmethod
+    def strip_jpeg(source_path, dest_path, drop_markers=JPEG_METADATA_MARKERS):
+        """
+        Copies a JPEG to dest_path without its metadata segments.
+        Scan data is copied byte for byte, so the image is not re-encoded.
+        """
+        with open(source_path, 'rb') as src:
+            with SegmentEditor.atomic_output(dest_path) as dst:
+                dst.write(b'\xff\xd8')
+                for code, payload in SegmentEditor.iter_jpeg_segments(src):
+                    if code in drop_markers:
+                        continue
+                    SegmentEditor.write_jpeg_segment(dst, code, payload)
+                # Everything after the first SOS header (scans, tables of
+                # progressive images, EOI, trailing data) is copied verbatim.
+                shutil.copyfileobj(src, dst, COPY_CHUNK_SIZE)
+        return dest_path
+
+    @staticmethod
+    def strip(source_path, dest_path):
+        """Copies a JPEG, PNG, WebP or TIFF to dest_path without its metadata."""
+        with open(source_path, 'rb') as f:
+            head = f.read(12)
+        if head.startswith(b'\xff\xd8'):
+            return SegmentEditor.strip_jpeg(source_path, dest_path)
+        if head.startswith(PNG_SIGNATURE):
+            return SegmentEditor.strip_png(source_path, dest_path)
+        if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+            return SegmentEditor.strip_webp(source_path, dest_path)
+        if head[:4] in (b'II*\x00', b'MM\x00*'):
+            return SegmentEditor.strip_tiff(source_path, dest_path)
+        raise ValueError("Unsupported container")
+
+    @staticmethod
+    def strip_png(source_path, dest_path, drop_chunks=PNG_METADATA_CHUNKS):
+        """
+        Copies a PNG to dest_path without its metadata chunks. IDAT and every
+        other chunk are copied with their CRC, so nothing is re-deflated.
+        """
+        with open(source_path, 'rb') as src:
+            if src.read(len(PNG_SIGNATURE)) != PNG_SIGNATURE:
+                raise ValueError("Not a PNG file")
+            with SegmentEditor.atomic_output(dest_path) as dst:
+                dst.write(PNG_SIGNATURE)
+                while True:
+                    header = src.read(8)
+                    if len(header) != 8:
+                        raise ValueError("Truncated PNG file")
+                    length = int.from_bytes(header[:4], 'big')
+                    chunk_type = header[4:]
+                    if chunk_type in drop_chunks:
+                        src.seek(length + 4, os.SEEK_CUR)  # data + CRC
+                    else:
+                        dst.write(header)
+                        SegmentEditor._copy_bytes(src, dst, length + 4)
+                    if chunk_type == b'IEND':
+                        break
+        return dest_path
+
+    @staticmethod
+    def strip_webp(source_path, dest_path, drop_chunks=WEBP_METADATA_CHUNKS):
+        """
+        Rewrites the RIFF container of a WebP to dest_path without its EXIF
+        and XMP chunks, clearing their VP8X flags. The bitstream is copied.
+        """
+        with open(source_path, 'rb') as src:
+            head = src.read(12)
+            if head[:4] != b'RIFF' or head[8:12] != b'WEBP':
+                raise ValueError("Not a WebP file")
+            riff_end = 8 + int.from_bytes(head[4:8], 'little')
+
+            # Chunk table from the headers only: the output size goes first
+            chunks = []
+            position = 12
+            while position + 8 <= riff_end:
+                src.seek(position)
+                header = src.read(8)
+                if len(header) != 8:
+                    raise ValueError("Truncated WebP chunk")
+                size = int.from_bytes(header[4:], 'little')
+                length = 8 + size + (size & 1)  # chunks are padded to even sizes
+                if header[:4] not in drop_chunks:
+                    chunks.append((header[:4], position, length))
+                position += length
+
+            with SegmentEditor.atomic_output(dest_path) as dst:
+                dst.write(b'RIFF' + (4 + sum(length for _, _, length in chunks)).to_bytes(4, 'little') + b'WEBP')
+                for fourcc, position, length in chunks:
+                    src.seek(position)
+                    if fourcc == b'VP8X':
+                        data = bytearray(src.read(length))
+                        if len(data) < 9:
+                            raise ValueError("Truncated VP8X chunk")
+                        data[8] &= ~(VP8X_EXIF_FLAG | VP8X_XMP_FLAG) & 0xFF
+                        dst.write(data)
+                    else:
+                        SegmentEditor._copy_bytes(src, dst, length)
+        return dest_path
+
+    @staticmethod
+    def strip_tiff(source_path, dest_path, drop_tags=TIFF_METADATA_TAGS):
+        """
+        Copies a TIFF to dest_path with drop_tags removed from every IFD of
+        the main chain. Each IFD is rewritten in place and the bytes of the
+        removed values (and of the Exif/GPS IFDs) are zeroed; strips and
+        tiles keep their offsets and are not re-encoded.
+        """
+        with open(source_path, 'rb') as src:
+            header = src.read(8)
+            if header[:4] == b'II*\x00':
+                order = 'little'
+            elif header[:4] == b'MM\x00*':
+                order = 'big'
+            else:
+                raise ValueError("Not a classic TIFF file")
+            src.seek(0, os.SEEK_END)
+            file_size = src.tell()
+
+            ifds = []
+            seen = set()
+            offset = int.from_bytes(header[4:8], order)
+            while offset:
+                if offset in seen:
+                    raise ValueError("TIFF IFD loop")
+                seen.add(offset)
+                entries, next_offset = SegmentEditor._read_tiff_ifd(src, offset, order, file_size)
+                ifds.append((offset, entries, next_offset))
+                offset = next_offset
+
+            kept_ranges, dropped_ranges = [], []
+            for _, entries, _ in ifds:
+                tags = {entry[0]: entry for entry in entries}
+                if TIFF_SUB_IFDS in tags:
+                    raise ValueError("TIFF SubIFDs are not supported")
+                for entry in entries:
+                    if entry[0] in drop_tags:
+                        dropped_ranges += SegmentEditor._tiff_entry_ranges(src, entry, order, file_size, set())
+                    else:
+                        kept_ranges += SegmentEditor._tiff_entry_ranges(src, entry, order, file_size, None)
+                for offsets_tag, counts_tag in TIFF_DATA_TAGS:
+                    if offsets_tag in tags and counts_tag in tags:
+                        offsets = SegmentEditor._tiff_values(src, tags[offsets_tag], order)
+                        counts = SegmentEditor._tiff_values(src, tags[counts_tag], order)
+                        kept_ranges += list(zip(offsets, counts))
+
+            # Never zero bytes that something kept still points to
+            for start, length in dropped_ranges:
+                for kept_start, kept_length in kept_ranges:
+                    if start < kept_start + kept_length and kept_start < start + length:
+                        raise ValueError("TIFF metadata shares bytes with image data")
+
+            src.seek(0)
+            with SegmentEditor.atomic_output(dest_path) as dst:
+                shutil.copyfileobj(src, dst, COPY_CHUNK_SIZE)
+                for offset, entries, next_offset in ifds:
+                    kept = [entry for entry in entries if entry[0] not in drop_tags]
+                    dst.seek(offset)
+                    dst.write(len(kept).to_bytes(2, order))
+                    for entry in kept:
+                        dst.write(entry[4])
+                    dst.write(next_offset.to_bytes(4, order))
+                    dst.write(b'\x00' * (12 * (len(entries) - len(kept))))
+                for start, length in dropped_ranges:
+                    dst.seek(start)
+                    dst.write(b'\x00' * length)
+        return dest_path
+
+    @staticmethod
+    def _read_tiff_ifd(f, offset, order, file_size):
+        """Returns ([(tag, type, count, value_field, raw_entry)], next_ifd_offset)."""
+        if offset + 2 > file_size:
+            raise ValueError("TIFF IFD out of bounds")
+        f.seek(offset)
+        count = int.from_bytes(f.read(2), order)
+        data = f.read(12 * count + 4)
+        if len(data) != 12 * count + 4:
+            raise ValueError("Truncated TIFF IFD")
+        entries = []
+        for i in range(count):
+            raw = data[12 * i:12 * i + 12]
+            entries.append((
+                int.from_bytes(raw[0:2], order), int.from_bytes(raw[2:4], order),
+                int.from_bytes(raw[4:8], order), raw[8:12], raw
+            ))
+        return entries, int.from_bytes(data[-4:], order)
+
+    @staticmethod
+    def _tiff_entry_ranges(f, entry, order, file_size, follow):
+        """
+        Returns the (start, length) ranges of the out-of-line value of entry.
+        With follow (a set of visited offsets), the Exif/GPS/Interop IFDs it
+        points to are included, with their own values.
+        """
+        tag, field_type, count, value_field, _ = entry
+        if field_type not in TIFF_TYPE_SIZES:
+            raise ValueError(f"Unknown TIFF field type {field_type}")
+        ranges = []
+        size = TIFF_TYPE_SIZES[field_type] * count
+        if size > 4:
+            start = int.from_bytes(value_field, order)
+            if start + size > file_size:
+                raise ValueError("TIFF value out of bounds")
+            ranges.append((start, size))
+
+        if follow is not None and tag in TIFF_IFD_POINTERS and count == 1:
+            offset = int.from_bytes(value_field, order)
+            if offset and offset not in follow:
+                follow.add(offset)
+                entries, _ = SegmentEditor._read_tiff_ifd(f, offset, order, file_size)
+                ranges.append((offset, 2 + 12 * len(entries) + 4))
+                for sub_entry in entries:
+                    ranges += SegmentEditor._tiff_entry_ranges(f, sub_entry, order, file_size, follow)
+        return ranges
+
+    @staticmethod
+    def _tiff_values(f, entry, order):
+        """Returns the integer values of a SHORT, LONG or IFD entry."""
+        _, field_type, count, value_field, _ = entry
+        if field_type not in (3, 4, 13):
+            raise ValueError("Unexpected TIFF offset type")
+        item_size = TIFF_TYPE_SIZES[field_type]
+        if item_size * count <= 4:
+            data = value_field
+        else:
+            f.seek(int.from_bytes(value_field, order))
+            data = f.read(item_size * count)
+            if len(data) != item_size * count:
+                raise ValueError("Truncated TIFF value")
+        return [int.from_bytes(data[i:i + item_size], order) for i in range(0, item_size * count, item_size)]
+
+    @staticmethod
+    def _copy_bytes(src, dst, length):
+        """Copies exactly length bytes from src to dst."""
+        while length > 0:
+            chunk = src.read(min(length, COPY_CHUNK_SIZE))
+            if not chunk:
+                raise ValueError("Unexpected end of file")
+            dst.write(chunk)
+            length -= len(chunk)
+
+    @staticmethod
+    def read_exif_block(source_path):
+        """
+        Returns the raw EXIF block of a JPEG, PNG or WebP file, or None.
+        Only metadata is read: JPEG parsing stops at the first SOS, PNG at the
+        first IDAT, and WebP chunks other than EXIF are skipped with seeks.
+        Raises ValueError for other formats.
+        """
+        with open(source_path, 'rb') as f:
+            head = f.read(12)
+            f.seek(0)
+            if head.startswith(b'\xff\xd8'):
+                for code, payload in SegmentEditor.iter_jpeg_segments(f):
+                    if code == APP1 and payload.startswith(EXIF_HEADER):
+                        return payload
+                return None
+            if head.startswith(PNG_SIGNATURE):
+                return SegmentEditor._read_png_exif(f)
+            if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+                return SegmentEditor._read_webp_exif(f)
+        raise ValueError("Unsupported container")
+
+    @staticmethod
+    def _read_png_exif(f):
+        f.seek(len(PNG_SIGNATURE))
+        while True:
+            header = f.read(8)
+            if len(header) != 8:
+                return None
+            length = int.from_bytes(header[:4], 'big')
+            chunk_type = header[4:]
+            if chunk_type in (b'IDAT', b'IEND'):
+                return None
+            if chunk_type == b'eXIf':
+                if length > MAX_METADATA_BYTES:
+                    raise ValueError("EXIF chunk too large")
+                data = f.read(length)
+                if len(data) != length:
+                    raise ValueError("Truncated PNG chunk")
+                return data
+            f.seek(length + 4, os.SEEK_CUR)  # data + CRC
+
+    @staticmethod
+    def _read_webp_exif(f):
+        f.seek(12)
+        while True:
+            header = f.read(8)
+            if len(header) != 8:
+                return None
+            size = int.from_bytes(header[4:], 'little')
+            if header[:4] == b'EXIF':
+                if size > MAX_METADATA_BYTES:
+                    raise ValueError("EXIF chunk too large")
+                data = f.read(size)
+                if len(data) != size:
+                    raise ValueError("Truncated WebP chunk")
+                return data
+            f.seek(size + (size & 1), os.SEEK_CUR)  # chunks are padded to even sizes
+
+    @staticmethod
+    def replace_jpeg_exif(source_path, dest_path, exif_bytes):
+        """
+        Copies a JPEG to dest_path with its Exif APP1 segment replaced by
+        exif_bytes (or removed if exif_bytes is None). XMP and every other
+        segment, as well as the scan data, are left untouched.
+        """
+        if exif_bytes is not None and not exif_bytes.startswith(EXIF_HEADER):
+            exif_bytes = EXIF_HEADER + exif_bytes
+
+        with open(source_path, 'rb') as src:
+            with SegmentEditor.atomic_output(dest_path) as dst:
+                dst.write(b'\xff\xd8')
+                inserted = exif_bytes is None
+                for code, payload in SegmentEditor.iter_jpeg_segments(src):
+                    if code == APP1 and payload.startswith(EXIF_HEADER):
+                        continue
+                    # Exif goes right after SOI, or after the JFIF APP0 if present
+                    if not inserted and code != APP0:
+                        SegmentEditor.write_jpeg_segment(dst, APP1, exif_bytes)
+                        inserted = True
+                    SegmentEditor.write_jpeg_segment(dst, code, payload)
+                shutil.copyfileobj(src, dst, COPY_CHUNK_SIZE)
+        return dest_path
+
+    @staticmethod
+    @contextmanager
+    def atomic_output(dest_path):
+        """
+        Yields a file object writing to a temporary file next to dest_path,
+        renamed over dest_path on success. Allows dest_path == source_path.
+        """
+        dir_name = os.path.dirname(dest_path) or '.'
+        fd, temp_path = tempfile.mkstemp(dir=dir_name, prefix='.tmp_')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                yield f
+            os.replace(temp_path, dest_path)
+        except BaseException:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
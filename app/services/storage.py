@@ -0,0 +1,217 @@
+import os
+import time
+import shutil
+import hashlib
+import logging
+import threading
+from werkzeug.utils import secure_filename
+
+
+logger = logging.getLogger(__name__)
+
+LAYOUTS = ('flat', 'sharded')
+
+_instances = {}
+_instances_lock = threading.Lock()
+
+
+class Storage:
+    """
+    Where stored files live. The disk tier is UPLOAD_FOLDER, either flat or
+    sharded as <ab>/<cd>/<name> (ab, cd from a hash of the name) so no
+    directory grows past a few hundred entries. An optional memory tier
+    (a tmpfs such as /dev/shm) holds small derived files under a byte
+    budget; the least recently used ones spill to disk when it is full.
+
+    Both tiers are plain directories, so services keep working on paths.
+    Uploads always go to disk: they are hard links into the ContentStore,
+    which must be on the same filesystem.
+    """
+
+    def __init__(self, root, layout='sharded', memory_root=None, memory_bytes=0, memory_max_file_bytes=0):
+        if layout not in LAYOUTS:
+            raise ValueError(f"Unknown storage layout: {layout}")
+        self.root = root
+        self.layout = layout
+        self.memory_root = memory_root if memory_root and memory_bytes else None
+        self.memory_bytes = memory_bytes
+        self.memory_max_file_bytes = memory_max_file_bytes
+
+    @staticmethod
+    def get(config):
+        """Returns the shared Storage for an app (or worker) config."""
+        settings = (
+            config['UPLOAD_FOLDER'],
+            config.get('STORAGE_LAYOUT', 'sharded'),
+            config.get('STORAGE_MEMORY_FOLDER'),
+            config.get('STORAGE_MEMORY_BYTES', 0),
+            config.get('STORAGE_MEMORY_MAX_FILE_BYTES', 0),
+        )
+        with _instances_lock:
+            storage = _instances.get(settings)
+            if storage is None:
+                storage = Storage(*settings)
+                _instances[settings] = storage
+            return storage
+
+    def _relpath(self, name):
+        name = secure_filename(name)
+        if self.layout == 'flat':
+            return name
+        digest = hashlib.md5(name.encode()).hexdigest()
+        return os.path.join(digest[:2], digest[2:4], name)
+
+    def disk_path(self, name):
+        return os.path.join(self.root, self._relpath(name))
+
+    def memory_path(self, name):
+        return os.path.join(self.memory_root, self._relpath(name)) if self.memory_root else None
+
+    def path(self, name):
+        """Returns the path of a stored file: its memory copy if it has one, else its disk path."""
+        memory_path = self.memory_path(name)
+        if memory_path and os.path.exists(memory_path):
+            return memory_path
+        return self.disk_path(name)
+
+    def writable_path(self, name):
+        """Returns the disk path for a new file, creating its shard directory."""
+        path = self.disk_path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def exists(self, name):
+        return os.path.exists(self.path(name))
+
+    def open(self, name, mode='rb'):
+        return open(self.path(name), mode)
+
+    def remove(self, name):
+        """Deletes every copy of a stored file. Returns True if one was removed."""
+        removed = False
+        for path in (self.memory_path(name), self.disk_path(name)):
+            if not path:
+                continue
+            try:
+                os.remove(path)
+                removed = True
+            except FileNotFoundError:
+                pass
+        return removed
+
+    def adopt(self, path, name):
+        """
+        Moves a file written by an operation (usually next to its source) to
+        its place in storage. Files small enough for the memory tier go there.
+        Returns the tier the file now lives in ('memory' or 'disk').
+        """
+        tier = 'disk'
+        if self.memory_root and os.path.getsize(path) <= min(self.memory_max_file_bytes, self.memory_bytes):
+            tier = 'memory'
+        target = self.memory_path(name) if tier == 'memory' else self.disk_path(name)
+        stale = self.disk_path(name) if tier == 'memory' else self.memory_path(name)
+
+        if os.path.abspath(path) != os.path.abspath(target):
+            self._move(path, target)
+        if stale and os.path.abspath(stale) != os.path.abspath(target):
+            try:
+                os.remove(stale)  # Older copy in the other tier would shadow or outlive it
+            except FileNotFoundError:
+                pass
+        return tier
+
+    def spill(self, index):
+        """
+        Moves least recently used memory-tier files to disk until the tier
+        fits its byte budget. Returns the number of files moved.
+        """
+        if not self.memory_root:
+            return 0
+        moved = 0
+        while index.tier_bytes('memory') > self.memory_bytes:
+            candidates = index.least_recent_in_tier('memory')
+            if not candidates:
+                break
+            for name, size in candidates:
+                try:
+                    self._move(self.memory_path(name), self.disk_path(name))
+                    moved += 1
+                except FileNotFoundError:
+                    pass  # Deleted or spilled by another worker
+                index.set_tier(name, 'disk')
+                if index.tier_bytes('memory') <= self.memory_bytes:
+                    break
+        return moved
+
+    @staticmethod
+    def _move(source, dest):
+        """Renames source to dest; across filesystems, copies then renames so dest is never partial."""
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        try:
+            os.replace(source, dest)
+            return
+        except OSError as e:
+            if isinstance(e, FileNotFoundError):
+                raise
+        tmp = os.path.join(os.path.dirname(dest), f".spill_{os.path.basename(dest)}")
+        try:
+            shutil.copyfile(source, tmp)
+            os.replace(tmp, dest)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        os.remove(source)
+
+    def scan(self):
+        """
+        Yields (name, tier, stat) for every stored file. Files found outside
+        their place (e.g. after switching layouts) are moved there first.
+        Hidden files (uploads being spooled, ...) are skipped.
+        """
+        for tier, root in (('memory', self.memory_root), ('disk', self.root)):
+            if not root or not os.path.exists(root):
+                continue
+            for dir_path, dir_names, file_names in os.walk(root):
+                dir_names[:] = [d for d in dir_names if not d.startswith('.')]
+                for name in file_names:
+                    if name.startswith('.'):
+                        continue
+                    path = os.path.join(dir_path, name)
+                    place = os.path.join(root, self._relpath(name))
+                    try:
+                        if path != place:
+                            self._move(path, place)
+                        yield name, tier, os.stat(place)
+                    except OSError as e:
+                        logger.error(f"Error scanning stored file {name}: {e}")
+
+    def sweep_hidden(self, max_age_seconds, now=None):
+        """
+        Deletes hidden files (temporary files of uploads, bulk runs and
+        atomic writes) older than max_age_seconds, left behind when a
+        worker died before renaming or removing them. scan and the index
+        never see them. Returns (files_removed, bytes_removed).
+        """
+        cutoff = (time.time() if now is None else now) - max_age_seconds
+        files = 0
+        removed = 0
+        for root in (self.memory_root, self.root):
+            if not root or not os.path.exists(root):
+                continue
+            for dir_path, dir_names, file_names in os.walk(root):
+                for name in file_names:
+                    if not name.startswith('.'):
+                        continue
+                    path = os.path.join(dir_path, name)
+                    try:
+                        st = os.stat(path)
+                        if st.st_mtime >= cutoff:
+                            continue  # May still be in use
+                        os.remove(path)
+                        files += 1
+                        removed += st.st_size
+                    except FileNotFoundError:
+                        continue
+                    except OSError as e:
+                        logger.error(f"Error removing temporary file {name}: {e}")
+        return files, removed
@@ -0,0 +1,57 @@
+import fnmatch
+import piexif
+from PIL.ExifTags import GPSTAGS
+
+
+# Tag tables per piexif IFD group, in the order names are resolved
+IFD_TABLES = {
+    "0th": {tag_id: info["name"] for tag_id, info in piexif.TAGS["Image"].items()},
+    "Exif": {tag_id: info["name"] for tag_id, info in piexif.TAGS["Exif"].items()},
+    "GPS": dict(GPSTAGS),
+}
+
+# (group, tag_id) -> name
+TAG_TO_NAME = {
+    (group, tag_id): name
+    for group, table in IFD_TABLES.items()
+    for tag_id, name in table.items()
+}
+
+# name -> [(group, tag_id), ...]; some names (e.g. ExposureTime) exist in several IFDs
+NAME_TO_TAGS = {}
+for (_group, _tag_id), _name in TAG_TO_NAME.items():
+    NAME_TO_TAGS.setdefault(_name, []).append((_group, _tag_id))
+
+
+class TagIndex:
+    """
+    Precomputed, bidirectional index between EXIF tag names and (IFD group, tag ID).
+    Built once at import time.
+    """
+
+    @staticmethod
+    def lookup(tag_name):
+        """
+        Returns (group_name, tag_id) for a tag name, preferring the 0th IFD,
+        then Exif, then GPS. Returns (None, None) for unknown names.
+        """
+        tags = NAME_TO_TAGS.get(tag_name)
+        if not tags:
+            return None, None
+        return tags[0]
+
+    @staticmethod
+    def name_of(group_name, tag_id):
+        return TAG_TO_NAME.get((group_name, tag_id))
+
+    @staticmethod
+    def match(pattern):
+        """Returns every (group_name, tag_id) whose name matches a name or glob pattern."""
+        if not any(c in pattern for c in '*?['):
+            return list(NAME_TO_TAGS.get(pattern, ()))
+        return [
+            tag
+            for name, tags in NAME_TO_TAGS.items()
+            if fnmatch.fnmatchcase(name, pattern)
+            for tag in tags
+        ]
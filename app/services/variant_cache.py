@@ -0,0 +1,126 @@
+import os
+import hashlib
+import logging
+from PIL import Image
+from flask import current_app
+from app.services.segment_editor import SegmentEditor
+from app.services.file_index import FileIndex
+from app.services.metrics import Metrics
+
+
+logger = logging.getLogger(__name__)
+
+# Bump when the encoding below changes so stale variants are not served
+ENCODER_VERSION = 'v1'
+
+
+class VariantCache:
+    """
+    On-disk cache of derived artifacts (recompressed downloads, previews), keyed by
+    (source identity, quality, encoder options) and bounded by an LRU byte
+    budget (VARIANT_CACHE_BYTES).
+    The source identity is the content hash for stored uploads, otherwise a
+    fingerprint of inode, size and mtime, so rewriting a file invalidates
+    its variants.
+    """
+
+    @staticmethod
+    def source_key(file_path, content_hash=None):
+        if content_hash:
+            return content_hash
+        st = os.stat(file_path)
+        return f"f{st.st_dev:x}-{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"
+
+    @staticmethod
+    def variant_path(key, folder=None):
+        folder = folder or current_app.config['VARIANT_FOLDER']
+        return os.path.join(folder, key[:2], key)
+
+    @staticmethod
+    def get_or_render(file_path, quality, content_hash=None):
+        """
+        Returns (path, format) of file_path recompressed at quality, in its
+        original format. Encodes only on a cache miss.
+        """
+        return VariantCache.get_or_create(
+            file_path, f"preserve|q{quality}",
+            lambda dest_path: VariantCache.render(file_path, dest_path, quality),
+            content_hash, operation='download_variant'
+        )
+
+    @staticmethod
+    def get_or_create(file_path, params, render, content_hash=None, operation='variant'):
+        """
+        Returns (path, format) of the variant of file_path described by params.
+        On a miss, render(dest_path) writes it and returns its format.
+        """
+        index = FileIndex.get(current_app.config['INDEX_DB_PATH'])
+        source = VariantCache.source_key(file_path, content_hash)
+        key = VariantCache.variant_key(source, params)
+        path = VariantCache.variant_path(key)
+
+        fmt = index.variant_hit(key)
+        if fmt and os.path.exists(path):
+            Metrics.inc('picturify_variant_cache_total', result='hit')
+            return path, fmt
+        Metrics.inc('picturify_variant_cache_total', result='miss')
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with Metrics.timer(operation, 'encode'):
+            fmt = render(path)
+        index.add_variant(key, source, fmt, os.path.getsize(path))
+        VariantCache.enforce_budget(index, keep=key)
+        return path, fmt
+
+    @staticmethod
+    def variant_key(source, params):
+        return hashlib.sha1(f"{source}|{params}|{ENCODER_VERSION}".encode()).hexdigest()
+
+    @staticmethod
+    def render(file_path, dest_path, quality):
+        """Recompresses file_path into dest_path, keeping its format (and EXIF for JPEG)."""
+        with Image.open(file_path) as img:
+            fmt = img.format if img.format else 'JPEG'
+            with SegmentEditor.atomic_output(dest_path) as f:
+                if fmt == 'JPEG':
+                    # Keep EXIF if present
+                    exif = img.info.get('exif')
+                    if exif:
+                        img.save(f, fmt, quality=quality, exif=exif)
+                    else:
+                        img.save(f, fmt, quality=quality)
+                else:
+                    # PNG/WEBP etc
+                    img.save(f, fmt, quality=quality)
+        return fmt
+
+    @staticmethod
+    def enforce_budget(index, keep=None):
+        budget = current_app.config.get('VARIANT_CACHE_BYTES', 512 * 1024 * 1024)
+        while index.variant_bytes() > budget:
+            candidates = [c for c in index.least_recent_variants() if c[0] != keep]
+            if not candidates:
+                return
+            for key, size in candidates:
+                VariantCache._discard(index, index.remove_variants(key=key))
+                if index.variant_bytes() <= budget:
+                    return
+
+    @staticmethod
+    def invalidate(source, index=None, folder=None):
+        """
+        Drops every cached variant of a source (content hash or fingerprint).
+        index and folder default to the app's (pass them outside an app context).
+        """
+        index = index or FileIndex.get(current_app.config['INDEX_DB_PATH'])
+        VariantCache._discard(index, index.remove_variants(source=source), folder)
+
+    @staticmethod
+    def _discard(index, keys, folder=None):
+        for key in keys:
+            try:
+                os.remove(VariantCache.variant_path(key, folder))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.error(f"Error removing cached variant {key}: {e}")
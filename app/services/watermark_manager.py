@@ -1,85 +1,111 @@
-from PIL import Image, ImageDraw, ImageFont, ImageEnhance
+from PIL import Image, ImageDraw, ImageFont
 import os
 import logging
-from flask import current_app
+from functools import lru_cache
+from app.services.metrics import Metrics
+from app.services.processing_options import ProcessingOptions
 
 logger = logging.getLogger(__name__)
 
+FONT_PATH = "arial.ttf"
+
+# Rendered text tiles kept per process. Each is only as large as the text.
+TILE_CACHE_SIZE = 16
+
+
+@lru_cache(maxsize=32)
+def _load_font(font_path, size):
+    """Loads a font once per (path, size) and process."""
+    try:
+        return ImageFont.truetype(font_path, size)
+    except IOError:
+        return ImageFont.load_default()
+
+
+@lru_cache(maxsize=TILE_CACHE_SIZE)
+def _render_tile(text, font_path, font_size, opacity):
+    """
+    Renders text as an L mask cropped to its bounding box.
+    Returns (mask, (left, top)), the offset of the box from the text origin.
+    """
+    font = _load_font(font_path, font_size)
+    left, top, right, bottom = ImageDraw.Draw(Image.new("L", (1, 1))).textbbox((0, 0), text, font=font)
+    mask = Image.new("L", (max(1, right - left), max(1, bottom - top)), 0)
+    ImageDraw.Draw(mask).text((-left, -top), text, font=font, fill=int(255 * opacity))
+    return mask, (left, top)
+
+
 class WatermarkManager:
     @staticmethod
-    def apply_watermark(source_path, text, position='center', opacity=0.5, dest_path=None):
+    def get_overlay(text, size, position='center', opacity=0.5):
+        """
+        Returns (mask, (x, y)): the text mask for an image of the given size
+        and where to paste it. Images of equal dimensions share the same
+        cached mask.
+        """
+        width, height = size
+        # Use a large font size relative to image height (e.g., 5%)
+        font_size = max(10, int(height * 0.05))
+        mask, (left, top) = _render_tile(text, FONT_PATH, font_size, float(opacity))
+        text_width, text_height = mask.size
+
+        x, y = 0, 0
+        padding = int(width * 0.02)  # 2% padding
+
+        if position == 'center':
+            x = (width - text_width) / 2
+            y = (height - text_height) / 2
+        elif position == 'bottom-right':
+            x = width - text_width - padding
+            y = height - text_height - padding
+        elif position == 'bottom-left':
+            x = padding
+            y = height - text_height - padding
+        elif position == 'top-right':
+            x = width - text_width - padding
+            y = padding
+        elif position == 'top-left':
+            x = padding
+            y = padding
+
+        return mask, (int(x + left), int(y + top))
+
+    @staticmethod
+    def apply_watermark(source_path, text, position='center', opacity=0.5, dest_path=None, options=None):
         """
         Applies a text watermark to the image.
+        Only the text's bounding box is blended; the rest of the image is
+        left in its original mode, without a full-size overlay.
         """
         if dest_path is None:
             dir_name, file_name = os.path.split(source_path)
             dest_path = os.path.join(dir_name, f"watermarked_{file_name}")
 
         try:
-            with Image.open(source_path) as base:
+            with Image.open(source_path) as img:
                 # Capture EXIF data before converting
-                exif_data = base.info.get("exif")
-                
-                base = base.convert("RGBA")
-                # Make a blank image for the text, initialized to transparent text color
-                txt = Image.new("RGBA", base.size, (255, 255, 255, 0))
-
-                # font setup
-                # Load font
-                try:
-                     # Use a large font size relative to image height (e.g., 5%)
-                    font_size = int(base.size[1] * 0.05)
-                    if font_size < 10: font_size = 10
-                    font = ImageFont.truetype("arial.ttf", font_size)
-                except IOError:
-                    font = ImageFont.load_default()
-
-                d = ImageDraw.Draw(txt)
-                
-                # Calculate text dimensions
-                left, top, right, bottom = d.textbbox((0, 0), text, font=font)
-                text_width = right - left
-                text_height = bottom - top
-                
-                # Calculate coordinates
-                width, height = base.size
-                x, y = 0, 0
-                padding = int(width * 0.02) # 2% padding
-
-                if position == 'center':
-                    x = (width - text_width) / 2
-                    y = (height - text_height) / 2
-                elif position == 'bottom-right':
-                    x = width - text_width - padding
-                    y = height - text_height - padding
-                elif position == 'bottom-left':
-                    x = padding
-                    y = height - text_height - padding
-                elif position == 'top-right':
-                    x = width - text_width - padding
-                    y = padding
-                elif position == 'top-left':
-                    x = padding
-                    y = padding
-
-                # Draw text on the transparent layer
-                alpha = int(255 * opacity)
-                d.text((x, y), text, font=font, fill=(255, 255, 255, alpha))
-
-                out = Image.alpha_composite(base, txt)
-
-                # Save as RGB (removing alpha channel)
-                save_kwargs = {
-                    "quality": current_app.config['IMAGE_QUALITY'],
-                    "subsampling": current_app.config['IMAGE_SUBSAMPLING']
-                }
-                
+                exif_data = img.info.get("exif")
+
+                with Metrics.timer('apply_watermark', 'decode'):
+                    # Output is RGB (or grayscale); white text needs no other mode
+                    base = img if img.mode in ("RGB", "L") else img.convert("RGB")
+                    base.load()
+
+                with Metrics.timer('apply_watermark', 'render'):
+                    mask, (x, y) = WatermarkManager.get_overlay(text, base.size, position, opacity)
+                    white = 255 if base.mode == "L" else (255, 255, 255)
+                    # Blends white into the text box only, weighted by the mask
+                    base.paste(white, (x, y, x + mask.width, y + mask.height), mask)
+
+                save_kwargs = ProcessingOptions.resolve(options).save_kwargs()
+
                 if exif_data:
                     save_kwargs["exif"] = exif_data
 
-                out.convert("RGB").save(dest_path, **save_kwargs)
-                
-                return dest_path
+                with Metrics.timer('apply_watermark', 'encode'):
+                    base.save(dest_path, **save_kwargs)
+
+            return dest_path
         except Exception as e:
             logger.error(f"Error applying watermark: {e}")
             return None
@@ -0,0 +1,86 @@
+import os
+import zipfile
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+# Formats that are already compressed: deflating them only costs CPU
+STORED_EXTENSIONS = {'jpg', 'jpeg', 'webp', 'heic', 'heif', 'png'}
+
+# Read size for entries, also the upper bound of data held per yield
+CHUNK_SIZE = 256 * 1024
+
+
+class _ChunkSink:
+    """
+    Write-only, unseekable file object collecting what ZipFile writes.
+    ZipFile detects it cannot seek and falls back to data descriptors.
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+class ZipStreamer:
+    @staticmethod
+    def compress_type_for(filename):
+        ext = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+        return zipfile.ZIP_STORED if ext in STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+
+    @staticmethod
+    def stream(entries, chunk_size=CHUNK_SIZE):
+        """
+        Generator yielding a ZIP archive of entries, an iterable of (path, arcname).
+        Files are read in chunks and sent as they are compressed, so memory use
+        stays around chunk_size regardless of the archive size. ZIP64 is used
+        for large entries and archives.
+        An entry may give bytes instead of a path for small generated files.
+        entries is consumed lazily: the next entry is only requested once the
+        previous one has been fully written.
+        """
+        sink = _ChunkSink()
+        with zipfile.ZipFile(sink, 'w', allowZip64=True) as zf:
+            for path, arcname in entries:
+                if isinstance(path, bytes):
+                    zf.writestr(arcname, path, compress_type=zipfile.ZIP_DEFLATED)
+                    data = sink.drain()
+                    if data:
+                        yield data
+                    continue
+                try:
+                    zinfo = zipfile.ZipInfo.from_file(path, arcname)
+                    src = open(path, 'rb')
+                except OSError as e:
+                    logger.error(f"Skipping {arcname} in ZIP stream: {e}")
+                    continue
+
+                zinfo.compress_type = ZipStreamer.compress_type_for(arcname)
+                with src, zf.open(zinfo, 'w', force_zip64=zinfo.file_size >= zipfile.ZIP64_LIMIT) as dst:
+                    while True:
+                        chunk = src.read(chunk_size)
+                        if not chunk:
+                            break
+                        dst.write(chunk)
+                        data = sink.drain()
+                        if data:
+                            yield data
+                data = sink.drain()
+                if data:
+                    yield data
+        # Central directory
+        data = sink.drain()
+        if data:
+            yield data
@@ -10,21 +10,110 @@ class Config:
     # Max upload size (150 MB)
     MAX_CONTENT_LENGTH = 150 * 1024 * 1024
 
+    # Request size and file count limits for the streaming bulk endpoints
+    # (/api/v1/analyze/bulk, /api/v1/purify/bulk)
+    BULK_MAX_CONTENT_LENGTH = 4 * 1024 * 1024 * 1024
+    BULK_MAX_FILES = 10000
+
     # Allowed image extensions
     ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'tiff', 'webp', 'heic', 'heif'}
 
     # Maximum number of files to keep in storage before cleanup triggers
     MAX_STORED_FILES = 100
 
+    # Byte budgets for stored files, globally and per browser session.
+    # Least recently used files are evicted first when a budget is exceeded.
+    MAX_STORED_BYTES = 2 * 1024 * 1024 * 1024
+    MAX_SESSION_BYTES = 500 * 1024 * 1024
+
     # Maximum number of files a user can upload in a single batch session
     MAX_BATCH_SIZE = 10
 
-    # Probability (0-1) that a cleanup run triggers on a request
-    CLEANUP_PROBABILITY = 0.5
+    # Files shown per page of the batch view (batches are kept server-side)
+    BATCH_PAGE_SIZE = 48
+
+    # Defaults of the batch "coarsen location" action: grid size in degrees
+    # (0.01 is about 1 km) and radius of the random offset in metres
+    GPS_COARSEN_GRID = 0.01
+    GPS_JITTER_METERS = 500
+
+    # Batch actions run on a per-worker process pool.
+    # 0 = run inline in the request thread.
+    BATCH_WORKERS = min(4, os.cpu_count() or 1)
+
+    # Seconds a single file may take once a pool worker has picked it up
+    BATCH_TASK_TIMEOUT = 60
+
+    # Pool workers are replaced after this many files (bounds memory growth)
+    BATCH_MAX_TASKS_PER_CHILD = 100
 
     # How old a file must be (in seconds) to be considered for deletion
     MAX_FILE_AGE_SECONDS = 600
 
+    # Server-side state (file index, ...). Must not be publicly served.
+    DATA_FOLDER = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'data')
+    INDEX_DB_PATH = os.path.join(DATA_FOLDER, 'picturify.db')
+
+    # Layout of UPLOAD_FOLDER: 'sharded' (<ab>/<cd>/<name>, from a hash of the name) or 'flat'
+    STORAGE_LAYOUT = 'sharded'
+
+    # Optional RAM tier (a tmpfs such as /dev/shm) for small derived files.
+    # Least recently used files spill to UPLOAD_FOLDER past STORAGE_MEMORY_BYTES.
+    STORAGE_MEMORY_FOLDER = os.environ.get('STORAGE_MEMORY_FOLDER')
+    STORAGE_MEMORY_BYTES = 64 * 1024 * 1024
+    STORAGE_MEMORY_MAX_FILE_BYTES = 2 * 1024 * 1024
+
+    # Content-addressed copies of uploads, hard linked into UPLOAD_FOLDER.
+    # Keep on the same filesystem as UPLOAD_FOLDER for deduplication to work.
+    BLOB_FOLDER = os.path.join(DATA_FOLDER, 'blobs')
+
+    # Recompressed downloads (/download?quality=N), cached on disk under an LRU byte budget
+    VARIANT_FOLDER = os.path.join(DATA_FOLDER, 'variants')
+    VARIANT_CACHE_BYTES = 512 * 1024 * 1024
+
+    # Previews shown on the result and batch pages (cached with the variants)
+    PREVIEW_FORMAT = 'WEBP'
+    PREVIEW_QUALITY = 80
+    PREVIEW_MAX_AGE = 365 * 24 * 3600
+
+    # HEIC/HEIF uploads are kept as HEIF. Converting them is an explicit action
+    # run on the batch pool, to this format (JPEG, PNG or WEBP) and quality.
+    TRANSCODE_FORMAT = 'JPEG'
+    TRANSCODE_QUALITY = 90
+
+    # Number of EXIF analysis results memoized per worker, keyed by content hash
+    ANALYSIS_CACHE_SIZE = 256
+
+    # Asynchronous jobs (/api/v1/jobs): persistent queue run by one background
+    # runner per host on the batch process pool.
+    JOBS_ENABLED = True
+    JOBS_DB_PATH = os.path.join(DATA_FOLDER, 'jobs.db')
+    JOBS_FOLDER = os.path.join(DATA_FOLDER, 'jobs')
+    JOB_MAX_FILES = 10000
+    JOB_MAX_ATTEMPTS = 3
+    JOB_RETENTION_SECONDS = 24 * 3600
+    JOBS_POLL_SECONDS = 1
+
+    # Background reaper deleting expired uploads (one active per host)
+    REAPER_ENABLED = True
+    REAPER_INTERVAL_SECONDS = 30
+
+    # Prometheus metrics on /metrics, summed over every worker process of the host.
+    # Workers save their metrics every METRICS_FLUSH_SECONDS.
+    METRICS_ENABLED = True
+    METRICS_FLUSH_SECONDS = 5
+    METRICS_ALLOWED_NETWORKS = ('127.0.0.0/8', '::1/128')
+
+    # Opt-in cProfile + tracemalloc capture of single requests, listed on /profiles.
+    # A request is captured when it sends X-Picturify-Profile: <PROFILING_TOKEN>,
+    # or at random with PROFILING_SAMPLE_RATE (0-1). Off: no hooks are installed.
+    PROFILING_ENABLED = os.environ.get('PROFILING_ENABLED', '').lower() in ('1', 'true', 'yes')
+    PROFILING_TOKEN = os.environ.get('PROFILING_TOKEN')
+    PROFILING_SAMPLE_RATE = 0.0
+    PROFILING_FOLDER = os.path.join(DATA_FOLDER, 'profiles')
+    PROFILING_MAX_CAPTURES = 50
+    PROFILING_ALLOWED_NETWORKS = ('127.0.0.0/8', '::1/128')
+
     # Output quality for re-encoded images (1-100).
     # 100 = Best quality, 85-95 = Good balance.
     IMAGE_QUALITY = 100
@@ -33,7 +122,11 @@ class Config:
     # 0 = 4:4:4 (Best, keeps all color info), 1 = 4:2:2, 2 = 4:2:0 (Standard JPEG).
     IMAGE_SUBSAMPLING = 0
 
+    # Optional JSON file with extra metadata templates: {"name": ["Make", "GPS*", "@camera_settings"]}
+    METADATA_TEMPLATES_FILE = os.environ.get('METADATA_TEMPLATES_FILE')
+
     @staticmethod
     def init_app(app):
         if not os.path.exists(Config.UPLOAD_FOLDER):
             os.makedirs(Config.UPLOAD_FOLDER)
+        os.makedirs(app.config['DATA_FOLDER'], exist_ok=True)
@@ -0,0 +1,7 @@
+import sys
+from app.cli import main
+
+# Command line tool: python picturify.py purify photos/ -o purified/
+# Runs without the web app (no Flask app context or server needed).
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,242 @@
+"""
+Micro-benchmarks for the service operations.
+
+Generates a deterministic corpus (resolutions x formats x EXIF densities),
+times each operation in its own process and reports throughput, p50/p99
+latency and peak RSS. Results are saved as JSON; pass a previous report as
+--baseline to fail on regressions.
+
+    python tests/benchmark.py --quick
+    python tests/benchmark.py --output new.json --baseline old.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+FORMATS = {'JPEG': 'jpg', 'PNG': 'png', 'WEBP': 'webp', 'TIFF': 'tiff', 'HEIF': 'heic'}
+OPERATIONS = ('get_exif_data', 'remove_exif', 'modify_exif', 'keep_only_tags', 'apply_watermark', 'save_image')
+DEFAULT_RESOLUTIONS = ('640x480', '1920x1080', '4000x3000')
+
+# Latency changes smaller than this are noise, whatever the ratio
+MIN_REGRESSION_SECONDS = 0.0005
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a non-empty list."""
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * pct // 100))
+    return ordered[int(rank) - 1]
+
+
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # KiB on Linux, bytes on macOS
+    return rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
+
+
+def build_corpus(folder, resolutions, formats, densities):
+    from tests.utils import create_corpus_image
+    corpus = []
+    for resolution in resolutions:
+        size = tuple(int(v) for v in resolution.split('x'))
+        for fmt in formats:
+            for density in densities:
+                path = os.path.join(folder, f"{resolution}_{density}.{FORMATS[fmt]}")
+                create_corpus_image(path, fmt, size, density)
+                corpus.append({
+                    'path': path,
+                    'group': f"{fmt}/{density}/{resolution}",
+                    'bytes': os.path.getsize(path),
+                })
+    return corpus
+
+
+def _make_app(work_dir):
+    from app import create_app
+    from tests.test_routes import TestConfig
+
+    class BenchConfig(TestConfig):
+        UPLOAD_FOLDER = os.path.join(work_dir, 'uploads')
+        DATA_FOLDER = os.path.join(work_dir, 'data')
+        INDEX_DB_PATH = os.path.join(DATA_FOLDER, 'picturify.db')
+        BLOB_FOLDER = os.path.join(DATA_FOLDER, 'blobs')
+        VARIANT_FOLDER = os.path.join(DATA_FOLDER, 'variants')
+        JOBS_DB_PATH = os.path.join(DATA_FOLDER, 'jobs.db')
+        JOBS_FOLDER = os.path.join(DATA_FOLDER, 'jobs')
+        MAX_STORED_FILES = 100000
+        BATCH_WORKERS = 0
+
+    os.makedirs(BenchConfig.UPLOAD_FOLDER, exist_ok=True)
+    return create_app(BenchConfig)
+
+
+def _operation(name, out_dir):
+    """Returns a callable(path) running one operation, and an optional cleanup(result)."""
+    from werkzeug.datastructures import FileStorage
+    from app.services.exif_manager import ExifManager
+    from app.services.image_handler import ImageHandler
+    from app.services.metadata_templates import MetadataTemplates
+    from app.services.watermark_manager import WatermarkManager
+
+    def dest(path):
+        return os.path.join(out_dir, 'out_' + os.path.basename(path))
+
+    if name == 'get_exif_data':
+        return ExifManager.get_exif_data, None
+    if name == 'remove_exif':
+        return lambda path: ExifManager.remove_exif(path, dest(path)), None
+    if name == 'modify_exif':
+        changes = {'Artist': 'Benchmark', 'Copyright': 'Picturify'}
+        return lambda path: ExifManager.modify_exif(path, changes, dest(path)), None
+    if name == 'keep_only_tags':
+        kept = MetadataTemplates.get_compiled('flickr')
+        return lambda path: ExifManager.keep_only_tags(path, kept, dest(path)), None
+    if name == 'apply_watermark':
+        return lambda path: WatermarkManager.apply_watermark(path, 'Picturify', 'bottom-right', 0.5, dest(path)), None
+    if name == 'save_image':
+        def save(path):
+            with open(path, 'rb') as f:
+                return ImageHandler.save_image(FileStorage(f, filename=os.path.basename(path)))
+        # Deleting also releases the stored blob, so every run stores new content
+        return save, ImageHandler.delete_file
+    raise ValueError(f"Unknown operation: {name}")
+
+
+def run_operation(name, corpus, repeat, work_dir):
+    """Times one operation over the corpus. Runs in a fresh process so peak RSS is its own."""
+    app = _make_app(work_dir)
+    out_dir = os.path.join(work_dir, 'out')
+    os.makedirs(out_dir, exist_ok=True)
+    baseline_rss = peak_rss_mb()
+
+    timings = {}
+    with app.test_request_context():
+        func, cleanup = _operation(name, out_dir)
+        for entry in corpus:
+            samples = []
+            for i in range(repeat + 1):
+                start = time.perf_counter()
+                result = func(entry['path'])
+                elapsed = time.perf_counter() - start
+                if cleanup and result:
+                    cleanup(result)
+                if i:  # First run warms caches and imports
+                    samples.append(elapsed)
+            timings[entry['group']] = samples
+    return {'timings': timings, 'peak_rss_mb': peak_rss_mb(), 'baseline_rss_mb': baseline_rss}
+
+
+def summarize(samples, size_bytes):
+    total = sum(samples)
+    return {
+        'runs': len(samples),
+        'p50_ms': round(percentile(samples, 50) * 1000, 3),
+        'p99_ms': round(percentile(samples, 99) * 1000, 3),
+        'files_per_s': round(len(samples) / total, 2) if total else None,
+        'mb_per_s': round(len(samples) * size_bytes / total / 1e6, 2) if total else None,
+    }
+
+
+def compare(report, baseline, tolerance):
+    """Returns a list of regressions of report against baseline."""
+    regressions = []
+    for op, current in report['results'].items():
+        previous = baseline.get('results', {}).get(op)
+        if not previous:
+            continue
+        for group, stats in current['groups'].items():
+            before = previous['groups'].get(group)
+            if not before:
+                continue
+            delta = (stats['p50_ms'] - before['p50_ms']) / 1000
+            if stats['p50_ms'] > before['p50_ms'] * (1 + tolerance) and delta > MIN_REGRESSION_SECONDS:
+                regressions.append(f"{op} {group}: p50 {before['p50_ms']} -> {stats['p50_ms']} ms")
+        if current['peak_rss_mb'] > previous['peak_rss_mb'] * (1 + tolerance):
+            regressions.append(f"{op}: peak RSS {previous['peak_rss_mb']} -> {current['peak_rss_mb']} MB")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--resolutions', default=','.join(DEFAULT_RESOLUTIONS))
+    parser.add_argument('--formats', default=','.join(FORMATS))
+    parser.add_argument('--densities', default='none,typical,makernote,gps')
+    parser.add_argument('--operations', default=','.join(OPERATIONS))
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs per file (after one warm-up run)')
+    parser.add_argument('--quick', action='store_true', help='smallest resolution, 2 runs per file')
+    parser.add_argument('--output', default='tests/benchmark_report.json')
+    parser.add_argument('--baseline', help='previous report to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown ratio (0.25 = 25%%)')
+    args = parser.parse_args(argv)
+
+    resolutions = args.resolutions.split(',')
+    repeat = args.repeat
+    if args.quick:
+        resolutions, repeat = resolutions[:1], 2
+    operations = args.operations.split(',')
+
+    work_dir = tempfile.mkdtemp(prefix='picturify-bench-')
+    try:
+        corpus_dir = os.path.join(work_dir, 'corpus')
+        os.makedirs(corpus_dir)
+        corpus = build_corpus(corpus_dir, resolutions, args.formats.split(','), args.densities.split(','))
+        sizes = {entry['group']: entry['bytes'] for entry in corpus}
+
+        report = {
+            'meta': {
+                'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+                'repeat': repeat,
+                'corpus_files': len(corpus),
+                'corpus_bytes': sum(sizes.values()),
+            },
+            'results': {},
+        }
+
+        context = multiprocessing.get_context('spawn')
+        for op in operations:
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                run = executor.submit(run_operation, op, corpus, repeat, os.path.join(work_dir, op)).result()
+
+            groups = {group: summarize(samples, sizes[group]) for group, samples in run['timings'].items()}
+            all_samples = [s for samples in run['timings'].values() for s in samples]
+            report['results'][op] = {
+                'overall': summarize(all_samples, sum(sizes.values()) / len(sizes)),
+                'peak_rss_mb': round(run['peak_rss_mb'], 1),
+                'groups': groups,
+            }
+            overall = report['results'][op]['overall']
+            print(f"{op:<16} p50 {overall['p50_ms']:>9.3f} ms  p99 {overall['p99_ms']:>9.3f} ms  "
+                  f"{overall['files_per_s']:>8} files/s  peak RSS {report['results'][op]['peak_rss_mb']} MB")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=4)
+    print(f"\nBenchmark report generated: {os.path.abspath(args.output)}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    # Ensure project root is in path to import app, config, and tests package
+    project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    if project_root not in sys.path:
+        sys.path.insert(0, project_root)
+    sys.exit(main())
@@ -2,12 +2,20 @@
 import unittest
 import os
 import shutil
+import tempfile
 import io
+import zipfile
+from unittest import mock
 import json
+import math
 from app import create_app
+from app.services.job_runner import JobRunner
+from app.services.image_handler import ImageHandler
+from app.services.batch_exif_index import BatchExifIndex
 from config import Config
 from tests.utils import create_dummy_image, get_exif_data
 import piexif
+from PIL import Image
 
 class TestConfig(Config):
     TESTING = True
@@ -15,9 +23,30 @@ class TestConfig(Config):
     # Use absolute path for upload folder to avoid CWD ambiguity
     UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tests', 'uploads')
     PROCESSED_FOLDER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tests', 'processed')
+    DATA_FOLDER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tests', 'data')
+    INDEX_DB_PATH = os.path.join(DATA_FOLDER, 'picturify.db')
+    BLOB_FOLDER = os.path.join(DATA_FOLDER, 'blobs')
+    VARIANT_FOLDER = os.path.join(DATA_FOLDER, 'variants')
+    REAPER_ENABLED = False
+    JOBS_ENABLED = False
+    JOBS_DB_PATH = os.path.join(DATA_FOLDER, 'jobs.db')
+    JOBS_FOLDER = os.path.join(DATA_FOLDER, 'jobs')
+    PROFILING_FOLDER = os.path.join(DATA_FOLDER, 'profiles')
+
+    @classmethod
+    def use_data_folder(cls, folder):
+        """Points the index, caches and queues at folder (a fresh one per test keeps runs independent)."""
+        cls.DATA_FOLDER = folder
+        cls.INDEX_DB_PATH = os.path.join(folder, 'picturify.db')
+        cls.BLOB_FOLDER = os.path.join(folder, 'blobs')
+        cls.VARIANT_FOLDER = os.path.join(folder, 'variants')
+        cls.JOBS_DB_PATH = os.path.join(folder, 'jobs.db')
+        cls.JOBS_FOLDER = os.path.join(folder, 'jobs')
+        cls.PROFILING_FOLDER = os.path.join(folder, 'profiles')
 
 class TestRoutes(unittest.TestCase):
     def setUp(self):
+        TestConfig.use_data_folder(tempfile.mkdtemp(prefix='picturify-test-'))
         self.app = create_app(TestConfig)
         self.client = self.app.test_client()
         self.app_context = self.app.app_context()
@@ -34,6 +63,7 @@ class TestRoutes(unittest.TestCase):
             shutil.rmtree(TestConfig.UPLOAD_FOLDER, ignore_errors=True)
         if os.path.exists(TestConfig.PROCESSED_FOLDER):
             shutil.rmtree(TestConfig.PROCESSED_FOLDER, ignore_errors=True)
+        shutil.rmtree(TestConfig.DATA_FOLDER, ignore_errors=True)
 
     def test_upload_analyze_success(self):
         """Test successful image analysis via API."""
@@ -90,5 +120,453 @@ class TestRoutes(unittest.TestCase):
         # Size check might be flaky with dummy images, checking mimetype is safer for now
         self.assertEqual(response.mimetype, 'image/jpeg')
 
+    def test_upload_ingest_single_write(self):
+        """Test uploads are spooled into the upload folder and renamed, leaving no temp files."""
+        heic = io.BytesIO()
+        Image.new('RGB', (32, 32), color='red').save(heic, 'HEIF')
+        heic.seek(0)
+        response = self.client.post('/api/v1/analyze', data={'image': (heic, 'photo.heic')},
+                                    content_type='multipart/form-data')
+        self.assertEqual(response.status_code, 200)
+        # HEIC is stored as uploaded, without a JPEG transcode
+        stored = response.get_json()['filename']
+        self.assertTrue(stored.endswith('_photo.heic'))
+        with Image.open(ImageHandler.get_path(stored)) as img:
+            self.assertEqual(img.format, 'HEIF')
+
+        bogus = io.BytesIO(b'not an image at all')
+        response = self.client.post('/api/v1/analyze', data={'image': (bogus, 'fake.jpg')},
+                                    content_type='multipart/form-data')
+        self.assertEqual(response.status_code, 400)
+
+        leftovers = [f for f in os.listdir(TestConfig.UPLOAD_FOLDER) if f.startswith('.')]
+        self.assertEqual(leftovers, [])
+
+    def test_duplicate_upload_is_deduplicated(self):
+        """Test re-uploading identical content shares storage and reuses the cached analysis."""
+        filename = os.path.join(TestConfig.UPLOAD_FOLDER, 'dup_src.jpg')
+        create_dummy_image(filename, exif_data={"0th": {piexif.ImageIFD.Make: b"TestCamera"}})
+
+        names = []
+        for i in range(2):
+            with open(filename, 'rb') as img:
+                if i == 1:
+                    with mock.patch('app.services.exif_manager.ExifManager._read_exif_data',
+                                    side_effect=AssertionError('analysis should be cached')):
+                        response = self.client.post('/api/v1/analyze', data={'image': (img, 'dup.jpg')},
+                                                    content_type='multipart/form-data')
+                else:
+                    response = self.client.post('/api/v1/analyze', data={'image': (img, 'dup.jpg')},
+                                                content_type='multipart/form-data')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.get_json()['exif_data']['Make'], 'TestCamera')
+            names.append(response.get_json()['filename'])
+
+        first, second = (os.stat(ImageHandler.get_path(n)) for n in names)
+        self.assertNotEqual(names[0], names[1])
+        self.assertEqual((first.st_dev, first.st_ino), (second.st_dev, second.st_ino))
+
+    def test_download_quality_variant_is_cached(self):
+        """Test a recompressed download is encoded once and then served from the cache."""
+        filename = os.path.join(TestConfig.UPLOAD_FOLDER, 'variant_src.jpg')
+        create_dummy_image(filename, size=(300, 200))
+        with open(filename, 'rb') as img:
+            response = self.client.post('/api/v1/analyze', data={'image': (img, 'variant.jpg')},
+                                        content_type='multipart/form-data')
+        stored = response.get_json()['filename']
+
+        first = self.client.get(f'/download/{stored}?quality=50')
+        with mock.patch('app.services.variant_cache.VariantCache.render',
+                        side_effect=AssertionError('variant should be cached')):
+            second = self.client.get(f'/download/{stored}?quality=50')
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first.mimetype, 'image/jpeg')
+        self.assertEqual(first.data, second.data)
+        first.close()
+        second.close()
+
+    def test_preview_is_cached_with_long_lived_headers(self):
+        """Test previews are rendered once and served as cacheable WebP."""
+        filename = os.path.join(TestConfig.UPLOAD_FOLDER, 'preview_src.jpg')
+        create_dummy_image(filename, size=(1200, 900))
+        with open(filename, 'rb') as img:
+            response = self.client.post('/', data={'image': (img, 'preview.jpg')}, content_type='multipart/form-data')
+        stored = response.headers['Location'].rsplit('/', 1)[-1]
+
+        page = self.client.get(f'/result/{stored}').get_data(as_text=True)
+        self.assertIn(f'/preview/{stored}?size=large', page)
+
+        # The data folder is fresh: the first request must render
+        index = ImageHandler.get_index()
+        self.assertEqual(index.variant_bytes(), 0)
+
+        from app.services.preview_manager import PreviewManager
+        with mock.patch.object(PreviewManager, 'render', wraps=PreviewManager.render) as render:
+            for _ in range(2):
+                response = self.client.get(f'/preview/{stored}?size=large')
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.mimetype, 'image/webp')
+                self.assertIn('immutable', response.headers['Cache-Control'])
+                with Image.open(io.BytesIO(response.data)) as img:
+                    self.assertEqual(img.size, (800, 600))
+                response.close()
+        self.assertEqual(render.call_count, 1)
+        self.assertGreater(index.variant_bytes(), 0)
+
+    def test_metrics_endpoint(self):
+        """Test /metrics aggregates request and operation metrics, including exited processes."""
+        filename = os.path.join(TestConfig.UPLOAD_FOLDER, 'metrics.jpg')
+        create_dummy_image(filename, exif_data={"0th": {piexif.ImageIFD.Make: b"MetricsCamera"}})
+        with open(filename, 'rb') as img:
+            response = self.client.post('/api/v1/analyze', data={'image': (img, 'metrics.jpg')}, content_type='multipart/form-data')
+        self.assertIn('get_exif_data-parse;dur=', response.headers['Server-Timing'])
+
+        def evictions():
+            body = self.client.get('/metrics').get_data(as_text=True)
+            values = [line.split()[1] for line in body.splitlines() if line.startswith('picturify_evictions_total ')]
+            return float(values[0]) if values else 0.0
+
+        # Snapshot left by a worker that has exited adds to the live counters
+        before = evictions()
+        index = ImageHandler.get_index()
+        index.save_metrics('dead', 2 ** 31 - 16, json.dumps({
+            'counters': [['picturify_evictions_total', [], 3]], 'histograms': []
+        }))
+
+        for _ in range(2):
+            body = self.client.get('/metrics').get_data(as_text=True)
+            self.assertIn('# TYPE picturify_request_duration_seconds histogram', body)
+            self.assertIn('picturify_requests_total{method="POST",route="/api/v1/analyze",status="200"}', body)
+            self.assertIn('picturify_operation_seconds_count{operation="get_exif_data",phase="parse"}', body)
+            self.assertIn('picturify_stored_files ', body)
+            self.assertEqual(evictions(), before + 3)
+        self.assertNotIn('dead', [key for key, _, _ in index.load_metrics()])
+
+        response = self.client.get('/metrics', environ_base={'REMOTE_ADDR': '203.0.113.5'})
+        self.assertEqual(response.status_code, 403)
+
+    def test_profiling_capture(self):
+        """Test a request is profiled only with the profiling token, and listed on /profiles."""
+        class ProfilingConfig(TestConfig):
+            PROFILING_ENABLED = True
+            PROFILING_TOKEN = 'secret'
+            PROFILING_FOLDER = os.path.join(TestConfig.DATA_FOLDER, 'profiles')
+        app = create_app(ProfilingConfig)
+        client = app.test_client()
+        self.assertNotIn('profiles', self.app.view_functions)
+
+        response = client.get('/about', headers={'X-Picturify-Profile': 'wrong'})
+        self.assertNotIn('X-Profile-Id', response.headers)
+
+        response = client.get('/about', headers={'X-Picturify-Profile': 'secret', 'X-Request-ID': 'req-about-1'})
+        self.assertEqual(response.headers['X-Profile-Id'], 'req-about-1')
+        folder = os.path.join(ProfilingConfig.PROFILING_FOLDER, 'req-about-1')
+        with open(os.path.join(folder, 'profile.txt')) as f:
+            self.assertIn('function calls', f.read())
+        with open(os.path.join(folder, 'allocations.txt')) as f:
+            self.assertIn('Peak traced memory', f.read())
+
+        index = client.get('/profiles').get_data(as_text=True)
+        self.assertIn('req-about-1', index)
+        self.assertEqual(client.get('/profiles/req-about-1/profile.prof').status_code, 200)
+        self.assertEqual(client.get('/profiles/req-about-1/secrets.txt').status_code, 404)
+        self.assertEqual(client.get('/profiles', environ_base={'REMOTE_ADDR': '203.0.113.5'}).status_code, 403)
+
+    def test_batch_purify(self):
+        """Test batch purification on the process pool."""
+        uploads = []
+        for i in range(3):
+            filename = os.path.join(TestConfig.UPLOAD_FOLDER, f'batch_src_{i}.jpg')
+            create_dummy_image(filename, exif_data={"0th": {piexif.ImageIFD.Make: b"TestCamera"}})
+            uploads.append((open(filename, 'rb'), f'batch_{i}.jpg'))
+
+        try:
+            response = self.client.post('/', data={'image': uploads}, content_type='multipart/form-data')
+        finally:
+            for f, _ in uploads:
+                f.close()
+        self.assertEqual(response.status_code, 302)
+
+        response = self.client.post('/batch_action', data={'action': 'purify'})
+        self.assertEqual(response.status_code, 302)
+
+        with self.client.session_transaction() as sess:
+            batch = ImageHandler.get_index().batch_names(sess['batch_id'])
+        self.assertEqual(len(batch), 3)
+        for fname in batch:
+            self.assertTrue(fname.startswith('purified_'))
+            self.assertIsNone(get_exif_data(ImageHandler.get_path(fname)))
+
+        # Per-file state and lineage are kept in the manifest
+        with self.client.session_transaction() as sess:
+            entries = ImageHandler.get_index().batch_files(sess['batch_id'])
+        self.assertEqual([e['origin'] for e in entries], ['batch_0.jpg', 'batch_1.jpg', 'batch_2.jpg'])
+        self.assertTrue(all(e['lineage'] == '["purify"]' and not e['has_exif'] for e in entries))
+
+        # Pages only render their slice of the batch
+        self.app.config['BATCH_PAGE_SIZE'] = 2
+        try:
+            response = self.client.get('/batch_result?page=2')
+        finally:
+            self.app.config['BATCH_PAGE_SIZE'] = TestConfig.BATCH_PAGE_SIZE
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(batch[2].encode(), response.data)
+        self.assertNotIn(batch[0].encode(), response.data)
+
+    def test_batch_filters_drive_targeted_actions(self):
+        """Test batch filters come from the EXIF index and restrict batch actions to matching files."""
+        gps = {
+            piexif.GPSIFD.GPSLatitudeRef: b'N', piexif.GPSIFD.GPSLatitude: ((48, 1), (51, 1), (0, 1)),
+            piexif.GPSIFD.GPSLongitudeRef: b'E', piexif.GPSIFD.GPSLongitude: ((2, 1), (21, 1), (0, 1)),
+        }
+        exif = [
+            {"0th": {piexif.ImageIFD.Make: b"Leaky"}, "GPS": gps},
+            {"0th": {piexif.ImageIFD.Make: b"Quiet"}},
+        ]
+        uploads = []
+        for i, exif_data in enumerate(exif):
+            filename = os.path.join(TestConfig.UPLOAD_FOLDER, f'filter_src_{i}.jpg')
+            create_dummy_image(filename, exif_data=exif_data)
+            uploads.append((open(filename, 'rb'), f'filter_{i}.jpg'))
+        try:
+            self.client.post('/', data={'image': uploads}, content_type='multipart/form-data')
+        finally:
+            for f, _ in uploads:
+                f.close()
+        with self.client.session_transaction() as sess:
+            leaky, quiet = ImageHandler.get_index().batch_names(sess['batch_id'])
+
+        response = self.client.get('/batch_result?gps=1')
+        self.assertIn(b'1 of 2 images match', response.data)
+        self.assertIn(leaky.encode(), response.data)
+        self.assertNotIn(quiet.encode(), response.data)
+
+        # Files were parsed once, on upload: filters only read the index
+        with mock.patch('app.services.exif_manager.ExifManager._read_exif_data',
+                        side_effect=AssertionError('index should be reused')):
+            response = self.client.get('/batch_result?make=Quiet')
+        self.assertIn(b'1 of 2 images match', response.data)
+
+        response = self.client.post('/batch_action', data={'action': 'purify', 'gps': '1'})
+        self.assertEqual(response.status_code, 302)
+
+        with self.client.session_transaction() as sess:
+            batch = ImageHandler.get_index().batch_names(sess['batch_id'])
+        self.assertEqual(batch, [f'purified_{leaky}', quiet])
+        self.assertEqual(self.client.get('/batch_result?gps=1').status_code, 200)
+
+    def test_batch_coarsen_and_export_locations(self):
+        """Test the batch GPS export and the coarsen action, which only rewrites located files."""
+        gps = {
+            piexif.GPSIFD.GPSLatitudeRef: b'N', piexif.GPSIFD.GPSLatitude: ((48, 1), (51, 1), (2964, 100)),
+            piexif.GPSIFD.GPSLongitudeRef: b'E', piexif.GPSIFD.GPSLongitude: ((2, 1), (17, 1), (4020, 100)),
+        }
+        uploads = []
+        for i, exif_data in enumerate([{"GPS": gps}, None]):
+            filename = os.path.join(TestConfig.UPLOAD_FOLDER, f'gps_src_{i}.jpg')
+            create_dummy_image(filename, exif_data=exif_data)
+            uploads.append((open(filename, 'rb'), f'gps_{i}.jpg'))
+        try:
+            self.client.post('/', data={'image': uploads}, content_type='multipart/form-data')
+        finally:
+            for f, _ in uploads:
+                f.close()
+        with self.client.session_transaction() as sess:
+            batch_id = sess['batch_id']
+        located, plain = ImageHandler.get_index().batch_names(batch_id)
+
+        response = self.client.get('/batch_gps.csv')
+        self.assertEqual(response.status_code, 200)
+        rows = response.data.decode().splitlines()
+        self.assertEqual(len(rows), 2)
+        self.assertTrue(rows[1].startswith(f'{located},48.858'))
+
+        response = self.client.post('/batch_action', data={'action': 'coarsen', 'coarsen_mode': 'grid', 'grid': '0.5'})
+        self.assertEqual(response.status_code, 302)
+        batch = ImageHandler.get_index().batch_names(batch_id)
+        self.assertEqual(batch, [f'located_{located}', plain])
+
+        response = self.client.get('/batch_gps.geojson')
+        coordinates = json.loads(response.data)['features'][0]['geometry']['coordinates']
+        self.assertEqual(coordinates, [2.5, 49.0])
+        self.assertIn(b'Coarsened', self.client.get('/batch_result').data)
+
+        # The API extracts positions from uploads without storing them
+        with open(ImageHandler.get_path(batch[0]), 'rb') as f:
+            response = self.client.post('/api/v1/gps/bulk?format=csv', data={'images': [(f, 'a.jpg')]},
+                                        content_type='multipart/form-data')
+        self.assertEqual(response.data.decode().splitlines()[1], 'a.jpg,49.0000000,2.5000000,')
+
+        # A second action rewrites the file under the same name: the EXIF index must see it
+        self.client.post('/batch_action', data={'action': 'coarsen', 'coarsen_mode': 'remove'})
+        self.assertEqual(ImageHandler.get_index().batch_names(batch_id), batch)
+        index = BatchExifIndex.for_batch(batch_id)
+        self.assertEqual(index.summary()['with_gps'], 0)
+        self.assertTrue(math.isnan(index.numbers['GPSLatitude'][0]))
+        self.assertIn(b'0 of 2 images match', self.client.get('/batch_result?gps=1').data)
+
+    def test_batch_watermark(self):
+        """Test the batch watermark action."""
+        uploads = []
+        for i in range(2):
+            filename = os.path.join(TestConfig.UPLOAD_FOLDER, f'wm_src_{i}.jpg')
+            create_dummy_image(filename)
+            uploads.append((open(filename, 'rb'), f'wm_{i}.jpg'))
+        try:
+            self.client.post('/', data={'image': uploads}, content_type='multipart/form-data')
+        finally:
+            for f, _ in uploads:
+                f.close()
+
+        response = self.client.post('/batch_action', data={'action': 'watermark', 'watermark_text': 'Test'})
+        self.assertEqual(response.status_code, 302)
+
+        with self.client.session_transaction() as sess:
+            batch = ImageHandler.get_index().batch_names(sess['batch_id'])
+        self.assertEqual(len(batch), 2)
+        for fname in batch:
+            self.assertTrue(fname.startswith('watermarked_'))
+
+        # A non-numeric opacity is rejected, not a server error
+        response = self.client.post('/batch_action', data={
+            'action': 'watermark', 'watermark_text': 'Test', 'watermark_opacity': 'abc'
+        }, follow_redirects=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'Invalid opacity', response.data)
+
+    def test_heic_transcode_on_request(self):
+        """Test HEIC uploads are only converted when asked, to the requested format."""
+        heic = io.BytesIO()
+        Image.new('RGB', (32, 32), color='red').save(
+            heic, 'HEIF', exif=piexif.dump({"0th": {piexif.ImageIFD.Make: b"HeicCamera"}}))
+        data = heic.getvalue()
+        response = self.client.post('/api/v1/analyze', data={'image': (io.BytesIO(data), 'photo.heic')},
+                                    content_type='multipart/form-data')
+        stored = response.get_json()['filename']
+        self.assertEqual(response.get_json()['exif_data']['Make'], 'HeicCamera')
+
+        response = self.client.post(f'/transcode/{stored}', data={'format': 'PNG'})
+        self.assertEqual(response.status_code, 302)
+        converted = response.headers['Location'].rsplit('/', 1)[-1]
+        self.assertTrue(converted.startswith('converted_') and converted.endswith('.png'))
+        self.assertFalse(os.path.exists(ImageHandler.get_path(stored)))
+        with Image.open(ImageHandler.get_path(converted)) as img:
+            self.assertEqual(img.format, 'PNG')
+
+        response = self.client.post('/api/v1/purify', data={'image': (io.BytesIO(data), 'photo.heic'), 'format': 'jpeg'},
+                                    content_type='multipart/form-data')
+        self.assertEqual(response.mimetype, 'image/jpeg')
+        self.assertIsNone(get_exif_data(io.BytesIO(response.data)))
+
+    def test_download_batch_streams_zip(self):
+        """Test the batch ZIP is streamed and JPEGs are stored uncompressed."""
+        uploads = []
+        for i in range(2):
+            filename = os.path.join(TestConfig.UPLOAD_FOLDER, f'zip_src_{i}.jpg')
+            create_dummy_image(filename)
+            uploads.append((open(filename, 'rb'), f'zip_{i}.jpg'))
+        try:
+            self.client.post('/', data={'image': uploads}, content_type='multipart/form-data')
+        finally:
+            for f, _ in uploads:
+                f.close()
+
+        response = self.client.post('/download_batch')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_streamed)
+        with zipfile.ZipFile(io.BytesIO(response.data)) as zf:
+            self.assertIsNone(zf.testzip())
+            infos = zf.infolist()
+        self.assertEqual(len(infos), 2)
+        for info in infos:
+            self.assertEqual(info.compress_type, zipfile.ZIP_STORED)
+
+    def _bulk_uploads(self, prefix, count):
+        uploads = []
+        for i in range(count):
+            filename = os.path.join(TestConfig.UPLOAD_FOLDER, f'{prefix}_src_{i}.jpg')
+            create_dummy_image(filename, exif_data={"0th": {piexif.ImageIFD.Make: b"TestCamera"}})
+            uploads.append((open(filename, 'rb'), f'{prefix}_{i}.jpg'))
+        uploads.append((io.BytesIO(b'not an image'), 'bogus.jpg'))
+        return uploads
+
+    def test_bulk_analyze_streams_ndjson(self):
+        """Test bulk analysis answers one JSON line per part, errors inline."""
+        uploads = self._bulk_uploads('bulk', 2)
+        try:
+            response = self.client.post('/api/v1/analyze/bulk', data={'image': uploads}, content_type='multipart/form-data')
+        finally:
+            for f, _ in uploads:
+                f.close()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_streamed)
+        lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual([line['index'] for line in lines], [0, 1, 2])
+        self.assertEqual(lines[0]['exif_data']['Make'], 'TestCamera')
+        self.assertEqual(lines[2], {'index': 2, 'filename': 'bogus.jpg', 'error': 'Invalid image file'})
+        # Spooled parts are not kept
+        self.assertFalse([f for f in os.listdir(TestConfig.UPLOAD_FOLDER) if f.startswith('.')])
+
+    def test_bulk_purify_streams_zip(self):
+        """Test bulk purify returns a ZIP of stripped files with inline error entries."""
+        uploads = self._bulk_uploads('bulkp', 2)
+        try:
+            response = self.client.post('/api/v1/purify/bulk', data={'image': uploads}, content_type='multipart/form-data')
+        finally:
+            for f, _ in uploads:
+                f.close()
+
+        self.assertEqual(response.status_code, 200)
+        with zipfile.ZipFile(io.BytesIO(response.data)) as zf:
+            self.assertEqual(zf.namelist(), ['bulkp_0.jpg', 'bulkp_1.jpg', 'bogus.jpg.error.txt'])
+            with Image.open(io.BytesIO(zf.read('bulkp_0.jpg'))) as img:
+                self.assertNotIn('exif', img.info)
+        self.assertFalse([f for f in os.listdir(TestConfig.UPLOAD_FOLDER) if f.startswith('.')])
+
+    def test_job_api_purify(self):
+        """Test an asynchronous purify job from submission to results."""
+        uploads = []
+        for i in range(3):
+            filename = os.path.join(TestConfig.UPLOAD_FOLDER, f'job_src_{i}.jpg')
+            create_dummy_image(filename, exif_data={"0th": {piexif.ImageIFD.Make: b"TestCamera"}})
+            uploads.append((open(filename, 'rb'), f'job_{i}.jpg'))
+        uploads.append((io.BytesIO(b'not an image'), 'bogus.jpg'))
+        try:
+            response = self.client.post(
+                '/api/v1/jobs', data={'operation': 'purify', 'images': uploads},
+                content_type='multipart/form-data'
+            )
+        finally:
+            for f, _ in uploads:
+                f.close()
+
+        self.assertEqual(response.status_code, 202)
+        job = response.get_json()
+        self.assertEqual((job['status'], job['total'], job['queued']), ('queued', 3, 3))
+        self.assertEqual(job['rejected'], ['bogus.jpg'])
+        self.assertEqual(self.client.get(job['links']['results']).status_code, 409)
+
+        # Done by the background runner in production
+        while JobRunner.run_pending():
+            pass
+
+        job = self.client.get(job['links']['self']).get_json()
+        self.assertEqual((job['status'], job['done'], job['progress']), ('done', 3, 1.0))
+
+        response = self.client.get(job['links']['results'])
+        with zipfile.ZipFile(io.BytesIO(response.data)) as zf:
+            self.assertEqual(len(zf.namelist()), 3)
+            for name in zf.namelist():
+                with Image.open(io.BytesIO(zf.read(name))) as img:
+                    self.assertNotIn('exif', img.info)
+
+        items = self.client.get(job['links']['items']).get_json()['items']
+        self.assertEqual(self.client.get(items[0]['result']).status_code, 200)
+        self.assertEqual(self.client.delete(job['links']['self']).status_code, 204)
+        self.assertEqual(self.client.get(job['links']['self']).status_code, 404)
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,18 +1,41 @@
 
 import unittest
 import os
+import io
+import json
+import hashlib
+import time
+import math
+import random
 import shutil
-from PIL import Image
+import tempfile
+from array import array
+from unittest import mock
+from PIL import Image, PngImagePlugin
 from app.services.image_handler import ImageHandler
 from app.services.exif_manager import ExifManager
 from app.services.watermark_manager import WatermarkManager
+from app.services.metadata_templates import MetadataTemplates
+from app.services.file_reaper import FileReaper
+from app.services.job_runner import JobRunner
+from app.services.preview_manager import PreviewManager
+from app.services.batch_exif_index import BatchExifIndex
+from app.services.gps_batch import GpsBatch
+from app.services.processing_options import ProcessingOptions
+from app.services.directory_pipeline import DirectoryPipeline, ANALYSIS_NAME
 from tests.utils import create_dummy_image, get_exif_data
 from tests.test_routes import TestConfig
 from app import create_app
 import piexif
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 class TestServices(unittest.TestCase):
     def setUp(self):
+        TestConfig.use_data_folder(tempfile.mkdtemp(prefix='picturify-test-'))
         self.app = create_app(TestConfig)
         self.app_context = self.app.app_context()
         self.app_context.push()
@@ -30,6 +53,7 @@ class TestServices(unittest.TestCase):
             shutil.rmtree(TestConfig.UPLOAD_FOLDER)
         if os.path.exists(TestConfig.PROCESSED_FOLDER):
             shutil.rmtree(TestConfig.PROCESSED_FOLDER)
+        shutil.rmtree(TestConfig.DATA_FOLDER, ignore_errors=True)
 
     def test_image_handler_resize(self):
         """Test ImageHandler resize logic (mock or real)."""
@@ -56,9 +80,520 @@ class TestServices(unittest.TestCase):
         self.assertTrue(os.path.exists(purified_filename))
         self.assertIsNone(get_exif_data(purified_filename))
 
+    def test_exif_manager_remove_is_lossless(self):
+        """Test that JPEG purification copies the scan data byte for byte."""
+        filename = os.path.join(TestConfig.UPLOAD_FOLDER, 'test_lossless.jpg')
+        exif_dict = {"0th": {piexif.ImageIFD.Make: b"TestCamera"}}
+        create_dummy_image(filename, size=(64, 48), exif_data=exif_dict)
+
+        dest = ExifManager.remove_exif(filename)
+
+        with open(filename, 'rb') as f:
+            original = f.read()
+        with open(dest, 'rb') as f:
+            purified = f.read()
+        scan = original[original.index(b'\xff\xda'):]
+        self.assertTrue(purified.endswith(scan))
+        self.assertNotIn(b'TestCamera', purified)
+        with Image.open(dest) as img:
+            self.assertEqual(img.size, (64, 48))
+
+    def test_exif_manager_remove_png_webp_tiff_structurally(self):
+        """Test that PNG, WebP and TIFF metadata is dropped without re-encoding pixels."""
+        exif = piexif.dump({"0th": {piexif.ImageIFD.Make: b"SecretCam"},
+                            "Exif": {piexif.ExifIFD.MakerNote: b"SecretNote"}})
+        image = Image.effect_noise((64, 48), 40).convert('RGB')
+        png_info = PngImagePlugin.PngInfo()
+        png_info.add_text('Comment', 'SecretText')
+
+        png = os.path.join(TestConfig.UPLOAD_FOLDER, 'test_strip.png')
+        image.save(png, exif=exif, pnginfo=png_info)
+        webp = os.path.join(TestConfig.UPLOAD_FOLDER, 'test_strip.webp')
+        image.save(webp, exif=exif, xmp=b'<x:xmpmeta>SecretXmp</x:xmpmeta>', quality=80)
+        tiff = os.path.join(TestConfig.UPLOAD_FOLDER, 'test_strip.tiff')
+        image.save(tiff, exif=exif, tiffinfo={270: 'SecretDescription'})
+
+        for filename in (png, webp, tiff):
+            with mock.patch('app.services.exif_manager.Image.open', side_effect=AssertionError):
+                dest = ExifManager.remove_exif(filename)
+            with open(dest, 'rb') as f:
+                self.assertNotIn(b'Secret', f.read())
+            with Image.open(filename) as original, Image.open(dest) as purified:
+                self.assertEqual(purified.format, original.format)
+                self.assertEqual(purified.tobytes(), original.tobytes())
+                self.assertNotIn(piexif.ImageIFD.Make, purified.getexif())
+
+        with open(png, 'rb') as f:
+            original = f.read()
+        with open(os.path.join(TestConfig.UPLOAD_FOLDER, 'purified_test_strip.png'), 'rb') as f:
+            purified = f.read()
+        idat = original.index(b'IDAT') - 4
+        self.assertIn(original[idat:], purified)
+
+    def test_exif_manager_modify_keeps_scan_data(self):
+        """Test that metadata edits splice a new EXIF block without re-encoding."""
+        filename = os.path.join(TestConfig.UPLOAD_FOLDER, 'test_splice.jpg')
+        exif_dict = {"0th": {piexif.ImageIFD.Make: b"TestCamera"}}
+        create_dummy_image(filename, exif_data=exif_dict)
+
+        dest = ExifManager.modify_exif(filename, {'Artist': 'Jane Doe'})
+        dest = ExifManager.delete_tags(dest, ['Make'])
+
+        with open(filename, 'rb') as f:
+            original = f.read()
+        with open(dest, 'rb') as f:
+            edited = f.read()
+        self.assertTrue(edited.endswith(original[original.index(b'\xff\xda'):]))
+
+        exif = get_exif_data(dest)
+        self.assertEqual(exif["0th"][piexif.ImageIFD.Artist], b"Jane Doe")
+        self.assertNotIn(piexif.ImageIFD.Make, exif["0th"])
+
+    def test_exif_manager_get_exif_data_header_only(self):
+        """Test that EXIF is read from JPEG and PNG headers without Pillow decoding."""
+        jpeg = os.path.join(TestConfig.UPLOAD_FOLDER, 'test_header.jpg')
+        create_dummy_image(jpeg, exif_data={"0th": {piexif.ImageIFD.Make: b"TestCamera"}})
+        png = os.path.join(TestConfig.UPLOAD_FOLDER, 'test_header.png')
+        Image.new('RGB', (10, 10)).save(png, exif=piexif.dump({"0th": {piexif.ImageIFD.Model: b"PngCam"}}))
+
+        with mock.patch('app.services.exif_manager.Image.open', side_effect=AssertionError):
+            self.assertEqual(ExifManager.get_exif_data(jpeg)['Make'], 'TestCamera')
+            self.assertEqual(ExifManager.get_exif_data(png)['Model'], 'PngCam')
+            self.assertEqual(ExifManager.get_exif_data(self.filename), {})
+
+    def test_heif_metadata_edited_in_container(self):
+        """Test HEIF EXIF is read, replaced and stripped without re-encoding the image."""
+        filename = os.path.join(TestConfig.UPLOAD_FOLDER, 'test_meta.heic')
+        Image.new('RGB', (64, 48), color='red').save(
+            filename, 'HEIF', exif=piexif.dump({"0th": {piexif.ImageIFD.Make: b"HeicCamera"}}))
+        with mock.patch('app.services.exif_manager.Image.open', side_effect=AssertionError):
+            self.assertEqual(ExifManager.get_exif_data(filename)['Make'], 'HeicCamera')
+            # A larger block is appended, the rest of the file is kept
+            edited = ExifManager.modify_exif(filename, {'Artist': 'Jane Doe ' * 50})
+            purified = ExifManager.remove_exif(edited)
+            self.assertEqual(ExifManager.get_exif_data(edited)['Make'], 'HeicCamera')
+            self.assertEqual(ExifManager.get_exif_data(purified), {})
+
+        with open(purified, 'rb') as f:
+            data = f.read()
+        self.assertNotIn(b'HeicCamera', data)
+        self.assertNotIn(b'Jane Doe', data)
+        with Image.open(filename) as before, Image.open(purified) as after:
+            self.assertEqual((after.format, after.size), ('HEIF', (64, 48)))
+            self.assertEqual(before.tobytes(), after.tobytes())
+
+    def test_template_rules_compile(self):
+        """Test that names, globs and groups compile into per-IFD tag ID sets."""
+        compiled = MetadataTemplates.compile(['Artist', 'GPS*', '@camera'])
+
+        self.assertIn(piexif.ImageIFD.Artist, compiled["0th"])
+        self.assertIn(piexif.ImageIFD.Make, compiled["0th"])
+        self.assertIn(piexif.ExifIFD.BodySerialNumber, compiled["Exif"])
+        self.assertIn(piexif.GPSIFD.GPSVersionID, compiled["GPS"])
+        self.assertIn(piexif.GPSIFD.GPSLatitude, compiled["GPS"])
+        self.assertNotIn(piexif.ImageIFD.Software, compiled["0th"])
+
+    def test_exif_manager_keep_only_tags(self):
+        """Test template filtering keeps only matching tags."""
+        filename = os.path.join(TestConfig.UPLOAD_FOLDER, 'test_keep.jpg')
+        exif_dict = {
+            "0th": {piexif.ImageIFD.Make: b"TestCamera", piexif.ImageIFD.Software: b"Editor"},
+            "GPS": {piexif.GPSIFD.GPSLatitudeRef: b"N"},
+        }
+        create_dummy_image(filename, exif_data=exif_dict)
+
+        dest = ExifManager.keep_only_tags(filename, ['@camera', 'GPS*'])
+
+        exif = get_exif_data(dest)
+        self.assertIn(piexif.ImageIFD.Make, exif["0th"])
+        self.assertNotIn(piexif.ImageIFD.Software, exif["0th"])
+        self.assertEqual(exif["GPS"][piexif.GPSIFD.GPSLatitudeRef], b"N")
+
+    def test_template_file_loading(self):
+        """Test loading user-supplied templates from a JSON file."""
+        path = os.path.join(TestConfig.UPLOAD_FOLDER, 'templates.json')
+        with open(path, 'w') as f:
+            f.write('{"minimal": ["Orientation", "@dates"]}')
+
+        MetadataTemplates.load_file(path)
+        try:
+            compiled = MetadataTemplates.get_compiled('minimal')
+            self.assertIn(piexif.ImageIFD.Orientation, compiled["0th"])
+            self.assertIn(piexif.ExifIFD.DateTimeOriginal, compiled["Exif"])
+        finally:
+            MetadataTemplates.TEMPLATES.pop('minimal', None)
+
+    def test_file_reaper_deletes_due_files(self):
+        """Test the reaper deletes exactly the indexed files that have expired."""
+        index = ImageHandler.get_index()
+        storage = ImageHandler.get_storage()
+        for name in ('expired.jpg', 'fresh.jpg'):
+            create_dummy_image(storage.writable_path(name))
+            ImageHandler.register_file(name)
+        size = os.path.getsize(ImageHandler.get_path('expired.jpg'))
+        index.register('expired.jpg', size, 0)
+
+        files, reclaimed = FileReaper.reap(storage, index)
+
+        self.assertEqual((files, reclaimed), (1, size))
+        self.assertFalse(os.path.exists(ImageHandler.get_path('expired.jpg')))
+        self.assertTrue(os.path.exists(ImageHandler.get_path('fresh.jpg')))
+        ImageHandler.delete_file('fresh.jpg')
+
+    def test_file_reaper_drops_variants_of_reaped_files(self):
+        """Test cached previews go with their reaped source, once no upload shares its content."""
+        from app.services.content_store import ContentStore
+        index = ImageHandler.get_index()
+        storage = ImageHandler.get_storage()
+        variant_folder = self.app.config['VARIANT_FOLDER']
+        with open(self.filename, 'rb') as f:
+            sha = hashlib.sha256(f.read()).hexdigest()
+        ContentStore.add(sha, self.filename, storage.writable_path('shared_a.jpg'))
+        ContentStore.link(sha, storage.writable_path('shared_b.jpg'))
+        create_dummy_image(storage.writable_path('plain.jpg'))
+        for name, content_hash in (('shared_a.jpg', sha), ('shared_b.jpg', sha), ('plain.jpg', None)):
+            index.register(name, 100, 0 if name != 'shared_b.jpg' else 1e12, sha256=content_hash)
+        shared, _ = PreviewManager.get_or_render(storage.path('shared_a.jpg'), 'large', sha)
+        plain, _ = PreviewManager.get_or_render(storage.path('plain.jpg'), 'large')
+
+        self.assertEqual(FileReaper.reap(storage, index, self.app.config['BLOB_FOLDER'], variant_folder)[0], 2)
+        self.assertFalse(os.path.exists(plain))
+        self.assertTrue(os.path.exists(shared))  # shared_b.jpg still has this content
+
+        index.register('shared_b.jpg', 100, 0, sha256=sha)
+        FileReaper.reap(storage, index, self.app.config['BLOB_FOLDER'], variant_folder)
+        self.assertFalse(os.path.exists(shared))
+        self.assertEqual(index.variant_bytes(), 0)
+
+    def test_file_reaper_sweeps_abandoned_temporary_files(self):
+        """Test temporary files left by crashed workers are deleted once old enough."""
+        index = ImageHandler.get_index()
+        storage = ImageHandler.get_storage()
+        shard = os.path.dirname(storage.writable_path('stored.jpg'))
+        old_files = [os.path.join(TestConfig.UPLOAD_FOLDER, '.ingest_abc'),
+                     os.path.join(TestConfig.UPLOAD_FOLDER, '.bulk_abc_x.jpg'),
+                     os.path.join(shard, '.tmp_abc')]
+        recent = os.path.join(TestConfig.UPLOAD_FOLDER, '.ingest_recent')
+        for path in old_files + [recent]:
+            with open(path, 'wb') as f:
+                f.write(b'x' * 10)
+        for path in old_files:
+            os.utime(path, (0, 0))
+
+        files, reclaimed = FileReaper.sweep(storage, index, 600)
+
+        self.assertEqual((files, reclaimed), (3, 30))
+        self.assertFalse([path for path in old_files if os.path.exists(path)])
+        self.assertTrue(os.path.exists(recent))
+        self.assertTrue(os.path.exists(self.filename))
+
+    def test_storage_limit_evicts_session_lru(self):
+        """Test per-session byte budgets evict that session's oldest files only."""
+        index = ImageHandler.get_index()
+        names = ['lru_a.jpg', 'lru_b.jpg', 'lru_other.jpg']
+        for i, name in enumerate(names):
+            create_dummy_image(ImageHandler.get_storage().writable_path(name))
+            index.register(name, 100, 1e12, session='other' if 'other' in name else 'me', now=i)
+        self.app.config['MAX_SESSION_BYTES'] = 250
+
+        try:
+            ImageHandler.enforce_storage_limit(100, 'me')
+        finally:
+            self.app.config['MAX_SESSION_BYTES'] = TestConfig.MAX_SESSION_BYTES
+
+        self.assertFalse(os.path.exists(ImageHandler.get_path('lru_a.jpg')))
+        self.assertTrue(os.path.exists(ImageHandler.get_path('lru_b.jpg')))
+        self.assertTrue(os.path.exists(ImageHandler.get_path('lru_other.jpg')))
+        self.assertEqual(index.usage('me'), (1, 100))
+        for name in names:
+            ImageHandler.delete_file(name)
+
+    def test_image_handler_storage_runs_without_app(self):
+        """Test files are stored, indexed and evicted outside Flask when options are passed."""
+        options = ProcessingOptions.from_config(self.app.config)
+        options.max_stored_files = 2
+        self.app_context.pop()
+        try:
+            names = ['cli_a.jpg', 'cli_b.jpg']
+            for name in names:
+                create_dummy_image(ImageHandler.get_storage(options).writable_path(name))
+                ImageHandler.register_file(name, options=options)
+            self.assertEqual(ImageHandler.get_index(options).usage()[0], 2)
+
+            ImageHandler.enforce_storage_limit(options=options)
+            self.assertFalse(os.path.exists(ImageHandler.get_path('cli_a.jpg', options)))
+            self.assertEqual(ImageHandler.get_index(options).usage()[0], 1)
+            ImageHandler.delete_file('cli_b.jpg', options)
+            self.assertEqual(ImageHandler.get_index(options).usage()[0], 0)
+        finally:
+            self.app_context = self.app.app_context()
+            self.app_context.push()
+
+    def test_storage_memory_tier_spills_to_disk(self):
+        """Test small results go to the memory tier and spill to sharded disk paths past its budget."""
+        index = ImageHandler.get_index()
+        memory = os.path.join(TestConfig.DATA_FOLDER, 'memory')
+        size = os.path.getsize(self.filename)
+        self.app.config.update(STORAGE_MEMORY_FOLDER=memory, STORAGE_MEMORY_BYTES=size * 3 // 2,
+                               STORAGE_MEMORY_MAX_FILE_BYTES=size)
+        try:
+            names = []
+            for name in ('tier_a.jpg', 'tier_b.jpg'):
+                path = os.path.join(TestConfig.UPLOAD_FOLDER, name)
+                shutil.copy(self.filename, path)
+                names.append(ImageHandler.replace_file(name, path))
+
+            spilled, kept = (ImageHandler.get_path(name) for name in names)
+            self.assertTrue(kept.startswith(memory))
+            self.assertEqual(len(os.path.relpath(spilled, TestConfig.UPLOAD_FOLDER).split(os.sep)), 3)
+            self.assertEqual(index.tier_bytes('memory'), size)
+
+            # Files left at the top of the folder are moved to their shard on rebuild
+            index.rebuild(ImageHandler.get_storage(), 600)
+            self.assertTrue(os.path.exists(ImageHandler.get_path('test_service_image.jpg')))
+            self.assertNotEqual(ImageHandler.get_path('test_service_image.jpg'), self.filename)
+            for name in names + ['test_service_image.jpg']:
+                ImageHandler.delete_file(name)
+        finally:
+            self.app.config.update(STORAGE_MEMORY_FOLDER=None)
+            shutil.rmtree(memory, ignore_errors=True)
+
+    def test_batch_exif_index_filters_and_counts(self):
+        """Test the columnar batch index filters by GPS, tag value and date, and survives a round trip."""
+        exif = {
+            'a.jpg': {'Make': 'Canon', 'DateTimeOriginal': '2024:05:01 10:00:00',
+                      'GPSInfo': {'GPSLatitude': (48, 51, 0), 'GPSLatitudeRef': 'N',
+                                  'GPSLongitude': (2, 21, 0), 'GPSLongitudeRef': 'E'}},
+            'b.jpg': {'Make': 'Canon', 'DateTimeOriginal': '2023:01:01 10:00:00', 'BodySerialNumber': '123'},
+            'c.jpg': {'Make': 'Nikon'},
+            'd.jpg': {},
+        }
+        index = BatchExifIndex.build(list(exif), exif.get)
+        index = BatchExifIndex.loads(index.dumps())
+
+        self.assertEqual(index.select(has_gps=True), ['a.jpg'])
+        self.assertEqual(index.select(tags={'Make': 'Canon'}), ['a.jpg', 'b.jpg'])
+        self.assertEqual(index.select(tags={'Make': 'Sony'}), [])
+        since = time.mktime((2024, 1, 1, 0, 0, 0, 0, 0, -1))
+        self.assertEqual(index.select(tags={'Make': 'Canon'}, date_from=since), ['a.jpg'])
+        self.assertEqual(index.counts('Make'), [('Canon', 2), ('Nikon', 1)])
+
+        summary = index.summary()
+        self.assertEqual((summary['files'], summary['with_exif'], summary['with_gps'], summary['with_serials']),
+                         (4, 3, 1, 1))
+        self.assertAlmostEqual(index.numbers['GPSLatitude'][0], 48.85, places=2)
+
+        # Rows of files already indexed are reused, not read again
+        rebuilt = BatchExifIndex.build(['c.jpg', 'e.jpg'], lambda name: {'Make': 'Sony'}, index)
+        self.assertEqual(rebuilt.select(tags={'Make': 'Nikon'}), ['c.jpg'])
+        self.assertEqual(rebuilt.counts('Make'), [('Nikon', 1), ('Sony', 1)])
+
+    def test_gps_batch_converts_and_rewrites_positions(self):
+        """Test batch GPS reading, grid snapping and the pixel-free GPS IFD rewrite."""
+        located = os.path.join(self.app.config['UPLOAD_FOLDER'], 'gps_located.jpg')
+        create_dummy_image(located, exif_data={
+            "0th": {piexif.ImageIFD.Make: b"Canon"},
+            "GPS": {
+                piexif.GPSIFD.GPSLatitudeRef: b'S', piexif.GPSIFD.GPSLatitude: ((33, 1), (51, 1), (3576, 100)),
+                piexif.GPSIFD.GPSLongitudeRef: b'E', piexif.GPSIFD.GPSLongitude: ((151, 1), (12, 1), (3000, 100)),
+                piexif.GPSIFD.GPSAltitude: (58, 1),
+            },
+        })
+        try:
+            positions = GpsBatch.read(['located', 'plain'], [located, self.filename])
+            self.assertAlmostEqual(positions.lat[0], -33.8599, places=4)
+            self.assertAlmostEqual(positions.lon[0], 151.2083, places=4)
+            self.assertEqual(positions.alt[0], 58.0)
+            self.assertEqual([row[0] for row in positions.located()], ['located'])
+            feature = json.loads(positions.to_geojson())['features'][0]
+            self.assertEqual(feature['geometry']['coordinates'], [151.2083333, -33.8599333, 58.0])
+
+            ifd = positions.snap(0.1).gps_ifds()
+            self.assertEqual(ifd[1], {})
+            self.assertEqual(ifd[0][piexif.GPSIFD.GPSLatitudeRef], b'S')
+            self.assertEqual(ifd[0][piexif.GPSIFD.GPSLatitude], ((33, 1), (54, 1), (0, 10000)))
+
+            with open(located, 'rb') as f:
+                scan = f.read().split(b'\xff\xda', 1)[1]
+            dest = ExifManager.replace_gps(located, ifd[0])
+            with open(dest, 'rb') as f:
+                self.assertEqual(f.read().split(b'\xff\xda', 1)[1], scan)
+            exif = piexif.load(dest)
+            self.assertEqual(exif['0th'][piexif.ImageIFD.Make], b'Canon')
+            self.assertNotIn(piexif.GPSIFD.GPSAltitude, exif['GPS'])
+            self.assertAlmostEqual(GpsBatch.read(['x'], [dest]).lat[0], -33.9, places=6)
+            os.remove(dest)
+        finally:
+            os.remove(located)
+
+    @staticmethod
+    def _gps_conversions():
+        """Runs every GpsBatch conversion on the same inputs (NaN made comparable)."""
+        rationals = array('q', [33, 1, 51, 1, 3576, 100, 0, 0, 0, 0, 0, 0, 89, 1, 59, 1, 5999, 100])
+        signs = array('d', [-1.0, math.nan, 1.0])
+        degrees = GpsBatch.to_degrees(rationals, signs)
+        heights = GpsBatch._divide(array('q', [58, 1, 0, 0, 7, 2]), array('d', [1.0, 1.0, -1.0]))
+        lon = array('d', [151.2083, math.nan, 179.99])
+        snapped = GpsBatch(['a', 'b', 'c'], array('d', degrees), array('d', lon), heights).snap(0.1)
+        jittered = GpsBatch(['a', 'b', 'c'], array('d', degrees), array('d', lon), heights).jitter(
+            500, rng=random.Random(7))
+        columns = [degrees, heights, snapped.lat, snapped.lon, jittered.lat, jittered.lon]
+        return ([['nan' if math.isnan(v) else round(v, 9) for v in column] for column in columns],
+                GpsBatch.to_rationals(degrees))
+
+    def test_gps_batch_pure_python_path(self):
+        """Test the GpsBatch conversions without NumPy."""
+        with mock.patch('app.services.gps_batch.np', None):
+            columns, rationals = self._gps_conversions()
+        degrees, heights, snapped_lat, snapped_lon, jittered_lat, jittered_lon = columns
+        self.assertEqual(degrees[1], 'nan')
+        self.assertAlmostEqual(degrees[0], -33.8599333, places=6)
+        self.assertEqual(heights, [58.0, 'nan', -3.5])
+        self.assertEqual(snapped_lat[1:], ['nan', 90.0])
+        self.assertEqual(snapped_lon[2], -180.0)
+        self.assertEqual(rationals[0], ((33, 1), (51, 1), (357600, 10000)))
+        self.assertIsNone(rationals[1])
+        self.assertEqual(rationals[2], ((89, 1), (59, 1), (599900, 10000)))
+        self.assertEqual(jittered_lat[1], 'nan')
+        self.assertLess(abs(jittered_lat[0] - degrees[0]) * 111320.0, 500)
+
+    @unittest.skipUnless(numpy, 'NumPy is not installed')
+    def test_gps_batch_numpy_path_matches_pure_python(self):
+        """Test the NumPy GpsBatch conversions give the pure Python results."""
+        with mock.patch('app.services.gps_batch.np', None):
+            expected = self._gps_conversions()
+        self.assertEqual(self._gps_conversions(), expected)
+
+    def test_directory_pipeline_runs_without_app_and_resumes(self):
+        """Test the command line pipeline processes a tree outside Flask and skips files already done."""
+        source = os.path.join(self.app.config['UPLOAD_FOLDER'], 'tree')
+        output = os.path.join(self.app.config['PROCESSED_FOLDER'], 'tree_out')
+        for i, sub in enumerate(['', 'a', 'a/b']):
+            os.makedirs(os.path.join(source, sub), exist_ok=True)
+            create_dummy_image(os.path.join(source, sub, f'img{i}.jpg'),
+                               exif_data={"0th": {piexif.ImageIFD.Make: b"Canon"}})
+        with open(os.path.join(source, 'notes.txt'), 'w') as f:
+            f.write('not an image')
+
+        os.chmod(os.path.join(source, 'a', 'img1.jpg'), 0o640)
+
+        self.app_context.pop()
+        try:
+            # Worker processes and the inline mode both run without an app context
+            report = DirectoryPipeline('purify', source, output, workers=2).run()
+            self.assertEqual((report['processed'], report['skipped'], report['failed']), (3, 0, 0))
+            self.assertIsNone(get_exif_data(os.path.join(output, 'a', 'b', 'img2.jpg')))
+            # Outputs keep the source's permissions
+            self.assertEqual(os.stat(os.path.join(output, 'a', 'img1.jpg')).st_mode & 0o777, 0o640)
+
+            report = DirectoryPipeline('purify', source, output, workers=0).run()
+            self.assertEqual((report['processed'], report['skipped']), (0, 3))
+
+            # Hash mode records hashes first, then only redoes changed content, not a bare touch
+            report = DirectoryPipeline('purify', source, output, workers=0, skip='hash').run()
+            self.assertEqual(report['processed'], 3)
+            create_dummy_image(os.path.join(source, 'a', 'img1.jpg'), size=(120, 100))
+            os.utime(os.path.join(source, 'img0.jpg'), ns=(0, 0))
+            report = DirectoryPipeline('purify', source, output, workers=0, skip='hash').run()
+            self.assertEqual((report['processed'], report['skipped']), (1, 2))
+
+            # Another task writing to the same output directory replaces the purified files
+            report = DirectoryPipeline('template', source, output, workers=0, template='flickr').run()
+            self.assertEqual(report['processed'], 3)
+            self.assertIsNotNone(get_exif_data(os.path.join(output, 'img0.jpg')))
+            report = DirectoryPipeline('purify', source, output, workers=0).run()
+            self.assertEqual((report['processed'], report['skipped']), (3, 0))
+            self.assertIsNone(get_exif_data(os.path.join(output, 'img0.jpg')))
+
+            report = DirectoryPipeline('analyze', source, output, workers=0).run()
+            self.assertEqual(report['processed'], 3)
+            with open(os.path.join(output, ANALYSIS_NAME)) as f:
+                lines = [json.loads(line) for line in f]
+            self.assertEqual(lines[0], {'path': 'img0.jpg', 'sha256': None, 'exif_data': {'Make': 'Canon'}})
+
+            # A file that cannot be read is a failure, not a file without metadata
+            with open(os.path.join(source, 'bad.jpg'), 'wb') as f:
+                f.write(b'not an image')
+            report = DirectoryPipeline('analyze', source, output, workers=0).run()
+            self.assertEqual((report['processed'], report['skipped'], report['failed']), (0, 3, 1))
+        finally:
+            self.app_context = self.app.app_context()
+            self.app_context.push()
+
+    def test_job_queue_requeues_interrupted_items(self):
+        """Test items left running by a dead runner are retried, then failed."""
+        queue = JobRunner.get_queue()
+        job_id = queue.create('purify', {})
+        first = queue.reserve(job_id, 2, 10)
+        for seq in (first, first + 1):
+            shutil.copy(self.filename, queue.input_path(job_id, seq, 'img.jpg'))
+        queue.add_items(job_id, [(first, 'img.jpg'), (first + 1, 'img.jpg')])
+        queue.start(job_id)
+
+        # Runner killed while both items were running
+        queue.claim(10)
+        self.assertEqual(queue.requeue_running(max_attempts=3), 2)
+        self.assertEqual(queue.job(job_id)['counts'], {'queued': 2})
+
+        # A file that keeps killing the runner is given up on
+        queue.claim(1)
+        queue.complete(job_id, [])
+        for _ in range(2):
+            queue.requeue_running(max_attempts=3)
+            queue.claim(1)
+        queue.requeue_running(max_attempts=3)
+        self.assertEqual(queue.item(job_id, first)[2:], ('failed', 'Worker crashed'))
+
+        while JobRunner.run_pending():
+            pass
+        job = queue.job(job_id)
+        self.assertEqual((job['status'], job['counts']), ('done', {'done': 1, 'failed': 1}))
+        queue.delete(job_id)
+
+    def test_preview_uses_embedded_thumbnail(self):
+        """Test previews come from the EXIF thumbnail when it is large enough, else a draft decode."""
+        thumb = io.BytesIO()
+        Image.new('RGB', (400, 300), 'blue').save(thumb, 'JPEG')
+        source = os.path.join(TestConfig.UPLOAD_FOLDER, 'preview_src.jpg')
+        Image.new('RGB', (2000, 1500), 'red').save(source, exif=piexif.dump({
+            "0th": {}, "1st": {piexif.ImageIFD.XResolution: (72, 1)}, "thumbnail": thumb.getvalue()
+        }))
+        dest = os.path.join(TestConfig.UPLOAD_FOLDER, 'preview.webp')
+
+        PreviewManager.render(source, dest, 320)
+        with Image.open(dest) as img:
+            self.assertEqual((img.format, img.size), ('WEBP', (320, 240)))
+            r, g, b = img.convert('RGB').getpixel((10, 10))
+            self.assertGreater(b, r)
+            self.assertNotIn('exif', img.info)
+
+        # Thumbnail too small for the requested size: scaled JPEG decode
+        PreviewManager.render(source, dest, 800)
+        with Image.open(dest) as img:
+            self.assertEqual(img.size, (800, 600))
+            r, g, b = img.convert('RGB').getpixel((10, 10))
+            self.assertGreater(r, b)
+
     def test_watermark_manager(self):
-        """Test WatermarkManager (placeholder)."""
-        pass
+        """Test the watermark only touches the text box and reuses the rendered overlay."""
+        from app.services.watermark_manager import _render_tile
+        source = os.path.join(TestConfig.UPLOAD_FOLDER, 'wm_src.jpg')
+        Image.new('RGB', (400, 300), (0, 0, 0)).save(source, exif=piexif.dump({"0th": {piexif.ImageIFD.Make: b"Cam"}}))
+        _render_tile.cache_clear()
+
+        first = WatermarkManager.apply_watermark(source, 'Picturify', 'center', 1.0)
+        second = WatermarkManager.apply_watermark(source, 'Picturify', 'center', 1.0, source + '.2.jpg')
+
+        # Same dimensions: the overlay is rendered once
+        self.assertTrue(second)
+        self.assertEqual(_render_tile.cache_info().misses, 1)
+        mask, (x, y) = WatermarkManager.get_overlay('Picturify', (400, 300), 'center', 1.0)
+        with Image.open(first) as img:
+            self.assertEqual(img.mode, 'RGB')
+            self.assertEqual(get_exif_data(first)['0th'][piexif.ImageIFD.Make], b"Cam")
+            self.assertLess(sum(img.getpixel((5, 5))), 30)
+            box = img.crop((x, y, x + mask.width, y + mask.height))
+            self.assertGreater(box.convert('L').getextrema()[1], 200)
 
 if __name__ == '__main__':
     unittest.main()
@@ -53,3 +53,68 @@ def get_exif_data(filename):
         return None
     except Exception:
         return None
+
+# EXIF densities of the benchmark corpus
+EXIF_DENSITIES = ('none', 'typical', 'makernote', 'gps')
+
+def create_corpus_image(filename, format='JPEG', size=(640, 480), density='typical', seed=0):
+    """
+    Creates a deterministic, photo-like image for benchmarks: same arguments,
+    same pixels and metadata. density is one of EXIF_DENSITIES ('makernote'
+    adds a ~48 KB MakerNote, 'gps' a full GPS IFD).
+    """
+    import random
+    from PIL import ImageDraw
+
+    rng = random.Random(f"{seed}-{size}-{format}-{density}")
+    # Gradients plus random shapes: compresses like a photo, unlike a flat fill
+    image = Image.merge('RGB', [
+        Image.linear_gradient('L').rotate(rng.randrange(360)).resize(size) for _ in range(3)
+    ])
+    draw = ImageDraw.Draw(image)
+    for _ in range(40):
+        x, y = rng.randrange(size[0]), rng.randrange(size[1])
+        w, h = rng.randrange(1, size[0] // 4 + 2), rng.randrange(1, size[1] // 4 + 2)
+        draw.ellipse((x, y, x + w, y + h), fill=tuple(rng.randrange(256) for _ in range(3)))
+
+    exif_bytes = None
+    if density != 'none':
+        exif_dict = {
+            "0th": {
+                piexif.ImageIFD.Make: b"BenchCam",
+                piexif.ImageIFD.Model: b"Model X100",
+                piexif.ImageIFD.Software: b"Firmware 1.0",
+                piexif.ImageIFD.DateTime: b"2024:01:02 03:04:05",
+                piexif.ImageIFD.Artist: b"Bench Artist",
+                piexif.ImageIFD.Orientation: 1,
+            },
+            "Exif": {
+                piexif.ExifIFD.DateTimeOriginal: b"2024:01:02 03:04:05",
+                piexif.ExifIFD.ExposureTime: (1, 250),
+                piexif.ExifIFD.FNumber: (28, 10),
+                piexif.ExifIFD.ISOSpeedRatings: 200,
+                piexif.ExifIFD.FocalLength: (350, 10),
+                piexif.ExifIFD.LensModel: b"Bench 35mm F1.8",
+            },
+            "GPS": {},
+        }
+        if density == 'makernote':
+            exif_dict["Exif"][piexif.ExifIFD.MakerNote] = rng.randbytes(48 * 1024)
+        elif density == 'gps':
+            exif_dict["GPS"] = {
+                piexif.GPSIFD.GPSVersionID: (2, 3, 0, 0),
+                piexif.GPSIFD.GPSLatitudeRef: b"N",
+                piexif.GPSIFD.GPSLatitude: ((48, 1), (51, 1), (2964, 100)),
+                piexif.GPSIFD.GPSLongitudeRef: b"E",
+                piexif.GPSIFD.GPSLongitude: ((2, 1), (17, 1), (4020, 100)),
+                piexif.GPSIFD.GPSAltitude: (35, 1),
+                piexif.GPSIFD.GPSDateStamp: b"2024:01:02",
+            }
+        exif_bytes = piexif.dump(exif_dict)
+
+    save_kwargs = {'exif': exif_bytes} if exif_bytes else {}
+    if format == 'HEIF':
+        import pillow_heif
+        pillow_heif.register_heif_opener()
+    image.save(filename, format=format, **save_kwargs)
+    return filename